@@ -0,0 +1,175 @@
+# Contention benchmark for ClientManager: threads register, look up, rename
+# and remove clients concurrently, the way RecvThreads do, with every client
+# behind the same NATed IP by default, then race each other for the same
+# nicks. Compares the previous unlocked manager (list per IP) with the
+# striped manager and the same manager on one lock.
+#
+#   python -m src.benchmarks.client_manager --clients 10000 --threads 16
+
+import argparse
+import random
+import threading
+import time
+
+from src.benchmarks.common import *
+from src.hinge.server.ClientManager import ClientManager
+from src.hinge.server.HingeClient import Connection
+from src.hinge.utils import *
+
+
+class LegacyClientManager(object):
+
+    # The previous implementation, no locking and a list of connections per IP
+    def __init__(self):
+        self._ip_to_connections = {}
+        self._id_to_client = {}
+        self._nick_to_client = {}
+
+    def add(self, client):
+        if self._ip_to_connections.get(client.ip):
+            self._ip_to_connections[client.ip].append(client)
+        else:
+            self._ip_to_connections[client.ip] = [client]
+        if not self._id_to_client.get(client.id):
+            self._id_to_client[client.id] = client
+        else:
+            raise Exception("client with id {0} already exists".format(client.id))
+
+    def remove(self, client):
+        if (client.nick is not None) and self._nick_to_client.get(client.nick):
+            del self._nick_to_client[client.nick]
+        if self._id_to_client.get(client.id):
+            del self._id_to_client[client.id]
+        else:
+            raise KeyError("client with id {0} does not exist".format(client.id))
+        if self._ip_to_connections.get(client.ip):
+            self._ip_to_connections.get(client.ip).remove(client)
+        else:
+            raise KeyError("ip {0} is not connected".format(client.ip))
+
+    def register(self, client):
+        if self._nick_to_client.get(client.nick):
+            raise Exception("client with nick {0} already exists".format(client.nick))
+        else:
+            self._nick_to_client[client.nick] = client
+
+    def getClientById(self, client_id):
+        if self._id_to_client.get(client_id):
+            return self._id_to_client.get(client_id)
+        else:
+            raise KeyError("client with id {0} does not exist".format(client_id))
+
+    def getClientByNick(self, nick):
+        if self._nick_to_client.get(nick):
+            return self._nick_to_client.get(nick)
+        else:
+            raise KeyError("client with nick {0} does not exist".format(nick))
+
+    def updateClientId(self, client_id, new_client_id):
+        client = self.getClientById(client_id)
+        client.updateId(new_client_id)
+        del self._id_to_client[client_id]
+        self._id_to_client[client.id] = client
+
+
+MANAGERS = {
+    'legacy': LegacyClientManager,
+    'global_lock': lambda: ClientManager(stripes=1),
+    'striped': ClientManager,
+}
+
+
+def churn(manager, clients, lookups, errors, seed):
+    try:
+        # Connect and register the way HingeClient does
+        for client in clients:
+            manager.add(client)
+            manager.updateClientId(client.id, 'id' + client.nick)
+            manager.register(client)
+        for i in range(lookups):
+            for client in clients:
+                if manager.getClientById(client.id) is not client:
+                    errors.append('wrong client for id')
+                if manager.getClientByNick(client.nick) is not client:
+                    errors.append('wrong client for nick')
+        # Clients leave in any order, not the order they came in
+        random.Random(seed).shuffle(clients)
+        for client in clients:
+            manager.remove(client)
+    except Exception as e:
+        errors.append(repr(e))
+
+def race(manager, clients, winners):
+    # Every thread tries to take the same nicks, only one may get each
+    for client in clients:
+        manager.add(client)
+        try:
+            manager.register(client)
+            winners.append(client.nick)
+        except Exception:
+            pass
+
+def runThreads(workers):
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+def measure(name, clients, threads, lookups, ips, race_nicks):
+    manager = MANAGERS[name]()
+    connections = []
+    for i in range(clients):
+        connection = Connection(manager, '10.0.0.{0}'.format(i % ips))
+        connection.nick = 'nick{0}'.format(i)
+        connections.append(connection)
+    # Deal the clients out round robin so the threads are mid-churn together
+    errors = []
+    elapsed = runThreads([threading.Thread(target=churn,
+                                           args=(manager, connections[i::threads], lookups, errors, i))
+                          for i in range(threads)])
+    leftover = len(manager._id_to_client) + len(manager._nick_to_client) + \
+               sum(len(connections) for connections in manager._ip_to_connections.values())
+    ops = clients * (4 + 2 * lookups)
+    # Then have every thread race for the same nicks
+    winners = []
+    contenders = []
+    for i in range(threads):
+        contenders.append([Connection(manager, '10.0.0.1') for j in range(race_nicks)])
+        for j, connection in enumerate(contenders[-1]):
+            connection.nick = 'race{0}'.format(j)
+    runThreads([threading.Thread(target=race, args=(manager, contenders[i], winners))
+                for i in range(threads)])
+    return {
+        'manager': name,
+        'clients': clients,
+        'threads': threads,
+        'ips': ips,
+        'ops': ops,
+        'secs': round(elapsed, 3),
+        'ops_per_sec': round(ops / elapsed),
+        'errors': len(errors),
+        'leftover_entries': leftover,
+        'duplicate_nicks': len(winners) - len(set(winners)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="ClientManager contention")
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--lookups', type=int, default=8)
+    parser.add_argument('--ips', type=int, default=1)
+    parser.add_argument('--race-nicks', type=int, default=2000)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    # Switch threads often so the unlocked manager's races actually show up
+    sys.setswitchinterval(1e-6)
+    results = [measure(name, args.clients, args.threads, args.lookups, args.ips, args.race_nicks)
+               for name in sorted(MANAGERS)]
+    report('client_manager', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import tempfile
+import time
+
+from src.hinge.network.Message import Message
+from src.hinge.network.sock import Socket
+from src.hinge.utils import *
+
+
+# Let connect() pick the source port so TIME_WAIT sockets from earlier runs don't collide
+IP_BIND_ADDRESS_NO_PORT = getattr(socket, 'IP_BIND_ADDRESS_NO_PORT', 24)
+
+
+def runServer(server_class, port, kwargs):
+    # Keep the server's log file out of the working tree
+    os.chdir(tempfile.mkdtemp(prefix='hinge-bench-'))
+    server = server_class(port, show_console=False, **kwargs)
+    server.start()
+
+def startServer(server_class, port, daemon=True, **kwargs):
+    # Servers that fork workers of their own can't run as daemon processes
+    process = multiprocessing.Process(target=runServer,
+                                      args=(server_class, port, kwargs),
+                                      daemon=daemon)
+    process.start()
+    waitForPort(port)
+    return process
+
+def stopServer(process):
+    process.terminate()
+    process.join()
+
+def waitForPort(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("server did not start listening on port {0}".format(port))
+
+def processStats(pid):
+    stats = {}
+    with open('/proc/{0}/status'.format(pid)) as status:
+        for line in status:
+            key, _, value = line.partition(':')
+            if key == 'VmRSS':
+                stats['rss_kb'] = int(value.split()[0])
+            elif key == 'Threads':
+                stats['threads'] = int(value)
+    return stats
+
+def raiseFileLimit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def connectClient(port, nick, client_id=None, source_ip=None, socket_class=Socket):
+    sock = socket_class(('127.0.0.1', port))
+    # Spread connections over loopback addresses so we don't run out of ephemeral ports
+    if source_ip is not None:
+        sock.sock.setsockopt(socket.IPPROTO_IP, IP_BIND_ADDRESS_NO_PORT, 1)
+        sock.sock.bind((source_ip, 0))
+    sock.connect()
+    if client_id is None:
+        client_id = nick
+    sock.send(Message(COMMAND_VERSION, (client_id, SERVER_ROUTE), PROTOCOL_VERSION).json())
+    sock.send(Message(COMMAND_REGISTER, (client_id, SERVER_ROUTE), nick).json())
+    return sock
+
+def waitForRegistration(sock, client_id, nick, timeout=10):
+    # Ask the server for the nick's ID until it has been registered
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        sock.send(Message(COMMAND_REQ_ID, (client_id, SERVER_ROUTE), nick).json())
+        message = Message.createFromJson(sock.recv())
+        if message.command == COMMAND_SEND_ID and message.data != '':
+            return message.data
+        time.sleep(0.05)
+    raise RuntimeError("{0} was never registered".format(nick))
+
+def tcpSegmentsSent():
+    # System wide count of TCP segments sent, a stand-in for packets on loopback
+    with open('/proc/net/snmp') as snmp:
+        lines = [line.split() for line in snmp if line.startswith('Tcp:')]
+    return int(lines[1][lines[0].index('OutSegs')])
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def timeRound(run, setup, number):
+    if setup is None:
+        start = time.perf_counter()
+        for i in range(number):
+            run()
+        return time.perf_counter() - start
+    # Per call setup is left out of the timing
+    total = 0.0
+    for i in range(number):
+        args = setup()
+        start = time.perf_counter()
+        run(*args)
+        total += time.perf_counter() - start
+    return total
+
+def timeCase(run, setup=None, repeat=5, min_time=0.2):
+    # Double the calls per round until a round takes min_time, then keep that
+    number = 1
+    while True:
+        elapsed = timeRound(run, setup, number)
+        if elapsed >= min_time:
+            break
+        number *= 2
+    samples = [elapsed / number]
+    samples.extend(timeRound(run, setup, number) / number for i in range(repeat - 1))
+    return number, samples
+
+def summarize(case, number, samples, **fields):
+    result = {
+        'case': case,
+        'number': number,
+        'repeat': len(samples),
+        'min_us': round(min(samples) * 1e6, 2),
+        'median_us': round(statistics.median(samples) * 1e6, 2),
+        'mean_us': round(statistics.mean(samples) * 1e6, 2),
+        'stdev_us': round(statistics.stdev(samples) * 1e6, 2) if len(samples) > 1 else 0.0,
+        'ops_per_sec': round(1 / statistics.median(samples), 2),
+    }
+    result.update(fields)
+    return result
+
+def report(name, results, output=None):
+    for result in results:
+        fields = ' '.join('{0}={1}'.format(key, result[key]) for key in sorted(result))
+        print('{0}: {1}'.format(name, fields))
+    if output is not None:
+        with open(output, 'w') as out:
+            json.dump({'benchmark': name, 'results': results}, out, indent=2, sort_keys=True)
@@ -0,0 +1,204 @@
+# Ratio and CPU cost of compressing chat messages before they are
+# encrypted, over generated transcripts: short chat lines (common words
+# strung together, and some stock lines), pasted code (the repo's own
+# sources) and a mix of both with the odd traceback. Each
+# transcript goes through a pair of Compressors the way a session sends
+# and reads it, and through the alternatives they were picked over:
+# deflate with the dictionary but every message on its own, and the stream
+# without the dictionary. Reports bytes on the wire against no
+# compression, and the compress + decompress time per message, per
+# threshold.
+#
+#   python -m src.benchmarks.compression --messages 2000 --output compression.json
+
+import argparse
+import glob
+import os
+import random
+import zlib
+
+from src.benchmarks.common import *
+from src.hinge.network.Compressor import Compressor
+from src.hinge.network.Compressor import ZLIB_DICTIONARY
+from src.hinge.utils import *
+
+
+CHAT_OPENERS = ['', '', '', 'ok ', 'yeah ', 'hmm ', 'lol ', 'btw ', 'so ', 'wait ', 'Hey, ', 'Thanks! ']
+CHAT_LINES = [
+    'are you around later?',
+    'I think the build is broken again',
+    "did you see the message I sent you yesterday",
+    "I'm not sure that's going to work with the new server",
+    'can you push the fix when you get a chance',
+    'it works on my machine',
+    'meeting moved to 3pm tomorrow',
+    "what do you think about switching to the other library?",
+    'just got home, will look at it tonight',
+    'the tests pass now but it is slower than before',
+    "I don't know, maybe ask them about it",
+    'sounds good to me',
+    'going to grab lunch, back in 30',
+    'have you tried turning it off and on again',
+    'that makes sense, thank you',
+    'see https://github.com/hingechat/hinge/issues for the details',
+]
+CHAT_CLOSERS = ['', '', '', ' :)', ' :D', '?', '!', ' haha', ' lol', '...']
+# By how often they come up, picked with a Zipf distribution
+WORDS = (
+    "the I to you a and it that is of in we on for do have be this not can was just so but what with "
+    "me my are at if will get like know think about it's don't there they one all up out going "
+    "now then time would should could some more when how here need want back see did new work "
+    "today good right yeah really because still also maybe way thing try fix server client "
+    "message session key code build test tests branch commit push merge release bug crash log "
+    "config version update change patch review later tomorrow morning tonight week weekend lunch "
+    "call meeting problem issue error slow fast network connection handshake deploy restart "
+    "sure thanks okay cool nice weird broken working again already yet never always probably"
+).split()
+TRACEBACK = (
+    'Traceback (most recent call last):\n'
+    '  File "src/hinge/network/Client.py", line {0}, in run\n'
+    '    message = Message.Message.decode(frame)\n'
+    '  File "src/hinge/network/Message.py", line {1}, in decode\n'
+    '    raise ProtocolError(err=ERR_MALFORMED_MESSAGE)\n'
+    'src.hinge.utils.ProtocolError: {2}\n'
+)
+
+
+def sourceLines():
+    root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'hinge')
+    lines = []
+    for path in sorted(glob.glob(os.path.join(root, '**', '*.py'), recursive=True)):
+        with open(path) as source:
+            lines.extend(source.read().splitlines())
+    return lines
+
+def chatLine(rng):
+    # A stock line now and then, mostly words strung together
+    if rng.random() < 0.2:
+        line = rng.choice(CHAT_LINES)
+    else:
+        line = ' '.join(WORDS[min(int(rng.paretovariate(1.1)) - 1, len(WORDS) - 1)]
+                        for i in range(rng.randint(2, 25)))
+    return rng.choice(CHAT_OPENERS) + line + rng.choice(CHAT_CLOSERS)
+
+def paste(rng, lines):
+    start = rng.randrange(len(lines))
+    return '\n'.join(lines[start:start + rng.randint(5, 60)])
+
+def transcripts(rng, count):
+    lines = sourceLines()
+
+    def mixed():
+        roll = rng.random()
+        if roll < 0.1:
+            return paste(rng, lines)
+        elif roll < 0.13:
+            return TRACEBACK.format(rng.randint(1, 400), rng.randint(1, 400), rng.randint(0, 23))
+        else:
+            return chatLine(rng)
+
+    return [
+        ('chat', [chatLine(rng) for i in range(count)]),
+        ('code', [paste(rng, lines) for i in range(count)]),
+        ('mixed', [mixed() for i in range(count)]),
+    ]
+
+
+class PerMessage(object):
+
+    # Deflate with the dictionary, every message on its own
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def compress(self, data):
+        data = data.encode()
+        if len(data) < self.threshold:
+            return COMPRESSION_RAW + data
+        deflate = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -COMPRESSION_WINDOW_BITS,
+                                   COMPRESSION_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, ZLIB_DICTIONARY)
+        return COMPRESSION_DEFLATED + deflate.compress(data) + deflate.flush()
+
+    def decompress(self, data):
+        if data[:1] == COMPRESSION_RAW:
+            return data[1:]
+        return zlib.decompressobj(-COMPRESSION_WINDOW_BITS, zdict=ZLIB_DICTIONARY).decompress(data[1:])
+
+
+class StreamWithoutDictionary(object):
+
+    # Compressor's stream, with nothing to refer back to at the start
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.deflate = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -COMPRESSION_WINDOW_BITS,
+                                        COMPRESSION_MEM_LEVEL)
+        self.inflate = zlib.decompressobj(-COMPRESSION_WINDOW_BITS)
+
+    def compress(self, data):
+        data = data.encode()
+        if len(data) < self.threshold:
+            return COMPRESSION_RAW + data
+        return COMPRESSION_DEFLATED + (self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+    def decompress(self, data):
+        if data[:1] == COMPRESSION_RAW:
+            return data[1:]
+        return self.inflate.decompress(data[1:] + b'\x00\x00\xff\xff')
+
+
+VARIANTS = [
+    (COMPRESSION_ZLIB, lambda threshold: Compressor(threshold)),
+    ('per-message', PerMessage),
+    ('no-dictionary', StreamWithoutDictionary),
+]
+
+def wireBytes(size, cipher):
+    # What the ciphertext of size plaintext bytes comes to
+    if cipher in AEAD_CIPHERS:
+        return size + AEAD_TAG_SIZE
+    else:
+        return (size // 16 + 1) * 16
+
+def measure(args):
+    results = []
+    rng = random.Random(args.seed)
+    for kind, messages in transcripts(rng, args.messages):
+        texts = [message.encode() for message in messages]
+        plain = sum(wireBytes(len(text), args.cipher) for text in texts)
+        for threshold in args.thresholds:
+            for variant, create in VARIANTS:
+                (sender, receiver) = (create(threshold), create(threshold))
+                compressed = [sender.compress(message) for message in messages]
+                if [receiver.decompress(data) for data in compressed] != texts:
+                    raise RuntimeError("{0} did not round trip".format(variant))
+
+                # A whole transcript per call, the streams have to start fresh
+                def run():
+                    (sender, receiver) = (create(threshold), create(threshold))
+                    for message in messages:
+                        receiver.decompress(sender.compress(message))
+
+                (number, rounds) = timeCase(run, repeat=args.repeat, min_time=args.min_time)
+                wire = sum(wireBytes(len(data), args.cipher) for data in compressed)
+                results.append(summarize('compress', number * len(messages),
+                                         [elapsed / len(messages) for elapsed in rounds],
+                                         transcript=kind, variant=variant, threshold=threshold,
+                                         mean_bytes=round(plain / len(messages), 1),
+                                         compressed=sum(len(text) >= threshold for text in texts),
+                                         ratio=round(wire / plain, 3)))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Ratio and cost of compressing chat messages")
+    parser.add_argument('--messages', type=int, default=2000, help="messages per transcript")
+    parser.add_argument('--thresholds', type=int, nargs='+', default=[0, COMPRESSION_THRESHOLD, 128, 512])
+    parser.add_argument('--cipher', choices=CIPHER_SUITES, default=CIPHER_SUITES[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds each round runs for at least")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+    report('compression', measure(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
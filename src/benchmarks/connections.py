@@ -0,0 +1,80 @@
+# Compares how many idle connections the threaded and asyncio servers can hold
+# and what they cost in server RSS and threads.
+#
+#   python -m src.benchmarks.connections --connections 50000 --mode async
+
+import argparse
+import time
+
+from src.benchmarks.common import *
+from src.hinge.server.AsyncTURNServer import AsyncTURNServer
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.utils import *
+
+
+SERVERS = {
+    'threaded': TURNServer,
+    'async': AsyncTURNServer,
+}
+
+CONNECTIONS_PER_SOURCE_IP = 10000
+
+
+def measure(mode, port, connections, settle):
+    process = startServer(SERVERS[mode], port)
+    idle = processStats(process.pid)
+    socks = []
+    error = ''
+    start = time.time()
+    try:
+        for i in range(connections):
+            source_ip = '127.0.0.{0}'.format(2 + i // CONNECTIONS_PER_SOURCE_IP)
+            socks.append(connectClient(port, 'bench{0}'.format(i), source_ip=source_ip))
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    connect_time = time.time() - start
+    # Give the server time to accept and register everyone
+    time.sleep(settle)
+    try:
+        loaded = processStats(process.pid)
+    except IOError:
+        loaded = {'rss_kb': 0, 'threads': 0}
+        error = error or 'server died'
+    for sock in socks:
+        sock.disconnect()
+    stopServer(process)
+    connected = len(socks)
+    rss_delta = loaded['rss_kb'] - idle['rss_kb']
+    return {
+        'mode': mode,
+        'connections': connected,
+        'connect_secs': round(connect_time, 3),
+        'idle_rss_kb': idle['rss_kb'],
+        'rss_kb': loaded['rss_kb'],
+        'rss_per_conn_kb': round(rss_delta / connected, 2) if connected else 0,
+        'threads': loaded['threads'],
+        'error': error,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Idle connection capacity of the TURN server")
+    parser.add_argument('--mode', choices=['threaded', 'async', 'both'], default='both')
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 100)
+    parser.add_argument('--settle', type=float, default=2.0)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    # Both ends of every connection live on this box, leave headroom for the rest
+    limit = raiseFileLimit() - 100
+    if args.connections > limit:
+        print("connections: capping at {0} by RLIMIT_NOFILE".format(limit))
+        args.connections = limit
+    modes = ['threaded', 'async'] if args.mode == 'both' else [args.mode]
+    results = [measure(mode, args.port + i, args.connections, args.settle)
+               for i, mode in enumerate(modes)]
+    report('connections', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+# Times the crypto a client pays for: DH key generation and agreement for
+# each key exchange suite, taking the keys from a KeyPool instead as
+# sessions are opened, each step of an SMP exchange and the share of it spent
+# packing and hashing integers for each codec, many exchanges at once
+# inline and in an SmpPool, and the per-message path of Session.sendMessage
+# and its receiving side for each cipher suite, per payload size. Each case
+# is run in --repeat rounds, every round long enough to measure, and the
+# spread across rounds is reported so runs before and after a change can be
+# compared.
+#
+#   python -m src.benchmarks.crypto --repeat 5 --output crypto.json
+
+import argparse
+import base64
+import os
+import statistics
+import threading
+import time
+
+from src.benchmarks.common import *
+from src.hinge.crypto import dh
+from src.hinge.crypto import modexp
+from src.hinge.crypto.CryptoUtils import CryptoUtils
+from src.hinge.crypto.KeyPool import KeyPool
+from src.hinge.crypto.SmpPool import SmpPool
+from src.hinge.crypto.smp import SMP
+from src.hinge.network.Session import Session
+from src.hinge.utils import *
+
+
+class SinkClient(object):
+
+    # Stands in for Client, keeps what the session would have sent
+    def __init__(self):
+        self.id = 'bench'
+        self.sent = None
+        self.key_pool = None
+
+    def sendMessage(self, message):
+        self.sent = message
+
+
+def benchDiffieHellman(args):
+    results = []
+    for suite, create in ((KEX_MODP4096, dh.DiffieHellman), (KEX_X25519, dh.X25519)):
+        peer = create()
+        peer.generateKeys()
+        local = create()
+        local.generateKeys()
+        results.append(summarize('dh.generateKeys', *timeCase(lambda: create().generateKeys(),
+                                                               repeat=args.repeat, min_time=args.min_time),
+                                 suite=suite))
+        results.append(summarize('dh.computeKey', *timeCase(lambda: local.computeKey(peer.pub_key),
+                                                             repeat=args.repeat, min_time=args.min_time),
+                                 suite=suite))
+
+        # What one side of a session handshake costs, as PrivateSession does it
+        def handshake():
+            crypto = CryptoUtils()
+            crypto.generateDHKey(suite=suite)
+            crypto.computeDHSecret(peer.pub_key)
+        pub_key = base64.b64encode(peer.exportPublicKey())
+        results.append(summarize('session.handshake', *timeCase(handshake, repeat=args.repeat,
+                                                                 min_time=args.min_time),
+                                 suite=suite, pub_key_bytes=len(pub_key)))
+    return results
+
+def benchKeyPool(args):
+    # Sessions opened every --session-interval seconds, as Session does it,
+    # with the keys generated inline and taken from a warmed up pool
+    results = []
+    for size in (0, args.pool_size):
+        pool = KeyPool(size=size)
+        pool.start()
+        deadline = time.time() + 60
+        while (pool.stats()['ready'] < size) and (time.time() < deadline):
+            time.sleep(0.05)
+        latencies = []
+        for i in range(args.sessions):
+            start = time.perf_counter()
+            CryptoUtils().generateDHKey(pool)
+            latencies.append(time.perf_counter() - start)
+            time.sleep(args.session_interval)
+        stats = pool.stats()
+        pool.close()
+        results.append({
+            'case': 'keypool.get',
+            'pool_size': size,
+            'sessions': args.sessions,
+            'interval': args.session_interval,
+            'median_us': round(statistics.median(latencies) * 1e6, 2),
+            'max_us': round(max(latencies) * 1e6, 2),
+            'hit_rate': round(stats['hit_rate'], 3),
+            'refill_lag_mean': round(stats['refill_lag_mean'], 3),
+            'refill_lag_max': round(stats['refill_lag_max'], 3),
+        })
+    return results
+
+def timed(smp, totals):
+    # Wraps the SMP's codec methods, adding the time spent in each to totals
+    for name in ('pack', 'unpack', 'hashValues'):
+        def wrapper(*args, method=getattr(smp, name), name=name):
+            start = time.perf_counter()
+            result = method(*args)
+            totals[name] += time.perf_counter() - start
+            return result
+        setattr(smp, name, wrapper)
+    return smp
+
+def benchSmp(args):
+    results = []
+    for codec in SMP_CODECS:
+        # Steps are timed inside full exchanges, later steps need the earlier ones anyway
+        steps = [[] for i in range(5)]
+        exchanges = []
+        totals = {'pack': 0.0, 'unpack': 0.0, 'hashValues': 0.0}
+        for i in range(args.repeat):
+            (alice, bob) = (timed(SMP('at dawn', codec), totals), timed(SMP('at dawn', codec), totals))
+            buffer = None
+            total = 0.0
+            for index, step in enumerate((alice.step1, bob.step2, alice.step3, bob.step4, alice.step5)):
+                start = time.perf_counter()
+                buffer = step(*([buffer] if index else []))
+                elapsed = time.perf_counter() - start
+                steps[index].append(elapsed)
+                total += elapsed
+            if not (alice.match and bob.match):
+                raise RuntimeError("SMP exchange did not match")
+            exchanges.append(total)
+        results.extend(summarize('smp.step{0}'.format(index + 1), 1, samples, codec=codec)
+                       for index, samples in enumerate(steps))
+        results.append(summarize('smp.exchange', 1, exchanges, codec=codec))
+        # Encoding, decoding and hashing the integers, per exchange
+        serialization = sum(totals.values())
+        results.append({
+            'case': 'smp.serialization',
+            'codec': codec,
+            'pack_us': round(totals['pack'] / args.repeat * 1e6, 2),
+            'unpack_us': round(totals['unpack'] / args.repeat * 1e6, 2),
+            'hash_us': round(totals['hashValues'] / args.repeat * 1e6, 2),
+            'share': round(serialization / sum(exchanges), 5),
+        })
+    # Paid once per process, on the first SMP
+    mod = SMP('at dawn').mod
+    start = time.perf_counter()
+    modexp.FixedBase(2, mod, mod.bit_length())
+    results.append(summarize('modexp.FixedBase', 1, [time.perf_counter() - start], window=FIXED_BASE_WINDOW))
+    return results
+
+def runExchange(pool, finished):
+    # Both sides of an SMP exchange through the pool, each step started when
+    # the one before it completes, as PrivateSession does it
+    sides = [SMP('at dawn'), SMP('at dawn')]
+    steps = ['step1', 'step2', 'step3', 'step4', 'step5']
+
+    def advance(index, args):
+        side = index % 2
+        def done(future):
+            (sides[side], buffer) = future.result()
+            if index == len(steps) - 1:
+                finished(sides[0].match and sides[1].match)
+            else:
+                advance(index + 1, (buffer,))
+        pool.submit(sides[side], steps[index], args).add_done_callback(done)
+    advance(0, ())
+
+def benchSmpPool(args):
+    # --smp-sessions exchanges at once, inline and in the pool. A thread
+    # ticking every millisecond stands in for the rest of the client, its
+    # lateness is how long the exchanges kept it from running.
+    results = []
+    for workers in sorted(set([0, 1, os.cpu_count() or 1])):
+        pool = SmpPool(workers)
+        if workers:
+            # Start the workers and build their tables
+            warm = [pool.submit(SMP('at dawn'), 'step1') for i in range(workers)]
+            for future in warm:
+                future.result()
+        else:
+            SMP('at dawn').powGen(1)
+        (lock, done, matched) = (threading.Lock(), threading.Event(), [])
+        def finished(match):
+            with lock:
+                matched.append(match)
+                if len(matched) == args.smp_sessions:
+                    done.set()
+                else:
+                    pass
+
+        lateness = []
+        def tick():
+            while not done.is_set():
+                start = time.perf_counter()
+                time.sleep(0.001)
+                lateness.append(time.perf_counter() - start - 0.001)
+        ticker = threading.Thread(target=tick, daemon=True)
+        ticker.start()
+        start = time.perf_counter()
+        for i in range(args.smp_sessions):
+            runExchange(pool, finished)
+        done.wait()
+        elapsed = time.perf_counter() - start
+        ticker.join()
+        pool.close()
+        if not all(matched):
+            raise RuntimeError("SMP exchange did not match")
+        results.append({
+            'case': 'smp.pool',
+            'workers': workers,
+            'sessions': args.smp_sessions,
+            'secs': round(elapsed, 3),
+            'exchanges_per_sec': round(args.smp_sessions / elapsed, 2),
+            'stall_p99_ms': round(percentile(lateness, 0.99) * 1000, 2),
+            'stall_max_ms': round(max(lateness) * 1000, 2),
+        })
+    return results
+
+def benchMessages(args):
+    # Two sessions sharing a key, as after a handshake
+    (sender, receiver) = (Session(SinkClient(), 'receiver'), Session(SinkClient(), 'bench'))
+    for session in (sender, receiver):
+        session.crypto.generateDHKey(suite=KEX_X25519)
+    receiver.crypto.computeDHSecret(sender.crypto.dh.pub_key)
+    sender.crypto.computeDHSecret(receiver.crypto.dh.pub_key)
+    sender.encrypted = receiver.encrypted = True
+    sender.initiator = True
+    crypto = sender.crypto
+
+    results = []
+    for payload in args.payloads:
+        data = os.urandom(payload)
+        encrypted = crypto.aesEncrypt(data)
+        cases = [
+            ('crypto.aesEncrypt', lambda: crypto.aesEncrypt(data), None),
+            ('crypto.aesDecrypt', lambda: crypto.aesDecrypt(encrypted), None),
+            ('crypto.generateHmac', lambda: crypto.generateHmac(encrypted), None),
+        ]
+        for case, run, setup in cases:
+            results.append(summarize(case, *timeCase(run, setup, repeat=args.repeat, min_time=args.min_time),
+                                     payload=payload))
+
+        # Messages have to arrive in order, so each one is encrypted untimed
+        # first, from where the sendMessage case left the counter
+        def sent():
+            receiver.incoming_message_num = sender.outgoing_message_num
+            sender.sendMessage(COMMAND_MSG, data)
+            return (sender.client.sent,)
+
+        for cipher in CIPHER_SUITES:
+            sender.crypto.cipherSuite = receiver.crypto.cipherSuite = cipher
+            wire_bytes = len(sent()[0].json())
+            cases = [
+                ('session.sendMessage', lambda: sender.sendMessage(COMMAND_MSG, data), None),
+                ('session.decrypt', receiver._Session__getDecryptedData, sent),
+            ]
+            for case, run, setup in cases:
+                results.append(summarize(case, *timeCase(run, setup, repeat=args.repeat, min_time=args.min_time),
+                                         payload=payload, cipher=cipher, wire_bytes=wire_bytes))
+    return results
+
+BENCHMARKS = [
+    ('dh', benchDiffieHellman),
+    ('keypool', benchKeyPool),
+    ('smp', benchSmp),
+    ('smppool', benchSmpPool),
+    ('messages', benchMessages),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description="Costs of the client's crypto primitives and paths")
+    parser.add_argument('--only', choices=[name for name, bench in BENCHMARKS], action='append')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds each round runs for at least")
+    parser.add_argument('--pool-size', type=int, default=DH_POOL_SIZE)
+    parser.add_argument('--sessions', type=int, default=8, help="sessions opened in the keypool case")
+    parser.add_argument('--session-interval', type=float, default=0.5)
+    parser.add_argument('--smp-sessions', type=int, default=8, help="exchanges run at once in the smppool case")
+    parser.add_argument('--payloads', type=int, nargs='+', default=[16, 256, 4096, 65536])
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    results = []
+    for name, bench in BENCHMARKS:
+        if (args.only is None) or (name in args.only):
+            results.extend(bench(args))
+        else:
+            pass
+    report('crypto', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# Runs N session pairs of real Clients through a TURNServer over loopback:
+# every pair does the DH handshake, then the initiator sends MSG and TYPING
+# at fixed rates for the duration. Reports delivered messages per second,
+# end-to-end latency (send call to recv callback, crypto included), the
+# handshake rate and the server's memory.
+#
+#   python -m src.benchmarks.end_to_end --pairs 4 --msg-rate 50 --duration 10 --output run.json
+
+import argparse
+import os
+import threading
+import time
+
+from src.benchmarks.common import *
+from src.hinge.network.Client import Client
+from src.hinge.server.AsyncTURNServer import AsyncTURNServer
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.utils import *
+
+
+SERVERS = {
+    'threaded': TURNServer,
+    'async': AsyncTURNServer,
+}
+
+
+class Pair(object):
+
+    def __init__(self, index, port, payload):
+        self.payload = payload
+        self.handshakes = 0
+        self.handshake_done = threading.Event()
+        self.latencies = []
+        self.received = {COMMAND_MSG: 0, COMMAND_TYPING: 0}
+        self.errors = []
+        self.initiator = Client('init{0}'.format(index), ('127.0.0.1', port), self.callbacks())
+        self.responder = Client('resp{0}'.format(index), ('127.0.0.1', port), self.callbacks(self.accept))
+
+    def callbacks(self, new=None):
+        return {
+            'recv': self.recv,
+            'new': new,
+            'handshake': self.handshake,
+            'smp': lambda *args: None,
+            'err': lambda remote_id, error: self.errors.append(error),
+        }
+
+    def accept(self, remote_id):
+        self.responder.newClientAccepted(remote_id)
+
+    def handshake(self, remote_id):
+        # Called once on each side
+        self.handshakes += 1
+        if self.handshakes == 2:
+            self.handshake_done.set()
+        else:
+            pass
+
+    def recv(self, command, remote_id, data):
+        self.received[command] += 1
+        if command == COMMAND_MSG:
+            self.latencies.append(time.perf_counter() - float(data.split('|', 1)[0]))
+        else:
+            pass
+
+    def connect(self):
+        for client in (self.initiator, self.responder):
+            client.connectToServer()
+
+    def waitForRegistration(self, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.initiator.getClientId(self.responder.nick):
+                return
+            time.sleep(0.05)
+        raise RuntimeError("{0} was never registered".format(self.responder.nick))
+
+    def openSession(self):
+        self.initiator.openSession(self.responder.nick)
+
+    def session(self):
+        return self.initiator.getSession(self.initiator.getClientId(self.responder.nick))
+
+    def message(self):
+        stamp = repr(time.perf_counter())
+        return stamp + '|' + 'x' * max(0, self.payload - len(stamp) - 1)
+
+    def disconnect(self):
+        for client in (self.initiator, self.responder):
+            client.disconnectFromServer()
+
+
+def sendOnSchedule(rates, duration):
+    # rates maps command -> (per second, send). Every command goes out from
+    # this one thread on a merged fixed schedule, where a late send doesn't
+    # push the ones after it back.
+    schedule = []
+    for command, (rate, send) in rates.items():
+        if rate > 0:
+            schedule.extend((i / rate, command, send) for i in range(int(duration * rate)))
+        else:
+            pass
+    schedule.sort(key=lambda entry: entry[0])
+    sent = dict((command, 0) for command in rates)
+    start = time.perf_counter()
+    for offset, command, send in schedule:
+        delay = start + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            pass
+        send()
+        sent[command] += 1
+    return sent
+
+def measure(mode, args, port):
+    process = startServer(SERVERS[mode], port)
+    pairs = [Pair(i, port, args.payload) for i in range(args.pairs)]
+    for pair in pairs:
+        pair.connect()
+    for pair in pairs:
+        pair.waitForRegistration()
+    rss_idle = processStats(process.pid)['rss_kb']
+
+    # Every pair handshakes at once
+    start = time.time()
+    for pair in pairs:
+        pair.openSession()
+    for pair in pairs:
+        if not pair.handshake_done.wait(args.handshake_timeout):
+            raise RuntimeError("handshake timed out, errors: {0}".format(pair.errors))
+    handshake_secs = time.time() - start
+
+    counts = []
+    senders = []
+    for pair in pairs:
+        session = pair.session()
+        rates = {
+            COMMAND_MSG: (args.msg_rate, lambda session=session, pair=pair: session.sendChatMessage(pair.message())),
+            COMMAND_TYPING: (args.typing_rate, lambda session=session: session.sendTypingMessage(TYPING_START)),
+        }
+        sender = threading.Thread(target=lambda rates=rates: counts.append(sendOnSchedule(rates, args.duration)),
+                                  daemon=True)
+        sender.start()
+        senders.append(sender)
+    start = time.time()
+    for sender in senders:
+        sender.join()
+    sent = dict((command, sum(count[command] for count in counts)) for command in (COMMAND_MSG, COMMAND_TYPING))
+    # Let what is in flight arrive
+    deadline = time.time() + args.drain_timeout
+    while (sum(pair.received[COMMAND_MSG] for pair in pairs) < sent[COMMAND_MSG]) and (time.time() < deadline):
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    rss_loaded = processStats(process.pid)['rss_kb']
+
+    for pair in pairs:
+        pair.disconnect()
+    stopServer(process)
+    latencies = [latency for pair in pairs for latency in pair.latencies]
+    received = sum(pair.received[COMMAND_MSG] for pair in pairs)
+    return {
+        'mode': mode,
+        'pairs': args.pairs,
+        'payload': args.payload,
+        'msg_rate': args.msg_rate,
+        'typing_rate': args.typing_rate,
+        'handshakes_per_sec': round(args.pairs / handshake_secs, 2),
+        'handshake_secs': round(handshake_secs, 3),
+        'msgs_sent': sent[COMMAND_MSG],
+        'msgs_received': received,
+        'typing_sent': sent[COMMAND_TYPING],
+        'typing_received': sum(pair.received[COMMAND_TYPING] for pair in pairs),
+        'msgs_per_sec': round(received / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'p999_ms': round(percentile(latencies, 0.999) * 1000, 3),
+        'server_rss_idle_kb': rss_idle,
+        'server_rss_loaded_kb': rss_loaded,
+        'client_rss_kb': processStats(os.getpid())['rss_kb'],
+        'errors': sum(len(pair.errors) for pair in pairs),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput and latency between real clients")
+    parser.add_argument('--mode', choices=['threaded', 'async', 'both'], default='threaded')
+    parser.add_argument('--pairs', type=int, default=4)
+    parser.add_argument('--msg-rate', type=float, default=50, help="MSG per second per pair")
+    parser.add_argument('--typing-rate', type=float, default=10, help="TYPING per second per pair")
+    parser.add_argument('--payload', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--handshake-timeout', type=float, default=120)
+    parser.add_argument('--drain-timeout', type=float, default=10)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 800)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    modes = sorted(SERVERS) if args.mode == 'both' else [args.mode]
+    results = []
+    for i, mode in enumerate(modes):
+        results.append(measure(mode, args, args.port + i))
+    report('end_to_end', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Microbenchmark of Socket's framed receive path over a local socket pair,
+# against the previous implementation that grew each frame with +=.
+#
+#   python -m src.benchmarks.framing
+
+import argparse
+import socket
+import threading
+import time
+
+from src.benchmarks.common import *
+from src.hinge.network.sock import Socket
+from src.hinge.utils import *
+
+
+class LegacySocket(Socket):
+
+    def recvFrame(self):
+        size = self.unpackFrameSize(self._legacyRecv(4))
+        return self._legacyRecv(size)
+
+    def _legacyRecv(self, length):
+        data = b''
+        recv_size = 0
+        while recv_size < length:
+            new_data = self.sock.recv(length - recv_size)
+            if not new_data:
+                raise NetworkError(CLOSE_CONNECTION)
+            data += new_data
+            recv_size += len(new_data)
+        return data
+
+
+WORKLOADS = {
+    'small': (64, 200000),
+    'large': (1024 * 1024, 200),
+}
+
+READERS = {
+    'legacy': LegacySocket,
+    'buffered': Socket,
+}
+
+
+def measure(reader_name, workload):
+    (frame_size, frames) = WORKLOADS[workload]
+    (left, right) = socket.socketpair()
+    writer = Socket(('socketpair', 0), left)
+    reader = READERS[reader_name](('socketpair', 1), right)
+    # Pre-frame everything so the writer side costs as little as possible
+    frame = writer.packFrameSize(frame_size) + b'x' * frame_size
+    batch = max(1, (256 * 1024) // len(frame))
+
+    def write():
+        chunk = frame * batch
+        sent = 0
+        while sent < frames:
+            count = min(batch, frames - sent)
+            left.sendall(chunk if count == batch else frame * count)
+            sent += count
+
+    thread = threading.Thread(target=write, daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    for i in range(frames):
+        reader.recvFrame()
+    elapsed = time.perf_counter() - start
+    thread.join()
+    left.close()
+    right.close()
+    return {
+        'reader': reader_name,
+        'workload': workload,
+        'frame_size': frame_size,
+        'frames': frames,
+        'secs': round(elapsed, 3),
+        'frames_per_sec': round(frames / elapsed),
+        'mib_per_sec': round(frames * frame_size / elapsed / (1024 * 1024), 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Framed receive microbenchmark")
+    parser.add_argument('--workload', choices=sorted(WORKLOADS) + ['all'], default='all')
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    workloads = sorted(WORKLOADS) if args.workload == 'all' else [args.workload]
+    results = [measure(reader, workload) for workload in workloads for reader in sorted(READERS)]
+    report('framing', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Measures what the per-stage hooks cost the relay path: not installed,
+# installed and timing 1 in INSTRUMENTATION_SAMPLE calls, and timing every
+# call. The last run prints the StageProfiler report the server produced.
+#
+#   python -m src.benchmarks.instrumentation --frames 100000
+
+import argparse
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from src.benchmarks.common import *
+from src.hinge.instrumentation import StageProfiler
+from src.hinge.network.Message import Message
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.utils import *
+
+
+class ProfiledTURNServer(TURNServer):
+
+    def __init__(self, listen_port, sample=None, report_path=None, **kwargs):
+        TURNServer.__init__(self, listen_port, **kwargs)
+        self.sample = sample
+        self.report_path = report_path
+
+    def start(self):
+        if self.sample is not None:
+            profiler = StageProfiler(self.sample)
+            profiler.start()
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.writeReport(profiler))
+        else:
+            pass
+        TURNServer.start(self)
+
+    def writeReport(self, profiler):
+        with open(self.report_path, 'w') as report:
+            report.write(profiler.report())
+        sys.exit(0)
+
+
+def blast(sock, frames, payload):
+    message = Message(COMMAND_MSG, ('sender', 'receiver'))
+    message.setEncryptedData(os.urandom(payload))
+    message.setBinaryHmac(os.urandom(64))
+    message.setBinaryMessageNum(os.urandom(16))
+    data = message.json()
+    for i in range(frames):
+        sock.send(data)
+
+def measure(name, sample, port, frames, payload, report_path):
+    # Decode every frame so all server stages are on the path
+    process = startServer(ProfiledTURNServer, port, fast_relay=False,
+                          sample=sample, report_path=report_path)
+    receiver = connectClient(port, 'receiver')
+    sender = connectClient(port, 'sender')
+    waitForRegistration(sender, 'sender', 'receiver')
+    start = time.time()
+    thread = threading.Thread(target=blast, args=(sender, frames, payload), daemon=True)
+    thread.start()
+    for i in range(frames):
+        receiver.recvFrame()
+    elapsed = time.time() - start
+    thread.join()
+    sender.disconnect()
+    receiver.disconnect()
+    stopServer(process)
+    return {
+        'hooks': name,
+        'frames': frames,
+        'secs': round(elapsed, 3),
+        'frames_per_sec': round(frames / elapsed),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost of the per-stage instrumentation hooks")
+    parser.add_argument('--frames', type=int, default=100000)
+    parser.add_argument('--payload', type=int, default=256)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 700)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    report_path = os.path.join(tempfile.mkdtemp(prefix='hinge-bench-'), 'profile.txt')
+    runs = [
+        ('off', None),
+        ('sampled', INSTRUMENTATION_SAMPLE),
+        ('every_call', 1),
+    ]
+    results = []
+    for i, (name, sample) in enumerate(runs):
+        results.append(measure(name, sample, args.port + i, args.frames, args.payload, report_path))
+    report('instrumentation', results, args.output)
+    with open(report_path) as profile:
+        print(profile.read())
+
+
+if __name__ == '__main__':
+    main()
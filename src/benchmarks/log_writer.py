@@ -0,0 +1,111 @@
+# Measures what TURNServer.notify costs the relay threads calling it during
+# a reconnect storm: the previous synchronous write + flush per record against
+# the background LogWriter. --flush-delay-ms stands in for a slow disk.
+#
+#   python -m src.benchmarks.log_writer --threads 8 --records 20000
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from src.benchmarks.common import *
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.utils import *
+
+
+class SlowFile(object):
+
+    def __init__(self, file, flush_delay):
+        self.file = file
+        self.flush_delay = flush_delay
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+        time.sleep(self.flush_delay)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class LegacyTURNServer(TURNServer):
+
+    def openLog(self):
+        self.log_file = open(self.log_path, 'a')
+
+    def log(self, message):
+        self.log_file.write('{0}\n'.format(message))
+        self.log_file.flush()
+
+
+SERVERS = {
+    'legacy': LegacyTURNServer,
+    'writer': TURNServer,
+}
+
+
+def storm(server, records, latencies):
+    for i in range(records):
+        start = time.perf_counter()
+        server.notify("127.0.0.1:{0} -> nick{0}, {0}".format(i))
+        latencies.append(time.perf_counter() - start)
+
+def measure(name, threads, records, flush_delay):
+    os.chdir(tempfile.mkdtemp(prefix='hinge-bench-'))
+    server = SERVERS[name](DEFAULT_PORT, show_console=False)
+    server.openLog()
+    if flush_delay:
+        if name == 'legacy':
+            server.log_file = SlowFile(server.log_file, flush_delay)
+        else:
+            server.log_file.file = SlowFile(server.log_file.file, flush_delay)
+    latencies = [[] for i in range(threads)]
+    workers = [threading.Thread(target=storm, args=(server, records, latencies[i]))
+               for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    server.log_file.close()
+    with open(server.log_path) as log:
+        written = sum(1 for line in log if not line.startswith('Log overloaded'))
+    latencies = [latency for thread in latencies for latency in thread]
+    return {
+        'logger': name,
+        'flush_delay_ms': flush_delay * 1000,
+        'records': len(latencies),
+        'written': written,
+        'notify_per_sec': round(len(latencies) / elapsed),
+        'p50_us': round(percentile(latencies, 0.5) * 1e6, 1),
+        'p99_us': round(percentile(latencies, 0.99) * 1e6, 1),
+        'max_ms': round(max(latencies) * 1000, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost of notify() on the relay threads")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--flush-delay-ms', type=float, default=1.0)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    results = []
+    for flush_delay in (0, args.flush_delay_ms / 1000):
+        # A slow disk takes the legacy path a while, keep that run short
+        records = args.records if not flush_delay else args.records // 20
+        for name in sorted(SERVERS):
+            results.append(measure(name, args.threads, records, flush_delay))
+    report('log_writer', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Measures nick -> ID lookups through Client against a running server: wall
+# time and the CPU the client process burns waiting for answers, for the old
+# spin-wait against futures one at a time, futures with every lookup in
+# flight at once and a single batched REQIDS. The nick cache is bypassed.
+#
+#   python -m src.benchmarks.lookups --lookups 2000
+
+import argparse
+import time
+
+from src.benchmarks.common import *
+from src.hinge.network.Client import Client
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.utils import *
+
+
+class SpinningClient(Client):
+
+    # The old single-slot busy-wait
+    def requestClientId(self, nick):
+        self.sync_resp = None
+        return Client.requestClientId(self, nick)
+
+    def _resolveRequest(self, message):
+        Client._resolveRequest(self, message)
+        self.sync_resp = message.data
+
+    def _waitForResp(self, future, timeout=None):
+        while self.sync_resp is None:
+            pass
+        return str(self.sync_resp)
+
+
+def sequential(client, lookups):
+    for i in range(lookups):
+        client._waitForResp(client.requestClientId('target'))
+
+def pipelined(client, lookups):
+    pending = [client.requestClientId('target') for i in range(lookups)]
+    for future in pending:
+        client._waitForResp(future)
+
+def batched(client, lookups):
+    client._waitForResp(client.requestClientIds(['target'] + ['target{0}'.format(i) for i in range(lookups - 1)]))
+
+MODES = {
+    'spin': (SpinningClient, sequential),
+    'future': (Client, sequential),
+    'future_pipelined': (Client, pipelined),
+    'batch': (Client, batched),
+}
+
+
+def measure(mode, nick, port, lookups):
+    (client_class, run) = MODES[mode]
+    callbacks = {'err': lambda *args: None, 'new': lambda *args: None}
+    client = client_class(nick, ('127.0.0.1', port), callbacks)
+    client.connectToServer()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    run(client, lookups)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    client.disconnectFromServer()
+    return {
+        'mode': mode,
+        'lookups': lookups,
+        'lookups_per_sec': round(lookups / wall),
+        'cpu_us_per_lookup': round(cpu / lookups * 1e6, 1),
+        'cpu_ratio': round(cpu / wall, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Client nick lookup cost")
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 500)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    process = startServer(TURNServer, args.port)
+    try:
+        target = connectClient(args.port, 'target')
+        waitForRegistration(target, 'target', 'target')
+        results = [measure(mode, 'looker{0}'.format(i), args.port, args.lookups)
+                   for i, mode in enumerate(sorted(MODES))]
+        target.disconnect()
+    finally:
+        stopServer(process)
+    report('lookups', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+# Memory and CPU of a million messages with Message against the class it
+# replaced, which str()ed every field and carried a __dict__: creating and
+# encoding one as a session does, decoding one and encoding it again as the
+# server does when it answers or relays, and the memory a message held on
+# to costs, fresh and decoded from a frame.
+#
+#   python -m src.benchmarks.messages --count 1000000 --output messages.json
+
+import argparse
+import base64
+import gc
+import json
+import os
+import struct
+import time
+import tracemalloc
+
+from src.benchmarks.common import *
+from src.hinge.network.Message import *
+from src.hinge.utils import *
+
+
+LEGACY_BINARY_FORMAT = '>cBBB{0}sB{1}sI{2}sB{3}sB{4}sB{5}s'
+
+
+# Message before it was slotted
+class LegacyMessage(object):
+
+    def __init__(self,
+                 command, route=(SERVER_ROUTE, SERVER_ROUTE), data='',
+                 hmac='', error='', num=''):
+
+        self.command = str(command)
+        self.route = tuple(route)
+        self.data = str(data)
+        self.hmac = str(hmac)
+        self.error = str(error)
+        self.num = str(num)
+        # Ciphertext set by the setBinary methods or read from a binary frame, base64 only for JSON
+        self.raw_data = None
+        self.raw_hmac = None
+        self.raw_num = None
+
+    def __str__(self):
+        return self.json()
+
+    def json(self):
+        if isinstance(self.data, bytes):
+            self.data = self.data.decode()
+        else:
+            self.data = str(self.data)
+        return json.dumps({
+            'command': self.command,
+            'route': self.route,
+            'data': self.data if self.raw_data is None else base64.b64encode(self.raw_data).decode(),
+            'hmac': self.hmac if self.raw_hmac is None else base64.b64encode(self.raw_hmac).decode(),
+            'error': self.error,
+            'num': self.num if self.raw_num is None else base64.b64encode(self.raw_num).decode(),
+        })
+
+    def binary(self):
+        flags = 0
+        if self.raw_data is not None:
+            data = self.raw_data
+            flags |= RAW_DATA
+        elif isinstance(self.data, bytes):
+            data = self.data
+        else:
+            data = str(self.data).encode()
+        if self.raw_hmac is not None:
+            hmac = self.raw_hmac
+            flags |= RAW_HMAC
+        else:
+            hmac = self.hmac.encode()
+        if self.raw_num is not None:
+            num = self.raw_num
+            flags |= RAW_NUM
+        else:
+            num = self.num.encode()
+        fields = (self.route[0].encode(), self.route[1].encode(), data, hmac, self.error.encode(), num)
+        try:
+            return struct.pack(LEGACY_BINARY_FORMAT.format(*map(len, fields)),
+                               BINARY_MAGIC, COMMAND_CODES[self.command], flags,
+                               len(fields[0]), fields[0], len(fields[1]), fields[1], len(fields[2]), fields[2],
+                               len(fields[3]), fields[3], len(fields[4]), fields[4], len(fields[5]), fields[5])
+        except (KeyError, struct.error):
+            raise ProtocolError(err=ERR_MALFORMED_MESSAGE)
+
+    def encode(self, frame_format):
+        if frame_format == FRAME_BINARY:
+            return self.binary()
+        else:
+            return self.json().encode('utf-8')
+
+    def getEncryptedDataAsBinaryString(self):
+        if self.raw_data is not None:
+            return self.raw_data
+        return base64.b64decode(self.data)
+
+    def setEncryptedData(self, data):
+        self.raw_data = data
+
+    def getHmacAsBinaryString(self):
+        if self.raw_hmac is not None:
+            return self.raw_hmac
+        return base64.b64decode(self.hmac)
+
+    def setBinaryHmac(self, hmac):
+        self.raw_hmac = hmac
+
+    def getMessageNumAsBinaryString(self):
+        if self.raw_num is not None:
+            return self.raw_num
+        return base64.b64decode(self.num)
+
+    def setBinaryMessageNum(self, num):
+        self.raw_num = num
+
+    @staticmethod
+    def createFromJson(jsonStr):
+        jsonStr = json.loads(jsonStr)
+        return LegacyMessage(
+            jsonStr['command'],
+            jsonStr['route'],
+            jsonStr['data'],
+            jsonStr['hmac'],
+            jsonStr['error'],
+            jsonStr['num'],
+        )
+
+    @staticmethod
+    def createFromBinary(frame):
+        # Malformed frames raise ValueError, like malformed JSON does
+        try:
+            (magic, code, flags) = BINARY_HEADER.unpack_from(frame)
+            command = FRAME_COMMANDS[code - 1] if code else None
+            offset = BINARY_HEADER.size
+            fields = []
+            for length in BINARY_LENGTHS:
+                (size,) = length.unpack_from(frame, offset)
+                offset += length.size
+                fields.append(frame[offset:offset + size])
+                offset += size
+        except (struct.error, IndexError):
+            raise ValueError("malformed binary frame")
+        if (magic != BINARY_MAGIC) or (command is None) or (offset != len(frame)):
+            raise ValueError("malformed binary frame")
+        (sender, receiver, data, hmac, error, num) = fields
+        message = LegacyMessage(command, (sender.decode(), receiver.decode()), error=error.decode())
+        if flags & RAW_DATA:
+            message.raw_data = data
+        else:
+            message.data = data.decode()
+        if flags & RAW_HMAC:
+            message.raw_hmac = hmac
+        else:
+            message.hmac = hmac.decode()
+        if flags & RAW_NUM:
+            message.raw_num = num
+        else:
+            message.num = num.decode()
+        return message
+
+    @staticmethod
+    def decode(frame):
+        if frame[:1] == BINARY_MAGIC:
+            return LegacyMessage.createFromBinary(frame)
+        else:
+            return LegacyMessage.createFromJson(frame)
+
+
+CLASSES = {
+    'legacy': LegacyMessage,
+    'slotted': Message,
+}
+
+ROUTE = ('1234567890123456789', '9876543210987654321')
+
+
+def create(cls, ciphertext):
+    # As Session.sendMessage builds an AEAD message
+    message = cls(COMMAND_MSG, ROUTE)
+    message.setEncryptedData(ciphertext)
+    message.num = '1234'
+    return message
+
+def createCycles(cls, count, frame_format, ciphertext):
+    start = time.perf_counter()
+    for i in range(count):
+        create(cls, ciphertext).encode(frame_format)
+    return time.perf_counter() - start
+
+def relayCycles(cls, count, frame):
+    # Read the route, send it on in the same format
+    frame_format = Message.frameFormat(frame)
+    start = time.perf_counter()
+    for i in range(count):
+        message = cls.decode(frame)
+        message.route
+        message.encode(frame_format)
+    return time.perf_counter() - start
+
+def heldBytes(build, count):
+    gc.collect()
+    tracemalloc.start()
+    held = [build() for i in range(count)]
+    (size, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return size / count
+
+def measure(args):
+    ciphertext = os.urandom(args.payload + AEAD_TAG_SIZE)
+    results = []
+    for name in sorted(CLASSES):
+        cls = CLASSES[name]
+        for frame_format in FRAME_FORMATS:
+            frame = create(cls, ciphertext).encode(frame_format)
+            for case, elapsed in (('create+encode', createCycles(cls, args.count, frame_format, ciphertext)),
+                                  ('decode+encode', relayCycles(cls, args.count, frame))):
+                results.append({
+                    'case': case,
+                    'class': name,
+                    'format': frame_format,
+                    'count': args.count,
+                    'secs': round(elapsed, 3),
+                    'us_per_op': round(elapsed / args.count * 1e6, 3),
+                })
+        frame = create(cls, ciphertext).encode(FRAME_BINARY)
+        for case, build in (('held.created', lambda: create(cls, ciphertext)),
+                            ('held.decoded', lambda: cls.decode(frame))):
+            results.append({
+                'case': case,
+                'class': name,
+                'count': args.count,
+                'bytes_per_message': round(heldBytes(build, args.count), 1),
+            })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Message memory and create/encode/decode cost")
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--payload', type=int, default=64)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+    report('messages', measure(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
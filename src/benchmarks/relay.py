@@ -0,0 +1,78 @@
+# Measures how many session frames per second the server relays between two
+# registered clients, with and without the zero-parse relay path.
+#
+#   python -m src.benchmarks.relay --frames 50000 --payload 256
+
+import argparse
+import os
+import threading
+import time
+
+from src.benchmarks.common import *
+from src.hinge.network.Message import Message
+from src.hinge.server.AsyncTURNServer import AsyncTURNServer
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.utils import *
+
+
+SERVERS = {
+    'threaded': TURNServer,
+    'async': AsyncTURNServer,
+}
+
+
+def blast(sock, frames, payload):
+    message = Message(COMMAND_MSG, ('sender', 'receiver'))
+    message.setEncryptedData(os.urandom(payload))
+    message.setBinaryHmac(os.urandom(64))
+    message.setBinaryMessageNum(os.urandom(16))
+    data = message.json()
+    for i in range(frames):
+        sock.send(data)
+
+def measure(mode, fast_relay, port, frames, payload):
+    process = startServer(SERVERS[mode], port, fast_relay=fast_relay)
+    receiver = connectClient(port, 'receiver')
+    sender = connectClient(port, 'sender')
+    # Make sure both registrations have landed before timing anything
+    time.sleep(0.5)
+    start = time.time()
+    thread = threading.Thread(target=blast, args=(sender, frames, payload), daemon=True)
+    thread.start()
+    for i in range(frames):
+        receiver.recvFrame()
+    elapsed = time.time() - start
+    thread.join()
+    sender.disconnect()
+    receiver.disconnect()
+    stopServer(process)
+    return {
+        'mode': mode,
+        'fast_relay': fast_relay,
+        'frames': frames,
+        'payload': payload,
+        'secs': round(elapsed, 3),
+        'frames_per_sec': round(frames / elapsed),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Server relay throughput")
+    parser.add_argument('--mode', choices=['threaded', 'async', 'both'], default='both')
+    parser.add_argument('--frames', type=int, default=50000)
+    parser.add_argument('--payload', type=int, default=256)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 200)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    modes = ['threaded', 'async'] if args.mode == 'both' else [args.mode]
+    results = []
+    port = args.port
+    for mode in modes:
+        for fast_relay in (False, True):
+            results.append(measure(mode, fast_relay, port, args.frames, args.payload))
+            port += 1
+    report('relay', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
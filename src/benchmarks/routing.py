@@ -0,0 +1,89 @@
+# What the server pays to route one relayed frame: peeking the command and
+# route out of it and finding the receiving connection, with --clients
+# connected. Compares the IDs clients picked for themselves (the decimal
+# hash of an object, sent as strings and found in the ID dict) with the
+# route IDs the server hands out (sent as two integers and found in the
+# RouteTable). Also reports the frame sizes and what the manager holds.
+#
+#   python -m src.benchmarks.routing --clients 10000 --output routing.json
+
+import argparse
+import random
+import tracemalloc
+
+from src.benchmarks.common import *
+from src.hinge.network.Message import Message
+from src.hinge.server.ClientManager import ClientManager
+from src.hinge.server.HingeClient import Connection
+from src.hinge.utils import *
+
+
+def populate(count, picked, rng):
+    manager = ClientManager()
+    clients = []
+    for i in range(count):
+        client = Connection(manager, '127.0.0.{0}'.format(i % 250 + 1))
+        manager.add(client)
+        if picked:
+            # As clients from before route IDs rename themselves, to the hash
+            # of their Client object, an address of about 44 bits
+            manager.updateClientId(client.id, str(rng.getrandbits(44)))
+        else:
+            pass
+        clients.append(client)
+    return (manager, clients)
+
+def heldBytes(count, picked, rng):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = populate(count, picked, rng)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del held
+    return size
+
+def measure(args):
+    results = []
+    rng = random.Random(args.seed)
+    for routes, picked in (('picked', True), ('assigned', False)):
+        (manager, clients) = populate(args.clients, picked, rng)
+        frames = []
+        for i in range(args.frames):
+            (sender, receiver) = rng.sample(clients, 2)
+            message = Message(COMMAND_MSG, (sender.id, receiver.id), num='1')
+            message.setEncryptedData(rng.randbytes(args.payload))
+            frames.append(message.binary())
+
+        def route():
+            for frame in frames:
+                (command, route) = Message.peekHeader(frame)
+                manager.getClientById(route[1])
+
+        (number, rounds) = timeCase(route, repeat=args.repeat, min_time=args.min_time)
+        # Per frame
+        samples = [elapsed / len(frames) for elapsed in rounds]
+        results.append(summarize('route', number * len(frames), samples, routes=routes, clients=args.clients,
+                                 wire_bytes=len(frames[0]), header_bytes=len(frames[0]) - args.payload))
+        results.append({
+            'case': 'held',
+            'routes': routes,
+            'clients': args.clients,
+            'kb': round(heldBytes(args.clients, picked, rng) / 1024, 1),
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-frame routing cost with picked and assigned client IDs")
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--frames', type=int, default=1000, help="distinct frames routed in each round")
+    parser.add_argument('--payload', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds each round runs for at least")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+    report('routing', measure(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Measures aggregate relay throughput of the sharded server as the number of
+# worker processes grows. Each sender/receiver pair runs in its own process so
+# the load generator is not limited by a single GIL.
+#
+#   python -m src.benchmarks.sharding --workers 1 2 4 8 --pairs 16
+
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+
+from src.benchmarks.common import *
+from src.hinge.network.Message import Message
+from src.hinge.server.ShardedTURNServer import ShardedTURNServer
+from src.hinge.utils import *
+
+
+def runPair(port, index, frames, payload, barrier, results):
+    sender_nick = 'sender{0}'.format(index)
+    receiver_nick = 'receiver{0}'.format(index)
+    receiver = connectClient(port, receiver_nick)
+    sender = connectClient(port, sender_nick)
+    message = Message(COMMAND_MSG, (sender_nick, receiver_nick))
+    message.setEncryptedData(os.urandom(payload))
+    data = message.json()
+    # Wait until every pair has registered before sending anything
+    waitForRegistration(sender, sender_nick, receiver_nick)
+    barrier.wait()
+    start = time.time()
+
+    def blast():
+        for i in range(frames):
+            sender.send(data)
+
+    thread = threading.Thread(target=blast, daemon=True)
+    thread.start()
+    for i in range(frames):
+        receiver.recvFrame()
+    results.put((start, time.time()))
+    thread.join()
+    sender.disconnect()
+    receiver.disconnect()
+
+def measure(workers, port, pairs, frames, payload):
+    process = startServer(ShardedTURNServer, port, daemon=False, workers=workers)
+    barrier = multiprocessing.Barrier(pairs)
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=runPair,
+                                       args=(port, i, frames, payload, barrier, results))
+               for i in range(pairs)]
+    for client in clients:
+        client.start()
+    times = [results.get() for client in clients]
+    for client in clients:
+        client.join()
+    stopServer(process)
+    elapsed = max(end for (_, end) in times) - min(start for (start, _) in times)
+    total = pairs * frames
+    return {
+        'workers': workers,
+        'pairs': pairs,
+        'frames': total,
+        'payload': payload,
+        'secs': round(elapsed, 3),
+        'frames_per_sec': round(total / elapsed),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded server relay throughput by worker count")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    parser.add_argument('--pairs', type=int, default=8)
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--payload', type=int, default=256)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 300)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    results = []
+    for i, workers in enumerate(args.workers):
+        results.append(measure(workers, args.port + i, args.pairs, args.frames, args.payload))
+    report('sharding', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
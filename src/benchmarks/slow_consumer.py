@@ -0,0 +1,104 @@
+# Floods a client that never reads and reports how much memory the server
+# ends up holding for it under each send queue policy. 'unbounded' uses
+# limits high enough to behave like the old unbounded queue.
+#
+#   python -m src.benchmarks.slow_consumer --duration 3
+
+import argparse
+import os
+import time
+
+from src.benchmarks.common import *
+from src.hinge.network.Message import Message
+from src.hinge.server.AsyncTURNServer import AsyncTURNServer
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.utils import *
+
+
+SERVERS = {
+    'threaded': TURNServer,
+    'async': AsyncTURNServer,
+}
+
+POLICIES = {
+    'unbounded': (SEND_POLICY_BLOCK, 1 << 40, 1 << 40),
+    'block': (SEND_POLICY_BLOCK, SEND_QUEUE_MAX_MESSAGES, SEND_QUEUE_MAX_BYTES),
+    'drop': (SEND_POLICY_DROP, SEND_QUEUE_MAX_MESSAGES, SEND_QUEUE_MAX_BYTES),
+    'disconnect': (SEND_POLICY_DISCONNECT, SEND_QUEUE_MAX_MESSAGES, SEND_QUEUE_MAX_BYTES),
+}
+
+
+def flood(sock, command, payload, duration):
+    message = Message(command, ('sender', 'receiver'))
+    message.setEncryptedData(os.urandom(payload))
+    data = message.json()
+    frames = 0
+    deadline = time.time() + duration
+    # Give up on a send the server won't take, that is the backpressure working
+    sock.sock.settimeout(1)
+    try:
+        while time.time() < deadline:
+            sock.sendMany([data] * 64)
+            frames += 64
+    except NetworkError:
+        pass
+    return frames
+
+def measure(mode, policy, port, payload, duration):
+    (send_policy, send_queue_messages, send_queue_bytes) = POLICIES[policy]
+    process = startServer(SERVERS[mode], port, send_policy=send_policy,
+                          send_queue_messages=send_queue_messages,
+                          send_queue_bytes=send_queue_bytes)
+    # The receiver never reads until the flood is over
+    receiver = connectClient(port, 'receiver')
+    sender = connectClient(port, 'sender')
+    waitForRegistration(sender, 'sender', 'receiver')
+    rss_before = processStats(process.pid)['rss_kb']
+    # Typing notifications are what the drop policy may throw away
+    command = COMMAND_TYPING if policy == 'drop' else COMMAND_MSG
+    frames = flood(sender, command, payload, duration)
+    time.sleep(0.5)
+    rss_after = processStats(process.pid)['rss_kb']
+    # See whether the server told the receiver to go away, without reading
+    # everything an unbounded server buffered
+    receiver.sock.settimeout(0.5)
+    evicted = False
+    deadline = time.time() + 5
+    try:
+        while time.time() < deadline:
+            message = Message.createFromJson(receiver.recvFrame())
+            if message.command == COMMAND_ERR:
+                evicted = message.error == str(ERR_SLOW_CONSUMER)
+                break
+    except (NetworkError, ValueError):
+        pass
+    sender.disconnect()
+    receiver.disconnect()
+    stopServer(process)
+    return {
+        'mode': mode,
+        'policy': policy,
+        'frames_sent': frames,
+        'server_rss_growth_kb': rss_after - rss_before,
+        'receiver_evicted': evicted,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Server memory with a stalled recipient")
+    parser.add_argument('--payload', type=int, default=1024)
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 600)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    results = []
+    port = args.port
+    for mode in sorted(SERVERS):
+        for policy in sorted(POLICIES):
+            results.append(measure(mode, policy, port, args.payload, args.duration))
+            port += 1
+    report('slow_consumer', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
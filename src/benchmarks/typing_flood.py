@@ -0,0 +1,117 @@
+# Floods a session with TYPING frames through the server and reports relay
+# latency and TCP segments per frame, for the vectored/coalescing send path
+# against the previous one send() for the header plus one for the body.
+#
+#   python -m src.benchmarks.typing_flood --rate 20000 --duration 2
+
+import argparse
+import threading
+import time
+
+import src.hinge.server.TURNServer
+
+from src.benchmarks.common import *
+from src.hinge.network.Message import Message
+from src.hinge.network.sock import Socket
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.utils import *
+
+
+class LegacySocket(Socket):
+
+    # Nagle left on and two send() calls per frame, as before
+    def _setNoDelay(self):
+        pass
+
+    def sendMany(self, datas):
+        for data in datas:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            self._send(self.packFrameSize(len(data)), 4)
+            self._send(data, len(data))
+
+
+class LegacyTURNServer(TURNServer):
+
+    def start(self):
+        src.hinge.server.TURNServer.Socket = LegacySocket
+        TURNServer.start(self)
+
+
+SENDERS = {
+    'legacy': (LegacyTURNServer, LegacySocket),
+    'vectored': (TURNServer, Socket),
+}
+
+
+def flood(sock, rate, duration):
+    per_tick = max(1, rate // 1000)
+    frames = 0
+    deadline = time.perf_counter() + duration
+    next_tick = time.perf_counter()
+    while next_tick < deadline:
+        for i in range(per_tick):
+            message = Message(COMMAND_TYPING, ('sender', 'receiver'), repr(time.perf_counter()))
+            sock.send(message.json())
+        frames += per_tick
+        next_tick += 0.001
+        delay = next_tick - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    return frames
+
+def receive(sock, latencies):
+    while True:
+        try:
+            message = Message.createFromJson(sock.recvFrame())
+        except NetworkError:
+            return
+        latencies.append(time.perf_counter() - float(message.data))
+
+def measure(name, port, rate, duration):
+    (server_class, socket_class) = SENDERS[name]
+    process = startServer(server_class, port)
+    receiver = connectClient(port, 'receiver', socket_class=socket_class)
+    sender = connectClient(port, 'sender', socket_class=socket_class)
+    waitForRegistration(sender, 'sender', 'receiver')
+    latencies = []
+    thread = threading.Thread(target=receive, args=(receiver, latencies), daemon=True)
+    thread.start()
+    segments = tcpSegmentsSent()
+    start = time.perf_counter()
+    sent = flood(sender, rate, duration)
+    deadline = time.time() + 10
+    while (len(latencies) < sent) and (time.time() < deadline):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    segments = tcpSegmentsSent() - segments
+    sender.disconnect()
+    receiver.disconnect()
+    stopServer(process)
+    frames = len(latencies)
+    return {
+        'sender': name,
+        'frames': frames,
+        'frames_per_sec': round(frames / elapsed),
+        'tcp_segments': segments,
+        'segments_per_frame': round(segments / frames, 3),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="TYPING flood latency and segment count")
+    parser.add_argument('--rate', type=int, default=20000)
+    parser.add_argument('--duration', type=float, default=2.0)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 400)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    results = [measure(name, args.port + i, args.rate, args.duration)
+               for i, name in enumerate(sorted(SENDERS))]
+    report('typing_flood', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
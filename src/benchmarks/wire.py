@@ -0,0 +1,76 @@
+# Bytes on the wire and the cost of writing and parsing one message in each
+# frame format: an AEAD chat message, the same under CBC + HMAC, and a
+# typing notification. Parsing includes getting the ciphertext, HMAC and
+# message number back as bytes, as the receiving session does.
+#
+#   python -m src.benchmarks.wire --payloads 16 256 4096 --output wire.json
+
+import argparse
+import os
+
+from src.benchmarks.common import *
+from src.hinge.network.Message import Message
+from src.hinge.utils import *
+
+
+def aeadMessage(payload):
+    message = Message(COMMAND_MSG, ('1234567890123456789', '9876543210987654321'), num='1234')
+    message.setEncryptedData(os.urandom(payload + AEAD_TAG_SIZE))
+    return message
+
+def cbcMessage(payload):
+    message = Message(COMMAND_MSG, ('1234567890123456789', '9876543210987654321'))
+    message.setEncryptedData(os.urandom((payload // 16 + 1) * 16))
+    message.setBinaryHmac(os.urandom(32))
+    message.setBinaryMessageNum(os.urandom(16))
+    return message
+
+def typingMessage(payload):
+    return Message(COMMAND_TYPING, ('1234567890123456789', '9876543210987654321'), str(TYPING_START))
+
+KINDS = [
+    ('aead', aeadMessage),
+    ('cbc-hmac', cbcMessage),
+    ('typing', typingMessage),
+]
+
+def parse(frame):
+    message = Message.decode(frame)
+    if message.command == COMMAND_MSG:
+        message.getEncryptedDataAsBinaryString()
+        if message.hmac or (message.raw_hmac is not None):
+            message.getHmacAsBinaryString()
+            message.getMessageNumAsBinaryString()
+        else:
+            pass
+    else:
+        pass
+    return message
+
+def measure(args):
+    results = []
+    for kind, create in KINDS:
+        for payload in (args.payloads if kind != 'typing' else [0]):
+            message = create(payload)
+            for frame_format in FRAME_FORMATS:
+                frame = message.encode(frame_format)
+                results.append(summarize('encode', *timeCase(lambda: message.encode(frame_format),
+                                                             repeat=args.repeat, min_time=args.min_time),
+                                         kind=kind, payload=payload, format=frame_format, wire_bytes=len(frame)))
+                results.append(summarize('parse', *timeCase(lambda: parse(frame),
+                                                            repeat=args.repeat, min_time=args.min_time),
+                                         kind=kind, payload=payload, format=frame_format, wire_bytes=len(frame)))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Size and encode/parse cost of a message per frame format")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds each round runs for at least")
+    parser.add_argument('--payloads', type=int, nargs='+', default=[16, 256, 4096, 65536])
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+    report('wire', measure(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ from . import dh
 from Crypto import Random
 from Crypto.Hash import *
 from Crypto.Cipher import AES
+from Crypto.Cipher import ChaCha20_Poly1305
 
 from src.hinge.utils import *
 
@@ -15,16 +16,26 @@ class CryptoUtils(object):
         self.aesSalt = None
         self.dh = None
         self.aesMode = AES.MODE_CBC
+        self.cipherSuite = CIPHER_AES_CBC_HMAC
 
     def getRandomBytes(self, n_bytes=128):
         return Random.get_random_bytes(192)
 
-    def generateDHKey(self):
-        self.dh = dh.DiffieHellman()
-        self.dh.generateKeys()
+    def generateDHKey(self, key_pool=None, suite=KEX_MODP4096):
+        if suite == KEX_X25519:
+            self.dh = dh.X25519()
+            self.dh.generateKeys()
+        elif key_pool is not None:
+            self.dh = key_pool.get()
+        else:
+            self.dh = dh.DiffieHellman()
+            self.dh.generateKeys()
 
     def computeDHSecret(self, publicKey):
-        self.dhSecret = self.dh.computeKey(publicKey)
+        try:
+            self.dhSecret = self.dh.computeKey(publicKey)
+        except dh.DHError:
+            raise CryptoError(err=ERR_BAD_HANDSHAKE)
         new_hash = self.generateHash(str(self.dhSecret).encode())
         self.aesKey = new_hash[0:32]
         self.aesIv = new_hash[16:32]
@@ -43,6 +54,29 @@ class CryptoUtils(object):
     def __aesGetCipher(self):
         return AES.new(self.aesKey, self.aesMode, self.aesIv)
 
+    def aeadEncrypt(self, nonce, message, associated):
+        # Ciphertext with the tag appended
+        if hasattr(message, "encode"):
+            message = message.encode()
+        cipher = self.__aeadGetCipher(nonce)
+        cipher.update(associated)
+        (encMessage, tag) = cipher.encrypt_and_digest(message)
+        return encMessage + tag
+
+    def aeadDecrypt(self, nonce, message, associated):
+        cipher = self.__aeadGetCipher(nonce)
+        cipher.update(associated)
+        try:
+            return cipher.decrypt_and_verify(message[:-AEAD_TAG_SIZE], message[-AEAD_TAG_SIZE:])
+        except ValueError:
+            raise CryptoError(err=ERR_BAD_HMAC)
+
+    def __aeadGetCipher(self, nonce):
+        if self.cipherSuite == CIPHER_CHACHA20_POLY1305:
+            return ChaCha20_Poly1305.new(key=self.aesKey, nonce=nonce)
+        else:
+            return AES.new(self.aesKey, AES.MODE_GCM, nonce=nonce)
+
     def generateHmac(self, message):
         hmac = HMAC.HMAC(self.aesKey, message).digest()
         return hmac
@@ -66,15 +100,20 @@ class CryptoUtils(object):
         return num
 
     def __octx_to_num(self, data):
-        converted = 0
-        length = len(data)
-        for i in range(length):
-            converted = converted + data[i] * (256 ** (length - i - 1))
-        return converted
+        return int.from_bytes(data, 'big')
 
     def getDHPubKey(self):
         return self.dh.pub_key
 
+    def exportDHPubKey(self):
+        return self.dh.exportPublicKey()
+
+    def importDHPubKey(self, data):
+        try:
+            return self.dh.importPublicKey(data)
+        except dh.DHError:
+            raise CryptoError(err=ERR_BAD_HANDSHAKE)
+
     def _pad(self, msg, bs):
         if hasattr(msg, "encode"):
             msg = msg.encode()
@@ -85,6 +124,24 @@ class CryptoUtils(object):
         return s[:-ord(s[len(s)-1:])]
 
 
+def parseSuites(data):
+    # "kex,kex;cipher,cipher;codec,codec;compression" from HELO or REDY, one list per kind.
+    # Clients from before a kind was negotiated leave it out and only know its default.
+    parts = data.split(';') if data else []
+    return tuple(parts[i].split(',') if (len(parts) > i) and parts[i] else [default]
+                 for i, default in enumerate(SUITE_DEFAULTS))
+
+
+def formatSuites(*kinds):
+    return ';'.join(','.join(kind) for kind in kinds)
+
+
+def negotiateSuites(offer, *ours):
+    # The first of our suites of each kind the other side offered, None if there is none
+    offered = parseSuites(offer)
+    return tuple(next((suite for suite in suites if suite in offered[i]), None) for i, suites in enumerate(ours))
+
+
 def binToDec(binval):
     import binascii
     return int(binascii.hexlify(binval), 16)
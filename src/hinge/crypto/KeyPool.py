@@ -0,0 +1,148 @@
+import collections
+import multiprocessing
+import threading
+import time
+
+from concurrent import futures
+
+from . import dh
+
+from src.hinge.utils import *
+
+
+def generateKeyPair(p=dh.def_p, g=dh.def_g):
+    # Runs in a worker process, so only the two integers come back
+    key = dh.DiffieHellman(p, g)
+    key.generateKeys()
+    return (key.priv_key, key.pub_key)
+
+
+class KeyPool(object):
+
+    # Keeps size single use DH keypairs generated ahead of time. Generation
+    # is done in worker processes: a 4096-bit pow holds the GIL for the
+    # whole of its ~0.7s, which would stall every other thread of a client.
+    # get() never waits for the workers, an empty pool generates inline. The
+    # workers start on the first get() unless start() warms the pool up
+    # sooner, most sessions agree on a suite that doesn't need it.
+    shared_pool = None
+    shared_lock = threading.Lock()
+
+    def __init__(self, size=DH_POOL_SIZE, workers=DH_POOL_WORKERS, p=dh.def_p, g=dh.def_g):
+        self.size = size
+        self.workers = workers
+        self.p = p
+        self.g = g
+        self.executor = None
+        # Reentrant, a future that is already done runs its callback in submit's caller
+        self.lock = threading.RLock()
+        self.ready = collections.deque()
+        self.pending = 0
+        self.started = False
+        self.closed = False
+        # Counters for tuning the size
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.refills = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    @staticmethod
+    def shared():
+        # One pool for every client in the process, keys are interchangeable
+        with KeyPool.shared_lock:
+            if KeyPool.shared_pool is None:
+                KeyPool.shared_pool = KeyPool()
+            else:
+                pass
+            return KeyPool.shared_pool
+
+    def start(self):
+        with self.lock:
+            if self.started or self.closed or (self.size <= 0):
+                return
+            self.started = True
+            # Not forked, the client has threads running by now. Spawned workers
+            # import the main module, so scripts need the __main__ guard.
+            self.executor = futures.ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'))
+            self.__refill()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.ready.clear()
+            executor = self.executor
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            pass
+
+    def get(self):
+        # Returns a DiffieHellman with its keys generated, never handed out twice
+        with self.lock:
+            if self.ready:
+                key = self.ready.popleft()
+                self.hits += 1
+            else:
+                key = None
+                self.misses += 1
+            self.start()
+            self.__refill()
+        if key is None:
+            key = dh.DiffieHellman(self.p, self.g)
+            key.generateKeys()
+        else:
+            pass
+        return key
+
+    def __refill(self):
+        # Called with the lock held
+        if not self.started or self.closed:
+            return
+        while len(self.ready) + self.pending < self.size:
+            try:
+                future = self.executor.submit(generateKeyPair, self.p, self.g)
+            except RuntimeError:
+                # Shutting down
+                return
+            self.pending += 1
+            future.add_done_callback(lambda future, requested=time.time(): self.__keyReady(future, requested))
+
+    def __keyReady(self, future, requested):
+        try:
+            (priv_key, pub_key) = future.result()
+        except Exception:
+            # A broken worker isn't retried, get() falls back to generating inline
+            with self.lock:
+                self.pending -= 1
+                self.failures += 1
+            return
+        key = dh.DiffieHellman(self.p, self.g, priv_key)
+        key.pub_key = pub_key
+        # Time from the slot being freed to it being filled again
+        lag = time.time() - requested
+        with self.lock:
+            self.pending -= 1
+            if self.closed:
+                return
+            self.ready.append(key)
+            self.refills += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'size': self.size,
+                'ready': len(self.ready),
+                'pending': self.pending,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'failures': self.failures,
+                'refills': self.refills,
+                'refill_lag_mean': self.lag_total / self.refills if self.refills else 0.0,
+                'refill_lag_max': self.lag_max,
+            }
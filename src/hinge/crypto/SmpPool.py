@@ -0,0 +1,63 @@
+import multiprocessing
+import threading
+
+from concurrent import futures
+
+from . import smp
+
+from src.hinge.utils import *
+
+
+class SmpPool(object):
+
+    # Runs SMP steps in worker processes. A step is dozens of 1536-bit
+    # modexps under the GIL, run inline it stalls every other session of
+    # the client. submit() returns a future of (smp, buffer), the SMP comes
+    # back as the state the step left it in. With no workers steps run
+    # inline and the future is already done when it is returned.
+    shared_pool = None
+    shared_lock = threading.Lock()
+
+    def __init__(self, workers=SMP_POOL_WORKERS):
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+        self.closed = False
+
+    @staticmethod
+    def shared():
+        with SmpPool.shared_lock:
+            if SmpPool.shared_pool is None:
+                SmpPool.shared_pool = SmpPool()
+            else:
+                pass
+            return SmpPool.shared_pool
+
+    def submit(self, state, step, args=()):
+        if self.workers == 0:
+            future = futures.Future()
+            try:
+                future.set_result(smp.runStep(state, step, args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("SMP pool closed")
+            if self.executor is None:
+                # Started on first use, SMP is rare. Spawned like the KeyPool
+                # workers, each builds its own fixed-base table on start.
+                self.executor = futures.ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'),
+                                                            initializer=smp.prepareWorker)
+            else:
+                pass
+            return self.executor.submit(smp.runStep, state, step, args)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            executor = self.executor
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            pass
@@ -1,3 +1,5 @@
+from Crypto.Protocol.DH import import_x25519_public_key, key_agreement
+from Crypto.PublicKey import ECC
 from Crypto.Random.random import randint
 from Crypto.Util.number import bytes_to_long, long_to_bytes
 
@@ -64,3 +66,47 @@ class DiffieHellman(object):
             rpub_key = bytes_to_long(rpub_key)
 
         return long_to_bytes(pow(rpub_key, self.priv_key, self.p))
+
+    def exportPublicKey(self):
+        # Sent as a decimal string
+        return str(self.pub_key).encode()
+
+    def importPublicKey(self, data):
+        try:
+            return int(data)
+        except ValueError:
+            raise DHError('Malformed public key')
+
+
+class X25519(object):
+
+    # Same interface as DiffieHellman, over Curve25519
+    def __init__(self, priv_key=None):
+        self.priv_key = priv_key
+        self.pub_key = None
+
+    def generateKeys(self):
+        if not self.priv_key:
+            self.priv_key = ECC.generate(curve='curve25519')
+
+        self.pub_key = self.priv_key.public_key().export_key(format='raw')
+        return self.pub_key
+
+    def computeKey(self, rpub_key):
+        if not self.priv_key:
+            raise DHError('Private key not generated')
+
+        try:
+            rpub_key = import_x25519_public_key(rpub_key)
+            # The raw shared secret, hashed by the caller like the MODP one
+            return key_agreement(static_priv=self.priv_key, static_pub=rpub_key, kdf=lambda secret: secret)
+        except ValueError:
+            raise DHError('Invalid public key')
+
+    def exportPublicKey(self):
+        return self.pub_key
+
+    def importPublicKey(self, data):
+        if len(data) != 32:
+            raise DHError('Malformed public key')
+        return bytes(data)
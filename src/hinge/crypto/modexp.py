@@ -0,0 +1,118 @@
+import threading
+
+from src.hinge.utils import *
+
+
+class FixedBase(object):
+
+    # base**e % mod for a base that never changes. The exponent is cut into
+    # window bit digits and row i of the table holds base**(d * 2**(window*i))
+    # for every digit d, so a power is one multiplication per digit and no
+    # squarings. Exponents wider than the table fall back to pow().
+    def __init__(self, base, mod, bits, window=FIXED_BASE_WINDOW):
+        self.base = base
+        self.mod = mod
+        self.bits = bits
+        self.window = window
+        self.mask = (1 << window) - 1
+        # Flat, row i starts at i << window
+        self.table = []
+        row_base = base % mod
+        for i in range((bits + window - 1) // window):
+            value = 1
+            for digit in range(1 << window):
+                self.table.append(value)
+                value = value * row_base % mod
+            row_base = value
+
+    def pow(self, exponent):
+        if (exponent < 0) or (exponent.bit_length() > self.bits):
+            return pow(self.base, exponent, self.mod)
+        (table, mask, window, mod) = (self.table, self.mask, self.window, self.mod)
+        result = 1
+        offset = 0
+        while exponent:
+            digit = exponent & mask
+            if digit:
+                result = result * table[offset | digit] % mod
+            exponent >>= window
+            offset += 1 << window
+        return result
+
+
+tables = {}
+tables_lock = threading.Lock()
+
+
+def fixedBase(base, mod, bits=None):
+    # Built on first use and shared by everything in the process
+    key = (base, mod)
+    with tables_lock:
+        table = tables.get(key)
+        if table is None:
+            table = tables[key] = FixedBase(base, mod, bits or mod.bit_length())
+        else:
+            pass
+        return table
+
+
+def multiExp(pairs, mod):
+    # The product of base**exponent % mod over (base, exponent) pairs, with
+    # the squarings shared: interleaved sliding windows, each exponent gets
+    # a window sized to it and a table of the odd powers of its base. Costs
+    # one squaring per bit of the longest exponent plus about bits/(w+1)
+    # multiplications per exponent, instead of a full pow for each.
+    digits = []
+    bits = 0
+    for base, exponent in pairs:
+        if exponent < 0:
+            raise ValueError("negative exponent")
+        length = exponent.bit_length()
+        window = windowSize(length)
+        # Odd powers base**1, base**3, ..., base**(2**window - 1)
+        base %= mod
+        square = base * base % mod
+        odd = [base]
+        for i in range((1 << (window - 1)) - 1):
+            odd.append(odd[-1] * square % mod)
+        # Bit position -> odd power starting there, from the low end
+        starts = {}
+        position = 0
+        while exponent:
+            if exponent & 1:
+                starts[position] = odd[(exponent & ((1 << window) - 1)) >> 1]
+                exponent >>= window
+                position += window
+            else:
+                exponent >>= 1
+                position += 1
+        digits.append(starts)
+        bits = max(bits, length)
+
+    result = 1
+    for position in range(bits - 1, -1, -1):
+        if result != 1:
+            result = result * result % mod
+        else:
+            pass
+        for starts in digits:
+            value = starts.get(position)
+            if value is not None:
+                result = result * value % mod
+            else:
+                pass
+    return result % mod
+
+
+def windowSize(bits):
+    # Where the saved multiplications stop paying for the bigger table
+    if bits > 768:
+        return 6
+    elif bits > 240:
+        return 5
+    elif bits > 80:
+        return 4
+    elif bits > 24:
+        return 3
+    else:
+        return 1
@@ -1,14 +1,25 @@
 from . import CryptoUtils
+from . import modexp
 import struct
 
 from src.hinge.utils import *
 
+MOD = 0xFFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7EDEE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3BE39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF6955817183995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF
+GEN = 2
+# Width of every integer in the SMP_CODEC_V2 encoding
+INT_SIZE = (MOD.bit_length() + 7) // 8
+
 class SMP(object):
-    def __init__(self, secret=None):
-        self.mod = 0xFFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7EDEE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3BE39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF6955817183995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF
+    def __init__(self, secret=None, codec=SMP_CODEC_V1):
+        self.mod = MOD
         self.modOrder = (self.mod-1) // 2
-        self.gen = 2
+        self.gen = GEN
+        # Every power of gen goes through a table shared by all instances,
+        # fetched when first needed so an SMP can be created without it
+        self.genTable = None
         self.match = False
+        # How integers are encoded and hashed, agreed on in the session handshake
+        self.codec = codec
         self.crypto = CryptoUtils.CryptoUtils()
         self.secret = self.crypto.mapStringToInt(secret)
 
@@ -16,26 +27,26 @@ class SMP(object):
         self.x2 = createRandomExponent()
         self.x3 = createRandomExponent()
 
-        self.g2 = pow(self.gen, self.x2, self.mod)
-        self.g3 = pow(self.gen, self.x3, self.mod)
+        self.g2 = self.powGen(self.x2)
+        self.g3 = self.powGen(self.x3)
 
         (c1, d1) = self.createLogProof('1', self.x2)
         (c2, d2) = self.createLogProof('2', self.x3)
 
         # Send g2a, g3a, c1, d1, c2, d2
-        return packList(self.g2, self.g3, c1, d1, c2, d2)
+        return self.pack(self.g2, self.g3, c1, d1, c2, d2)
 
     def step2(self, buffer):
-        (g2a, g3a, c1, d1, c2, d2) = unpackList(buffer)
+        (g2a, g3a, c1, d1, c2, d2) = self.unpack(buffer)
 
         if not self.isValidArgument(g2a) or not self.isValidArgument(g3a):
-            raise CryptoError("Invalid g2a/g3a values", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Invalid g2a/g3a values")
 
         if not self.checkLogProof('1', g2a, c1, d1):
-            raise CryptoError("Proof 1 check failed", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Proof 1 check failed")
 
         if not self.checkLogProof('2', g3a, c2, d2):
-            raise CryptoError("Proof 2 check failed", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Proof 2 check failed")
 
         self.g2a = g2a
         self.g3a = g3a
@@ -45,8 +56,8 @@ class SMP(object):
 
         r = createRandomExponent()
 
-        self.g2 = pow(self.gen, self.x2, self.mod)
-        self.g3 = pow(self.gen, self.x3, self.mod)
+        self.g2 = self.powGen(self.x2)
+        self.g3 = self.powGen(self.x3)
 
         (c3, d3) = self.createLogProof('3', self.x2)
         (c4, d4) = self.createLogProof('4', self.x3)
@@ -55,25 +66,25 @@ class SMP(object):
         self.gb3 = pow(self.g3a, self.x3, self.mod)
 
         self.pb = pow(self.gb3, r, self.mod)
-        self.qb = mulm(pow(self.gen, r, self.mod), pow(self.gb2, self.secret, self.mod), self.mod)
+        self.qb = mulm(self.powGen(r), pow(self.gb2, self.secret, self.mod), self.mod)
 
         (c5, d5, d6) = self.createCoordsProof('5', self.gb2, self.gb3, r)
 
         # Sends g2b, g3b, pb, qb, all the c's and d's
-        return packList(self.g2, self.g3, self.pb, self.qb, c3, d3, c4, d4, c5, d5, d6)
+        return self.pack(self.g2, self.g3, self.pb, self.qb, c3, d3, c4, d4, c5, d5, d6)
 
     def step3(self, buffer):
-        (g2b, g3b, pb, qb, c3, d3, c4, d4, c5, d5, d6) = unpackList(buffer)
+        (g2b, g3b, pb, qb, c3, d3, c4, d4, c5, d5, d6) = self.unpack(buffer)
 
         if not self.isValidArgument(g2b) or not self.isValidArgument(g3b) or \
            not self.isValidArgument(pb) or not self.isValidArgument(qb):
-            raise CryptoError("Invalid g2b/g3b/pb/qb values", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Invalid g2b/g3b/pb/qb values")
 
         if not self.checkLogProof('3', g2b, c3, d3):
-            raise CryptoError("Proof 3 check failed", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Proof 3 check failed")
 
         if not self.checkLogProof('4', g3b, c4, d4):
-            raise CryptoError("Proof 4 check failed", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Proof 4 check failed")
 
         self.g2b = g2b
         self.g3b = g3b
@@ -82,14 +93,14 @@ class SMP(object):
         self.ga3 = pow(self.g3b, self.x3, self.mod)
 
         if not self.checkCoordsProof('5', c5, d5, d6, self.ga2, self.ga3, pb, qb):
-            raise CryptoError("Proof 5 check failed", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Proof 5 check failed")
 
         s = createRandomExponent()
 
         self.qb = qb
         self.pb = pb
         self.pa = pow(self.ga3, s, self.mod)
-        self.qa = mulm(pow(self.gen, s, self.mod), pow(self.ga2, self.secret, self.mod), self.mod)
+        self.qa = mulm(self.powGen(s), pow(self.ga2, self.secret, self.mod), self.mod)
 
         (c6, d7, d8) = self.createCoordsProof('6', self.ga2, self.ga3, s)
 
@@ -99,19 +110,19 @@ class SMP(object):
         (c7, d9) = self.createEqualLogsProof('7', self.qa, inv, self.x3)
 
         # Sends pa, qa, ra, c6, d7, d8, c7, d9
-        return packList(self.pa, self.qa, self.ra, c6, d7, d8, c7, d9)
+        return self.pack(self.pa, self.qa, self.ra, c6, d7, d8, c7, d9)
 
     def step4(self, buffer):
-        (pa, qa, ra, c6, d7, d8, c7, d9) = unpackList(buffer)
+        (pa, qa, ra, c6, d7, d8, c7, d9) = self.unpack(buffer)
 
         if not self.isValidArgument(pa) or not self.isValidArgument(qa) or not self.isValidArgument(ra):
-            raise CryptoError("Invalid pa/qa/ra values", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Invalid pa/qa/ra values")
 
         if not self.checkCoordsProof('6', c6, d7, d8, self.gb2, self.gb3, pa, qa):
-            raise CryptoError("Proof 6 check failed", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Proof 6 check failed")
 
         if not self.checkEqualLogs('7', c7, d9, self.g3a, mulm(qa, self.invm(self.qb), self.mod), ra):
-            raise CryptoError("Proof 7 check failed", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Proof 7 check failed")
 
         inv = self.invm(self.qb)
         rb = pow(mulm(qa, inv, self.mod), self.x3, self.mod)
@@ -125,16 +136,16 @@ class SMP(object):
             self.match = True
 
         # Send rb, c8, d10
-        return packList(rb, c8, d10)
+        return self.pack(rb, c8, d10)
 
     def step5(self, buffer):
-        (rb, c8, d10) = unpackList(buffer)
+        (rb, c8, d10) = self.unpack(buffer)
 
         if not self.isValidArgument(rb):
-            raise CryptoError("Invalid rb values", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Invalid rb values")
 
         if not self.checkEqualLogs('8', c8, d10, self.g3b, mulm(self.qa, self.invm(self.qb), self.mod), rb):
-            raise CryptoError("Proof 8 check failed", ERR_SMP_CHECK_FAILED)
+            raise CryptoError(ERR_SMP_CHECK_FAILED, "Proof 8 check failed")
 
         rab = pow(rb, self.x3, self.mod)
 
@@ -144,24 +155,24 @@ class SMP(object):
 
     def createLogProof(self, version, x):
         randExponent = createRandomExponent()
-        c = self.hash(version + str(pow(self.gen, randExponent, self.mod)))
+        c = self.hashValues(version, self.powGen(randExponent))
         d = subm(randExponent, mulm(x, c, self.modOrder), self.modOrder)
         return (c, d)
 
     def checkLogProof(self, version, g, c, d):
-        gd = pow(self.gen, d, self.mod)
+        gd = self.powGen(d)
         gc = pow(g, c, self.mod)
         gdgc = gd * gc % self.mod
-        return (self.hash(version + str(gdgc)) == c)
+        return (self.hashValues(version, gdgc) == c)
 
     def createCoordsProof(self, version, g2, g3, r):
         r1 = createRandomExponent()
         r2 = createRandomExponent()
 
         tmp1 = pow(g3, r1, self.mod)
-        tmp2 = mulm(pow(self.gen, r1, self.mod), pow(g2, r2, self.mod), self.mod)
+        tmp2 = mulm(self.powGen(r1), pow(g2, r2, self.mod), self.mod)
 
-        c = self.hash(version + str(tmp1) + str(tmp2))
+        c = self.hashValues(version, tmp1, tmp2)
 
         d1 = subm(r1, mulm(r, c, self.modOrder), self.modOrder)
         d2 = subm(r2, mulm(self.secret, c, self.modOrder), self.modOrder)
@@ -169,41 +180,73 @@ class SMP(object):
         return (c, d1, d2)
 
     def checkCoordsProof(self, version, c, d1, d2, g2, g3, p, q):
-        tmp1 = mulm(pow(g3, d1, self.mod), pow(p, c, self.mod), self.mod)
-        tmp2 = mulm(mulm(pow(self.gen, d1, self.mod), pow(g2, d2, self.mod), self.mod), pow(q, c, self.mod), self.mod)
+        tmp1 = modexp.multiExp([(g3, d1), (p, c)], self.mod)
+        tmp2 = mulm(self.powGen(d1), modexp.multiExp([(g2, d2), (q, c)], self.mod), self.mod)
 
-        cprime = self.hash(version + str(tmp1) + str(tmp2))
+        cprime = self.hashValues(version, tmp1, tmp2)
 
         return (c == cprime)
 
     def createEqualLogsProof(self, version, qa, qb, x):
         r = createRandomExponent()
-        tmp1 = pow(self.gen, r, self.mod)
+        tmp1 = self.powGen(r)
         qab = mulm(qa, qb, self.mod)
         tmp2 = pow(qab, r, self.mod)
 
-        c = self.hash(version + str(tmp1) + str(tmp2))
+        c = self.hashValues(version, tmp1, tmp2)
         tmp1 = mulm(x, c, self.modOrder)
         d = subm(r, tmp1, self.modOrder)
 
         return (c, d)
 
     def checkEqualLogs(self, version, c, d, g3, qab, r):
-        tmp1 = mulm(pow(self.gen, d, self.mod), pow(g3, c, self.mod), self.mod)
-        tmp2 = mulm(pow(qab, d, self.mod), pow(r, c, self.mod), self.mod)
+        tmp1 = mulm(self.powGen(d), pow(g3, c, self.mod), self.mod)
+        tmp2 = modexp.multiExp([(qab, d), (r, c)], self.mod)
 
-        cprime = self.hash(version + str(tmp1) + str(tmp2))
+        cprime = self.hashValues(version, tmp1, tmp2)
 
         return (c == cprime)
 
+    def __getstate__(self):
+        # Steps can run in another process, which has its own table
+        state = self.__dict__.copy()
+        state['genTable'] = None
+        return state
+
+    def powGen(self, x):
+        if self.genTable is None:
+            self.genTable = modexp.fixedBase(self.gen, self.mod)
+        return self.genTable.pow(x)
+
     def invm(self, x):
-        return pow(x, self.mod-2, self.mod)
+        # Extended Euclid, the same inverse as x**(mod-2) for a fraction of the cost
+        return pow(x, -1, self.mod)
 
     def isValidArgument(self, val):
         return (val >= 2 and val <= self.mod-2)
 
     def hash(self, message):
-        return int(self.crypto.stringHash(message), 16)
+        # int(self.crypto.stringHash(message), 16) without the hex round trip,
+        # which drops the digest's last hex digit
+        return bytesToLong(self.crypto.generateHash(message)) >> 4
+
+    def hashValues(self, version, *values):
+        if self.codec == SMP_CODEC_V2:
+            return bytesToLong(self.crypto.generateHash(version.encode() + packFixed(*values)))
+        else:
+            return self.hash(version + ''.join(str(value) for value in values))
+
+    def pack(self, *items):
+        if self.codec == SMP_CODEC_V2:
+            return packFixed(*items)
+        else:
+            return packList(*items)
+
+    def unpack(self, buffer):
+        if self.codec == SMP_CODEC_V2:
+            return unpackFixed(buffer)
+        else:
+            return unpackList(buffer)
 
 def packList(*items):
     buffer = b''
@@ -231,25 +274,21 @@ def unpackList(buffer):
 
     return items
 
-def bytesToLong(bytes):
-    length = len(bytes)
-    string = 0
-    for i in range(length):
-        string += byteToLong(bytes[i:i+1]) << 8*(length-i-1)
-    return string
+def packFixed(*items):
+    # Every item INT_SIZE bytes wide, no length prefixes
+    return b''.join(item.to_bytes(INT_SIZE, 'big') for item in items)
 
-def longToBytes(long):
-    bytes = b''
-    while long != 0:
-        bytes = longToByte(long & 0xff) + bytes
-        long >>= 8
-    return bytes
+def unpackFixed(buffer):
+    if len(buffer) % INT_SIZE:
+        raise CryptoError(ERR_SMP_CHECK_FAILED, "Malformed SMP data")
+    return [bytesToLong(buffer[index:index+INT_SIZE]) for index in range(0, len(buffer), INT_SIZE)]
 
-def byteToLong(byte):
-    return struct.unpack('B', byte)[0]
+def bytesToLong(bytes):
+    return int.from_bytes(bytes, 'big')
 
-def longToByte(long):
-    return struct.pack('B', long)
+def longToBytes(long):
+    # Big endian with no leading zero bytes, nothing at all for 0
+    return long.to_bytes((long.bit_length() + 7) // 8, 'big')
 
 def mulm(x, y, mod):
     return x * y % mod
@@ -257,6 +296,14 @@ def mulm(x, y, mod):
 def subm(x, y, mod):
     return (x - y) % mod
 
+def runStep(smp, step, args):
+    # For SmpPool, the step and the state it leaves behind
+    buffer = getattr(smp, step)(*args)
+    return (smp, buffer)
+
+def prepareWorker():
+    modexp.fixedBase(GEN, MOD)
+
 def createRandomExponent():
     bytes = CryptoUtils.CryptoUtils().getRandomBytes(192)
     return CryptoUtils.binToDec(bytes)
\ No newline at end of file
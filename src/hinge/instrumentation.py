@@ -0,0 +1,152 @@
+import functools
+import inspect
+import itertools
+import threading
+import time
+
+from src.hinge.crypto.CryptoUtils import CryptoUtils
+from src.hinge.network.Message import Message
+from src.hinge.network.Session import Session
+from src.hinge.network.sock import AsyncSocket
+from src.hinge.network.sock import Socket
+from src.hinge.server.AsyncTURNServer import AsyncHingeClient
+from src.hinge.server.ClientManager import ClientManager
+from src.hinge.server.HingeClient import HingeClient
+from src.hinge.server.Metrics import Histogram
+from src.hinge.utils import *
+
+
+# Where each stage is timed. Hooks are installed by replacing these with
+# timing wrappers and uninstalled by putting the originals back, so nothing
+# is left on the hot path while no hook is registered.
+STAGES = [
+    (STAGE_RECV, Socket, 'recvFrame'),
+    (STAGE_RECV, AsyncSocket, 'recvFrame'),
+    (STAGE_DECODE, Message, 'createFromJson'),
+    (STAGE_DECODE, Message, 'createFromBinary'),
+    (STAGE_ROUTE, ClientManager, 'getClientById'),
+    (STAGE_ENQUEUE, HingeClient, 'sendFrame'),
+    (STAGE_ENQUEUE, AsyncHingeClient, 'sendFrame'),
+    (STAGE_SEND, Socket, 'sendMany'),
+    (STAGE_SEND, AsyncSocket, 'send'),
+    (STAGE_DECRYPT, Session, '_Session__getDecryptedData'),
+    (STAGE_AES_DECRYPT, CryptoUtils, 'aesDecrypt'),
+    (STAGE_AES_DECRYPT, CryptoUtils, 'aeadDecrypt'),
+    (STAGE_DISPATCH, Session, 'dispatchMessage'),
+]
+
+hooks = []
+originals = {}
+lock = threading.Lock()
+sample_every = INSTRUMENTATION_SAMPLE
+
+
+def addHook(hook, sample=INSTRUMENTATION_SAMPLE):
+    # hook(stage, elapsed_ns) is called for one in every sample calls of a stage
+    global sample_every, hooks
+    with lock:
+        sample_every = sample
+        hooks = hooks + [hook]
+        if not originals:
+            _install()
+        else:
+            pass
+
+def removeHook(hook):
+    global hooks
+    with lock:
+        hooks = [other for other in hooks if other is not hook]
+        if not hooks:
+            _uninstall()
+        else:
+            pass
+
+def _install():
+    for stage, owner, name in STAGES:
+        original = owner.__dict__[name]
+        originals[(owner, name)] = original
+        if isinstance(original, staticmethod):
+            setattr(owner, name, staticmethod(_timed(stage, original.__func__)))
+        else:
+            setattr(owner, name, _timed(stage, original))
+
+def _uninstall():
+    for (owner, name), original in originals.items():
+        setattr(owner, name, original)
+    originals.clear()
+
+def _timed(stage, function):
+    calls = itertools.count()
+
+    def report(start):
+        elapsed = time.perf_counter_ns() - start
+        for hook in hooks:
+            hook(stage, elapsed)
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            if next(calls) % sample_every:
+                return await function(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                report(start)
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if next(calls) % sample_every:
+                return function(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                report(start)
+    return wrapper
+
+
+class StageProfiler(object):
+
+    # A hook that keeps a latency histogram (in ns) of every stage and prints
+    # where the time goes, like a sampling profiler limited to the hot path
+    def __init__(self, sample=INSTRUMENTATION_SAMPLE):
+        self.sample = sample
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def __call__(self, stage, elapsed):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.record(elapsed)
+
+    def start(self):
+        addHook(self, self.sample)
+
+    def stop(self):
+        removeHook(self)
+
+    def report(self):
+        with self.lock:
+            stages = dict((stage, histogram.counts.copy()) for stage, histogram in self.stages.items())
+            totals = dict((stage, histogram.total) for stage, histogram in self.stages.items())
+        busy = sum(total for stage, total in totals.items() if stage not in BLOCKING_STAGES) or 1
+        lines = ["{0:<20}{1:>10}{2:>12}{3:>12}{4:>12}{5:>8}".format('stage', 'calls', 'mean us',
+                                                                 'p50 us', 'p99 us', 'share')]
+        for stage in sorted(stages, key=lambda stage: totals[stage], reverse=True):
+            histogram = Histogram()
+            histogram.counts.update(stages[stage])
+            samples = histogram.count()
+            if stage in BLOCKING_STAGES:
+                share = '-'
+            else:
+                share = "{0:.1f}%".format(100.0 * totals[stage] / busy)
+            lines.append("{0:<20}{1:>10}{2:>12.2f}{3:>12.2f}{4:>12.2f}{5:>8}".format(
+                stage, samples * self.sample, totals[stage] / samples / 1000.0,
+                histogram.percentile(50) / 1000.0, histogram.percentile(99) / 1000.0, share))
+        # Stages nest (decrypt contains aes_decrypt), so shares can add up past 100%
+        lines.append("calls are estimated from 1 in {0} sampled, {1} includes time spent "
+                     "waiting for data".format(self.sample, ', '.join(BLOCKING_STAGES)))
+        return '\n'.join(lines)
@@ -1,12 +1,19 @@
+import itertools
+import json
 import queue
 import socket
 import sys
 import traceback
 import threading
 
+from concurrent import futures
+
+from src.hinge.crypto.KeyPool import KeyPool
+from src.hinge.crypto.SmpPool import SmpPool
 from src.hinge.network import HingeObject
 from src.hinge.network import PrivateSession
 from src.hinge.network import Message
+from src.hinge.network.SendQueue import SendQueue
 from src.hinge.network.sock import Socket
 from src.hinge.utils import *
 
@@ -15,26 +22,41 @@ class Client(HingeObject.HingeObject):
 
     class SendThread(threading.Thread):
 
-        def __init__(self, client):
+        def __init__(self, client, send_policy):
             threading.Thread.__init__(self, daemon=True)
             self.client = client
-            self.message_queue = queue.Queue()
+            self.message_queue = SendQueue(policy=send_policy)
 
         def run(self):
             while True:
-                message = self.message_queue.get()
+                # Flush everything that queued up in the same write
+                messages = self.message_queue.get()
+                if not messages:
+                    return
+                # but nothing after an END to the server
+                for i, message in enumerate(messages):
+                    if self.__endsConnection(message):
+                        messages = messages[:i + 1]
+                        self.message_queue.close()
+                        break
+                    else:
+                        pass
                 try:
-                    self.client.sock.send(message.json())
-                    if (message.command == COMMAND_END) and \
-                       (message.route[1] == SERVER_ROUTE):
+                    frame_format = self.client.frame_format
+                    self.client.sock.sendMany([message.encode(frame_format) for message in messages])
+                    if self.__endsConnection(messages[-1]):
                         self.client.sock.disconnect()
+                        return
                     else:
                         pass
                 except NetworkError as ne:
+                    # Don't leave anyone blocked on a queue that will never drain
+                    self.message_queue.close()
                     self.client.callbacks['err'](SERVER_ROUTE, ERR_NETWORK_ERROR)
                     return
-                finally:
-                    self.message_queue.task_done()
+
+        def __endsConnection(self, message):
+            return (message.command == COMMAND_END) and (message.route[1] == SERVER_ROUTE)
 
     class RecvThread(threading.Thread):
 
@@ -45,7 +67,7 @@ class Client(HingeObject.HingeObject):
         def run(self):
             while True:
                 try:
-                    message = Message.Message.createFromJson(self.client.sock.recv())
+                    message = Message.Message.decode(self.client.sock.recvFrame())
                     # Check for error
                     if hasattr(message, 'error') and (message.error != ''):
                         error = int(message.error)
@@ -67,8 +89,21 @@ class Client(HingeObject.HingeObject):
                             self.client.callbacks['err'](SERVER_ROUTE, error)
                         else:
                             self.client.callbacks['err'](message.route[0], ERR_CONN_ENDED)
+                    elif message.command == COMMAND_VERSION:
+                        # The ID the server gave us and its pick of the frame formats we offered
+                        if message.num:
+                            self.client.updateId(message.num)
+                        else:
+                            pass
+                        if message.data in self.client.frame_formats:
+                            self.client.frame_format = message.data
+                        else:
+                            pass
+                        self.client.version_answered.set()
+                    elif message.command == COMMAND_UNREGISTERED:
+                        self.client.nick_cache.pop(message.data, None)
                     elif message.command in SYNC_COMMANDS:
-                        self.client.sync_resp = message.data
+                        self.client._resolveRequest(message)
                     else:
                         # Send data to intended session
                         session = self.client.sessions.get(message.route[0])
@@ -77,6 +112,8 @@ class Client(HingeObject.HingeObject):
                         else:
                             # Create a new client
                             if message.command == COMMAND_HELO:
+                                # Kept for the session if the user accepts
+                                self.client.offers[message.route[0]] = message.data
                                 self.client.callbacks['new'](message.route[0])
                             else:
                                 message = Message.Message(COMMAND_ERR,
@@ -84,55 +121,137 @@ class Client(HingeObject.HingeObject):
                                                           error=INVALID_COMMAND)
                                 self.client.sendMessage(message)
                 except NetworkError as ne:
+                    # Nobody is going to answer the lookups still in flight
+                    self.client._failRequests(ne)
+                    self.client.version_answered.set()
                     if hasattr(ne, 'errno') and (ne.errno != ERR_CLOSED_CONNECTION):
                         self.client.callbacks['err'](SERVER_ROUTE, ERR_NETWORK_ERROR)
                     else:
                         pass
                     return
+                except (ValueError, ProtocolError):
+                    # A malformed frame, the connection is still good for the ones after it
+                    continue
 
-    def __init__(self, nick, server_addr, callbacks):
+    def __init__(self, nick, server_addr, callbacks, send_policy=SEND_POLICY_DROP, key_pool=None,
+                 kex_suites=KEX_SUITES, cipher_suites=CIPHER_SUITES, smp_pool=None,
+                 smp_codecs=SMP_CODECS, frame_formats=FRAME_FORMATS, compressions=DEFAULT_COMPRESSIONS):
         HingeObject.HingeObject.__init__(self)
         self.nick = nick
         self.sock = Socket(server_addr)
         self.callbacks = callbacks
         self.message_queue = queue.Queue()
-        self.send_thread = Client.SendThread(self)
+        self.send_thread = Client.SendThread(self, send_policy)
         self.recv_thread = Client.RecvThread(self)
-        self.sync_resp = None
         self.sessions = {}
+        # Server lookups in flight, keyed by the request ID the server echoes back in num
+        self.requests = {}
+        self.requests_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        # Nick -> ID, entries are dropped when the server says the nick is gone
+        self.nick_cache = {}
+        # DH keys for new sessions, KeyPool(size=0) generates every one inline
+        self.key_pool = key_pool if key_pool is not None else KeyPool.shared()
+        # Where SMP steps run, SmpPool(workers=0) runs them on the session's thread
+        self.smp_pool = smp_pool if smp_pool is not None else SmpPool.shared()
+        # Suites in order of preference, and those offered by clients waiting to be accepted
+        self.kex_suites = list(kex_suites)
+        self.cipher_suites = list(cipher_suites)
+        self.smp_codecs = list(smp_codecs)
+        self.compressions = list(compressions)
+        self.offers = {}
+        # Frame formats we read, JSON until the server picks one
+        self.frame_formats = list(frame_formats)
+        self.frame_format = FRAME_JSON
+        # Set once the server has answered VERSION with our ID and frame format
+        self.version_answered = threading.Event()
 
     def __sendProtocolVersion(self):
-        self.__sendServerCommand(COMMAND_VERSION, PROTOCOL_VERSION)
+        # Older servers only look at the version and ignore the formats in num
+        self.__sendServerCommand(COMMAND_VERSION, PROTOCOL_VERSION, ','.join(self.frame_formats))
+
+    def __sendServerCommand(self, command, data='', num=''):
+        message = Message.Message(command, (self.id, SERVER_ROUTE), data, num=num)
+        self.sendMessage(message)
 
-    def __sendServerCommand(self, command, data=''):
-        message = Message.Message(command, (self.id, SERVER_ROUTE), data)
-        self.send_thread.message_queue.put(message)
+    def __sendServerRequest(self, command, data):
+        future = futures.Future()
+        future.command = command
+        future.data = data
+        with self.requests_lock:
+            future.request_id = str(next(self.request_ids))
+            self.requests[future.request_id] = future
+        self.__sendServerCommand(command, data, future.request_id)
+        return future
 
     def __registerNick(self):
         self.__sendServerCommand(COMMAND_REGISTER, self.nick)
 
-    def __createSession(self, remote_id, imediate_handshake=False):
+    def __createSession(self, remote_id, imediate_handshake=False, offer=''):
         if remote_id == self.id:
             self.callbacks['err'](remote_id, ERR_SELF_CONNECT)
         elif remote_id in self.sessions:
             self.callbacks['err'](remote_id, ERR_ALREADY_CONNECTED)
         else:
-            new_session = PrivateSession.PrivateSession(self, remote_id, imediate_handshake)
+            new_session = PrivateSession.PrivateSession(self, remote_id, imediate_handshake, offer)
             self.sessions[remote_id] = new_session
             new_session.start()
 
-    def _waitForResp(self):
-        while self.sync_resp is None:
+    def _resolveRequest(self, message):
+        with self.requests_lock:
+            future = self.requests.pop(message.num, None)
+        if future is not None:
+            # Cache before waking the caller so an UNREG behind this reply can't be missed
+            self.__cacheLookup(future.command, future.data, str(message.data))
+            future.set_result(str(message.data))
+        else:
             pass
-        resp = str(self.sync_resp)
-        self.sync_resp = None
-        return resp
+
+    def __cacheLookup(self, command, data, resp):
+        try:
+            if command == COMMAND_REQ_ID:
+                ids = {data: resp}
+            elif command == COMMAND_REQ_NICK:
+                ids = {resp: data}
+            elif command == COMMAND_REQ_IDS:
+                ids = json.loads(resp)
+            else:
+                ids = dict((nick, client_id) for client_id, nick in json.loads(resp).items())
+        except (ValueError, AttributeError):
+            return
+        for nick, client_id in ids.items():
+            if nick and client_id:
+                self.nick_cache[nick] = client_id
+            else:
+                pass
+
+    def _failRequests(self, error):
+        with self.requests_lock:
+            pending = list(self.requests.values())
+            self.requests.clear()
+        for future in pending:
+            future.set_exception(error)
+
+    def _waitForResp(self, future, timeout=SYNC_REQUEST_TIMEOUT):
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            with self.requests_lock:
+                self.requests.pop(future.request_id, None)
+            raise NetworkError(ERR_NETWORK_ERROR, SYNC_REQUEST_TIMED_OUT)
 
     def connectToServer(self):
+        # The key pool starts with the first session that agrees on KEX_MODP4096
         self.sock.connect()
         self.send_thread.start()
         self.recv_thread.start()
         self.__sendProtocolVersion()
+        # Register, and open sessions, under the ID the server gives us. Only
+        # servers from before then leave us waiting, and we keep our own.
+        if self.frame_formats:
+            self.version_answered.wait(VERSION_ANSWER_TIMEOUT)
+        else:
+            pass
         self.__registerNick()
 
     def disconnectFromServer(self):
@@ -146,13 +265,47 @@ class Client(HingeObject.HingeObject):
             except Exception:
                 pass
 
+    def requestClientId(self, nick):
+        return self.__sendServerRequest(COMMAND_REQ_ID, nick)
+
+    def requestClientNick(self, client_id):
+        return self.__sendServerRequest(COMMAND_REQ_NICK, client_id)
+
+    def requestClientIds(self, nicks):
+        return self.__sendServerRequest(COMMAND_REQ_IDS, json.dumps(list(nicks)))
+
+    def requestClientNicks(self, client_ids):
+        return self.__sendServerRequest(COMMAND_REQ_NICKS, json.dumps(list(client_ids)))
+
     def getClientId(self, nick):
-        self.__sendServerCommand(COMMAND_REQ_ID, nick)
-        return self._waitForResp()
+        client_id = self.nick_cache.get(nick)
+        if client_id is None:
+            client_id = self._waitForResp(self.requestClientId(nick))
+        else:
+            pass
+        return client_id
 
     def getClientNick(self, client_id):
-        self.__sendServerCommand(COMMAND_REQ_NICK, client_id)
-        return self._waitForResp()
+        return self._waitForResp(self.requestClientNick(client_id))
+
+    def getClientIds(self, nicks):
+        # Resolve everything that isn't cached in a single round trip
+        ids = {}
+        missing = []
+        for nick in nicks:
+            client_id = self.nick_cache.get(nick)
+            if client_id is None:
+                missing.append(nick)
+            else:
+                ids[nick] = client_id
+        if missing:
+            ids.update(json.loads(self._waitForResp(self.requestClientIds(missing))))
+        else:
+            pass
+        return ids
+
+    def getClientNicks(self, client_ids):
+        return json.loads(self._waitForResp(self.requestClientNicks(client_ids)))
 
     def getSession(self, session_id):
         return self.sessions.get(session_id)
@@ -161,6 +314,15 @@ class Client(HingeObject.HingeObject):
         remote_id = self.getClientId(nick)
         self.__createSession(remote_id, imediate_handshake=True)
 
+    def openSessions(self, nicks):
+        remote_ids = self.getClientIds(nicks)
+        for nick in nicks:
+            if remote_ids.get(nick):
+                self.__createSession(remote_ids[nick], imediate_handshake=True)
+            else:
+                pass
+        return remote_ids
+
     def closeSession(self, nick):
         remote_id = self.getClientId(nick)
         if remote_id:
@@ -176,12 +338,18 @@ class Client(HingeObject.HingeObject):
         del self.sessions[session_id]
 
     def sendMessage(self, message):
-        self.send_thread.message_queue.put(message)
+        # Typing notifications are the first thing dropped if the connection can't keep up
+        self.send_thread.message_queue.put(message, len(message.data),
+                                           (message.command in LOW_PRIORITY_COMMANDS) and not message.hasNum())
+
+    def queueStats(self):
+        return self.send_thread.message_queue.stats()
 
     def newClientAccepted(self, remote_id):
-        self.__createSession(remote_id)
+        self.__createSession(remote_id, offer=self.offers.pop(remote_id, ''))
 
     def newClientRejected(self, remote_id):
+        self.offers.pop(remote_id, None)
         # If rejected, send the rejected command to the client
         message = Message.Message(COMMAND_REJECT, (self.id, remote_id))
         self.sendMessage(message)
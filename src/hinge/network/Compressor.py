@@ -0,0 +1,84 @@
+import zlib
+
+from src.hinge.utils import *
+
+
+# Preset dictionary for COMPRESSION_ZLIB, what short chat messages and pasted
+# code tend to repeat. Deflate finds matches closest to the end cheapest, so
+# the most common strings go last. Changing it changes the wire format: a
+# new dictionary needs a new compression suite.
+ZLIB_DICTIONARY = (
+    b'Traceback (most recent call last):\n  File "", line , in <module>\n'
+    b'Error: Exception: ValueError: TypeError: KeyError: AttributeError: '
+    b'#include <stdio.h>\nint main(int argc, char *argv[]) {\n    return 0;\n}\n'
+    b'public static void private final protected class interface extends implements '
+    b'function (err, result) {\n  if (err) throw err;\n  console.log(\n});\n'
+    b'const let var => null undefined true false this.'
+    b'git commit -m "git push origin master git pull --rebase sudo apt-get install pip install '
+    b'https://github.com/ https://www. http://localhost:8080/ .com/ .org/ .html .json .txt .py .js '
+    b'SELECT * FROM WHERE ORDER BY GROUP BY INSERT INTO VALUES UPDATE SET '
+    b'def __init__(self, self.return None\n    else:\n        pass\n'
+    b'import from as try:\n        except Exception as e:\n            raise '
+    b'for i in range(len(if not and or is in while True:\n    print(\n'
+    b'):\n    ):\n        \n        \n    \n    '
+    b'Hello hello Hi hi Hey hey good morning good night thanks thank you '
+    b'Thanks! Thank you! OK ok okay Okay yeah Yeah yes Yes no No lol haha :) :D ;) :( '
+    b'What do you think? How are you? I think I don\'t know I\'m not sure '
+    b'I\'ll I\'ve I\'d it\'s It\'s that\'s That\'s don\'t doesn\'t can\'t won\'t didn\'t isn\'t '
+    b'could you would you can you do you have you are you going to want to need to have to '
+    b'tomorrow today tonight yesterday later right now at the moment '
+    b'something anything everything nothing someone anyone everyone '
+    b'because about before after again there their they were would should could '
+    b'which where when what with from this that have just like know will your '
+    b'the and for are but not you all any can had her was one our out get has him his '
+    b'how its let may new now see two way who did say she too use . , ? ! the of to a in is it '
+)
+
+
+class Compressor(object):
+
+    # One per session, deflating outgoing messages and inflating incoming
+    # ones. Each direction is a single stream over the whole session, so a
+    # message can refer back to text from the messages before it, and is
+    # cut with a sync flush after every message. The flush always ends in
+    # 00 00 ff ff, which is left off the wire. Messages under the threshold
+    # go as they are and don't enter the stream. Messages arrive in order,
+    # Session checks their numbers, so both ends of a stream stay in step.
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL):
+        self.threshold = threshold
+        self.level = level
+        # Started on first use, most sessions never send anything long
+        self.deflate = None
+        self.inflate = None
+
+    def compress(self, data):
+        if hasattr(data, "encode"):
+            data = data.encode()
+        if len(data) < self.threshold:
+            return COMPRESSION_RAW + data
+        if self.deflate is None:
+            self.deflate = zlib.compressobj(self.level, zlib.DEFLATED, -COMPRESSION_WINDOW_BITS,
+                                            COMPRESSION_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, ZLIB_DICTIONARY)
+        else:
+            pass
+        return COMPRESSION_DEFLATED + (self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+    def decompress(self, data):
+        marker = data[:1]
+        if marker == COMPRESSION_RAW:
+            return data[1:]
+        elif marker != COMPRESSION_DEFLATED:
+            raise CryptoError(err=ERR_BAD_DECRYPT)
+        if self.inflate is None:
+            self.inflate = zlib.decompressobj(-COMPRESSION_WINDOW_BITS, zdict=ZLIB_DICTIONARY)
+        else:
+            pass
+        try:
+            # Nothing bigger than a frame could have been sent
+            inflated = self.inflate.decompress(data[1:] + b'\x00\x00\xff\xff', MAX_FRAME_SIZE)
+        except zlib.error:
+            raise CryptoError(err=ERR_BAD_DECRYPT)
+        if self.inflate.unconsumed_tail:
+            raise CryptoError(err=ERR_BAD_DECRYPT)
+        else:
+            return inflated
@@ -1,65 +1,469 @@
 import base64
 import json
+import re
+import struct
 
 from src.hinge.utils import *
 
 
+# Matches the start of a frame as written by Message.json()
+FRAME_HEADER_REGEX = re.compile(rb'\{"command": "([^"\\]*)", "route": \["([^"\\]*)", "([^"\\]*)"\]')
+# Matches all of a frame as written by Message.json(), any frame that does loads. Its
+# strings are runs of ASCII from the space up, but quotes and backslashes, between the escapes
+# json.loads takes.
+JSON_STRING = rb'"[ !#-\[\]-\x7f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[ !#-\[\]-\x7f]*)*"'
+FRAME_REGEX = re.compile(rb'\{"command": %s, "route": \[%s, %s\], "data": %s, "hmac": %s, "error": %s, "num": %s\}' %
+                         ((JSON_STRING,) * 7))
+
+# First byte of a frame written by Message.binary(), a JSON one always starts with '{'
+BINARY_MAGIC = b'\x01'
+# Magic, command code and which fields are raw bytes
+BINARY_HEADER = struct.Struct('>cBB')
+# The route, as two IDs or as two strings each with a length prefix
+BINARY_ROUTE_IDS = struct.Struct('>II')
+BINARY_ROUTE_LENGTH = struct.Struct('>B')
+# Length prefixes of the data, hmac, error and num fields
+BINARY_LENGTHS = (struct.Struct('>I'), struct.Struct('>B'), struct.Struct('>B'), struct.Struct('>B'))
+# Built with % formatting, far cheaper than struct.pack with a format per frame. The
+# one byte lengths are %c, which raises OverflowError past 255.
+BINARY_FORMAT = BINARY_MAGIC + b'%c%c%s%s%s%c%s%c%s%c%s'
+BINARY_ROUTE_FORMAT = b'%c%s%c%s'
+
+# Fields that are base64 in JSON frames and raw bytes in binary ones
+RAW_DATA = 1
+RAW_HMAC = 2
+RAW_NUM = 4
+# The route is two IDs instead of two strings
+ROUTE_IDS = 8
+# Which flag marks each of the data, hmac, error and num fields raw, the error is always text
+BINARY_RAW_FLAGS = (RAW_DATA, RAW_HMAC, 0, RAW_NUM)
+
+COMMAND_CODES = dict((command, code) for code, command in enumerate(FRAME_COMMANDS, 1))
+
+
+def routeId(route):
+    # A route that is the decimal form of an ID fits a binary frame as one, anything else is sent as is
+    if route.isdigit() and route.isascii() and (len(route) <= 10) and ((route[0] != '0') or (route == '0')):
+        route_id = int(route)
+        return route_id if route_id <= 0xffffffff else None
+    else:
+        return None
+
+
+def binaryFields(frame, flags):
+    # Where the route ends and the fields after it start
+    if flags & ROUTE_IDS:
+        return BINARY_HEADER.size + BINARY_ROUTE_IDS.size
+    offset = BINARY_HEADER.size
+    for i in range(2):
+        offset += BINARY_ROUTE_LENGTH.size + BINARY_ROUTE_LENGTH.unpack_from(frame, offset)[0]
+    return offset
+
+
+def checkText(frame, offset, flags):
+    # Raises UnicodeDecodeError if a field that isn't raw isn't UTF-8
+    for length, raw in zip(BINARY_LENGTHS, BINARY_RAW_FLAGS):
+        (size,) = length.unpack_from(frame, offset)
+        offset += length.size
+        if size and not (flags & raw):
+            frame[offset:offset + size].decode()
+        else:
+            pass
+        offset += size
+
+
 class Message(object):
 
+    # One decoded from a binary frame keeps the frame and only cuts a field
+    # out of it when the field is asked for, the server never looks past the
+    # command and route of most. Encoding a message that hasn't changed since
+    # it was decoded or last encoded hands back the same frame.
+    __slots__ = ('_command', '_route', '_data', '_hmac', '_error', '_num',
+                 '_raw_data', '_raw_hmac', '_raw_num', '_frame', '_frame_format', '_fields')
+
     def __init__(self,
                  command, route=(SERVER_ROUTE, SERVER_ROUTE), data='',
                  hmac='', error='', num=''):
 
-        self.command = str(command)
-        self.route = tuple(route)
-        self.data = str(data)
-        self.hmac = str(hmac)
-        self.error = str(error)
-        self.num = str(num)
+        self._command = command if type(command) is str else str(command)
+        self._route = route if type(route) is tuple else tuple(route)
+        self._data = data if type(data) is str else str(data)
+        self._hmac = hmac if type(hmac) is str else str(hmac)
+        self._error = error if type(error) is str else str(error)
+        self._num = num if type(num) is str else str(num)
+        # Ciphertext set by the setBinary methods or read from a binary frame, base64 only for JSON
+        self._raw_data = None
+        self._raw_hmac = None
+        self._raw_num = None
+        # The last frame this was decoded from or encoded to
+        self._frame = None
+        self._frame_format = None
+        # Flags of the binary frame while the fields are still in it
+        self._fields = None
 
     def __str__(self):
         return self.json()
 
+    def __decodeFields(self):
+        # createFromBinary checked the lengths and that the text fields are UTF-8
+        (flags, frame) = (self._fields, self._frame)
+        offset = binaryFields(frame, flags)
+        fields = []
+        for length in BINARY_LENGTHS:
+            (size,) = length.unpack_from(frame, offset)
+            offset += length.size
+            fields.append(frame[offset:offset + size])
+            offset += size
+        (data, hmac, error, num) = fields
+        if flags & RAW_DATA:
+            self._raw_data = data
+        else:
+            self._data = data.decode()
+        if flags & RAW_HMAC:
+            self._raw_hmac = hmac
+        else:
+            self._hmac = hmac.decode()
+        if flags & RAW_NUM:
+            self._raw_num = num
+        else:
+            self._num = num.decode()
+        self._error = error.decode()
+        self._fields = None
+
+    @property
+    def command(self):
+        return self._command
+
+    @command.setter
+    def command(self, command):
+        if self._fields is not None:
+            self.__decodeFields()
+        else:
+            pass
+        self._frame = None
+        self._command = command
+
+    @property
+    def route(self):
+        return self._route
+
+    @route.setter
+    def route(self, route):
+        if self._fields is not None:
+            self.__decodeFields()
+        else:
+            pass
+        self._frame = None
+        self._route = tuple(route)
+
+    @property
+    def data(self):
+        if self._fields is not None:
+            self.__decodeFields()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        if self._fields is not None:
+            self.__decodeFields()
+        else:
+            pass
+        self._frame = None
+        self._data = data
+        self._raw_data = None
+
+    @property
+    def hmac(self):
+        if self._fields is not None:
+            self.__decodeFields()
+        return self._hmac
+
+    @hmac.setter
+    def hmac(self, hmac):
+        if self._fields is not None:
+            self.__decodeFields()
+        else:
+            pass
+        self._frame = None
+        self._hmac = hmac
+        self._raw_hmac = None
+
+    @property
+    def error(self):
+        if self._fields is not None:
+            self.__decodeFields()
+        return self._error
+
+    @error.setter
+    def error(self, error):
+        if self._fields is not None:
+            self.__decodeFields()
+        else:
+            pass
+        self._frame = None
+        self._error = str(error)
+
+    @property
+    def num(self):
+        if self._fields is not None:
+            self.__decodeFields()
+        return self._num
+
+    @num.setter
+    def num(self, num):
+        if self._fields is not None:
+            self.__decodeFields()
+        else:
+            pass
+        self._frame = None
+        self._num = num
+        self._raw_num = None
+
+    def hasNum(self):
+        # Whether it takes a message number, a session's or a request's
+        return bool(self.num) or (self.raw_num is not None)
+
+    @property
+    def raw_data(self):
+        if self._fields is not None:
+            self.__decodeFields()
+        return self._raw_data
+
+    @property
+    def raw_hmac(self):
+        if self._fields is not None:
+            self.__decodeFields()
+        return self._raw_hmac
+
+    @property
+    def raw_num(self):
+        if self._fields is not None:
+            self.__decodeFields()
+        return self._raw_num
+
     def json(self):
-        if isinstance(self.data, bytes):
-            self.data = self.data.decode()
+        if self._fields is not None:
+            self.__decodeFields()
         else:
-            self.data = str(self.data)
+            pass
+        data = self._data
+        if self._raw_data is not None:
+            data = base64.b64encode(self._raw_data).decode()
+        elif isinstance(data, bytes):
+            data = data.decode()
+        else:
+            data = str(data)
         return json.dumps({
-            'command': self.command,
-            'route': self.route,
-            'data': self.data,
-            'hmac': self.hmac,
-            'error': self.error,
-            'num': self.num,
+            'command': self._command,
+            'route': self._route,
+            'data': data,
+            'hmac': self._hmac if self._raw_hmac is None else base64.b64encode(self._raw_hmac).decode(),
+            'error': self._error,
+            'num': self._num if self._raw_num is None else base64.b64encode(self._raw_num).decode(),
         })
 
+    def binary(self):
+        if self._fields is not None:
+            self.__decodeFields()
+        else:
+            pass
+        flags = 0
+        if self._raw_data is not None:
+            data = self._raw_data
+            flags |= RAW_DATA
+        elif isinstance(self._data, bytes):
+            data = self._data
+        else:
+            data = str(self._data).encode()
+        if self._raw_hmac is not None:
+            hmac = self._raw_hmac
+            flags |= RAW_HMAC
+        else:
+            hmac = self._hmac.encode()
+        if self._raw_num is not None:
+            num = self._raw_num
+            flags |= RAW_NUM
+        else:
+            num = self._num.encode()
+        error = self._error.encode()
+        try:
+            (sender, receiver) = self._route
+            (sender_id, receiver_id) = (routeId(sender), routeId(receiver))
+            if (sender_id is not None) and (receiver_id is not None):
+                route = BINARY_ROUTE_IDS.pack(sender_id, receiver_id)
+                flags |= ROUTE_IDS
+            else:
+                (sender, receiver) = (sender.encode(), receiver.encode())
+                route = BINARY_ROUTE_FORMAT % (len(sender), sender, len(receiver), receiver)
+            return BINARY_FORMAT % (COMMAND_CODES[self._command], flags, route,
+                                    BINARY_LENGTHS[0].pack(len(data)), data, len(hmac), hmac,
+                                    len(error), error, len(num), num)
+        except (KeyError, OverflowError, struct.error):
+            raise ProtocolError(err=ERR_MALFORMED_MESSAGE)
+
+    def encode(self, frame_format):
+        if (self._frame is None) or (self._frame_format != frame_format):
+            frame = self.binary() if frame_format == FRAME_BINARY else self.json().encode('utf-8')
+            (self._frame, self._frame_format) = (frame, frame_format)
+        else:
+            pass
+        return self._frame
+
     def getEncryptedDataAsBinaryString(self):
-        return base64.b64decode(self.data)
+        if self.raw_data is not None:
+            return self._raw_data
+        return base64.b64decode(self._data)
 
     def setEncryptedData(self, data):
-        self.data = base64.b64encode(data).decode()
+        if self._fields is not None:
+            self.__decodeFields()
+        else:
+            pass
+        self._frame = None
+        self._raw_data = data
 
     def getHmacAsBinaryString(self):
-        return base64.b64decode(self.hmac)
+        if self.raw_hmac is not None:
+            return self._raw_hmac
+        return base64.b64decode(self._hmac)
 
     def setBinaryHmac(self, hmac):
-        self.hmac = base64.b64encode(hmac).decode()
+        if self._fields is not None:
+            self.__decodeFields()
+        else:
+            pass
+        self._frame = None
+        self._raw_hmac = hmac
 
     def getMessageNumAsBinaryString(self):
-        return base64.b64decode(self.num)
+        if self.raw_num is not None:
+            return self._raw_num
+        return base64.b64decode(self._num)
 
     def setBinaryMessageNum(self, num):
-        self.num = base64.b64encode(num).decode()
+        if self._fields is not None:
+            self.__decodeFields()
+        else:
+            pass
+        self._frame = None
+        self._raw_num = num
 
     @staticmethod
     def createFromJson(jsonStr):
-        jsonStr = json.loads(jsonStr)
-        return Message(
-            jsonStr['command'],
-            jsonStr['route'],
-            jsonStr['data'],
-            jsonStr['hmac'],
-            jsonStr['error'],
-            jsonStr['num'],
+        # JSON can't be read a field at a time, only the frame is kept
+        fields = json.loads(jsonStr)
+        message = Message(
+            fields['command'],
+            fields['route'],
+            fields['data'],
+            fields['hmac'],
+            fields['error'],
+            fields['num'],
         )
+        if isinstance(jsonStr, bytes):
+            (message._frame, message._frame_format) = (jsonStr, FRAME_JSON)
+        else:
+            pass
+        return message
+
+    @staticmethod
+    def createFromBinary(frame):
+        # Only the lengths and the text fields' UTF-8 are checked here, the fields are cut out
+        # when asked for. Malformed frames raise ValueError like malformed JSON does.
+        if type(frame) is not bytes:
+            frame = bytes(frame)
+        else:
+            pass
+        try:
+            (magic, code, flags) = BINARY_HEADER.unpack_from(frame)
+            command = FRAME_COMMANDS[code - 1] if code else None
+            if flags & ROUTE_IDS:
+                route = tuple(map(str, BINARY_ROUTE_IDS.unpack_from(frame, BINARY_HEADER.size)))
+                offset = BINARY_HEADER.size + BINARY_ROUTE_IDS.size
+            else:
+                route = []
+                offset = BINARY_HEADER.size
+                for i in range(2):
+                    (size,) = BINARY_ROUTE_LENGTH.unpack_from(frame, offset)
+                    offset += BINARY_ROUTE_LENGTH.size
+                    route.append(frame[offset:offset + size].decode())
+                    offset += size
+            start = offset
+            for length in BINARY_LENGTHS:
+                (size,) = length.unpack_from(frame, offset)
+                offset += length.size + size
+            # Text fields are nearly always ASCII, then there is nothing to check one by one
+            if not frame.isascii():
+                checkText(frame, start, flags)
+            else:
+                pass
+        except (struct.error, IndexError, UnicodeDecodeError):
+            raise ValueError("malformed binary frame")
+        if (magic != BINARY_MAGIC) or (command is None) or (offset != len(frame)):
+            raise ValueError("malformed binary frame")
+        message = Message(command, route)
+        (message._frame, message._frame_format) = (frame, FRAME_BINARY)
+        message._fields = flags
+        return message
+
+    @staticmethod
+    def decode(frame):
+        if frame[:1] == BINARY_MAGIC:
+            return Message.createFromBinary(frame)
+        else:
+            return Message.createFromJson(frame)
+
+    @staticmethod
+    def frameFormat(frame):
+        return FRAME_BINARY if frame[:1] == BINARY_MAGIC else FRAME_JSON
+
+    @staticmethod
+    def isWellFormed(frame):
+        # Whether decode() would take the frame, without decoding a JSON one. Only checks
+        # frames written the way Message.json() writes them, others are taken as malformed.
+        if frame[:1] == BINARY_MAGIC:
+            try:
+                Message.createFromBinary(frame)
+                return True
+            except ValueError:
+                return False
+        else:
+            return frame.isascii() and (FRAME_REGEX.fullmatch(frame) is not None)
+
+    @staticmethod
+    def frameHasNum(frame):
+        # hasNum without decoding the frame, which has to be well formed
+        if frame[:1] == BINARY_MAGIC:
+            offset = binaryFields(frame, frame[2])
+            for length in BINARY_LENGTHS[:-1]:
+                offset += length.size + length.unpack_from(frame, offset)[0]
+            return frame[offset] != 0
+        else:
+            # Message.json() writes the num last, a frame written any other way counts as numbered
+            return not frame.endswith(b'"num": ""}')
+
+    @staticmethod
+    def peekHeader(frame):
+        # Pull the command and route out of a raw frame without decoding the rest
+        # The route comes back as IDs when the frame carries them
+        if frame[:1] == BINARY_MAGIC:
+            try:
+                (magic, code, flags) = BINARY_HEADER.unpack_from(frame)
+                if not code:
+                    return None
+                elif flags & ROUTE_IDS:
+                    return (FRAME_COMMANDS[code - 1], BINARY_ROUTE_IDS.unpack_from(frame, BINARY_HEADER.size))
+                sender_end = BINARY_HEADER.size + 1 + frame[BINARY_HEADER.size]
+                receiver_end = sender_end + 1 + frame[sender_end]
+                if receiver_end > len(frame):
+                    return None
+                return (FRAME_COMMANDS[code - 1],
+                        (frame[BINARY_HEADER.size + 1:sender_end].decode(), frame[sender_end + 1:receiver_end].decode()))
+            except (struct.error, IndexError, UnicodeDecodeError):
+                return None
+        match = FRAME_HEADER_REGEX.match(frame)
+        if match is None:
+            return None
+        else:
+            command, sender, receiver = match.groups()
+            return (command.decode(), (sender.decode(), receiver.decode()))
@@ -1,18 +1,37 @@
 import base64
+import collections
+import threading
+
+from concurrent import futures
 
 from src.hinge.network import Session
+from src.hinge.network.Compressor import Compressor
+from src.hinge.crypto.CryptoUtils import formatSuites
+from src.hinge.crypto.CryptoUtils import negotiateSuites
+from src.hinge.crypto.CryptoUtils import parseSuites
 from src.hinge.crypto.smp import SMP
 from src.hinge.utils import *
 
 
 class PrivateSession(Session.Session):
 
-    def __init__(self, client, remote_id, imediate_handshake=False):
+    def __init__(self, client, remote_id, imediate_handshake=False, offer=''):
         Session.Session.__init__(self, client, remote_id)
         self.imediate_handshake = imediate_handshake
+        self.initiator = imediate_handshake
+        # Suites the initiator listed in its HELO
+        self.offer = offer
+        self.kex = None
+        self.smp_codec = SMP_CODEC_V1
+        self.compression = COMPRESSION_NONE
         self.handshake_done = False
         self.smp = None
         self.smp_step_1 = None
+        # The answer comes from the UI thread, step 1 from ours
+        self.smp_lock = threading.Lock()
+        # SMP steps waiting for the one running in the pool, run in order
+        self.smp_steps = collections.deque()
+        self.smp_running = False
 
     def __getHandshakeMessageData(self, expected):
         message = self.message_queue.get()
@@ -22,10 +41,10 @@ class PrivateSession(Session.Session):
                 raise ProtocolEnd()
             # Client rejected connection
             elif message.command == COMMAND_REJECT:
-                raise ProtocolError(errno=ERR_CONNECTION_REJECTED)
+                raise ProtocolError(err=ERR_CONN_REJECTED)
             # Handshake failed
             else:
-                raise ProtocolError(errno=ERR_BAD_HANDSHAKE)
+                raise ProtocolError(err=ERR_BAD_HANDSHAKE)
         else:
             # Decrypt message
             data = self._Session__getDecryptedData(message)
@@ -34,9 +53,9 @@ class PrivateSession(Session.Session):
             return data
 
     def __handleHandshakeError(self, exception):
-        self.client.callbacks['err'](self.remote_id, exception.errno)
+        self.client.callbacks['err'](self.remote_id, exception.err)
         # Rejected connection
-        if exception.errno == ERR_CONNECTION_REJECTED:
+        if exception.err == ERR_CONN_REJECTED:
             self.client.destroySession(self.remote_id)
         # Error
         else:
@@ -44,17 +63,30 @@ class PrivateSession(Session.Session):
 
     def __initiateHandshake(self):
         try:
-            # Send HELO command
-            self.sendMessage(COMMAND_HELO)
-            # Receive REDY command
-            self.__getHandshakeMessageData(COMMAND_REDY)
+            # Send HELO command with the suites we support
+            self.sendMessage(COMMAND_HELO, formatSuites(self.client.kex_suites, self.client.cipher_suites,
+                                                        self.client.smp_codecs, self.client.compressions))
+            # Receive REDY command with the chosen suites, none from older clients
+            (kex, ciphers, codecs, compressions) = parseSuites(self.__getHandshakeMessageData(COMMAND_REDY))
+            (self.kex, self.crypto.cipherSuite, self.smp_codec, self.compression) = \
+                (kex[0], ciphers[0], codecs[0], compressions[0])
+            if (self.kex not in self.client.kex_suites) or \
+               (self.crypto.cipherSuite not in self.client.cipher_suites) or \
+               (self.smp_codec not in self.client.smp_codecs) or \
+               (self.compression not in self.client.compressions):
+                raise ProtocolError(err=ERR_BAD_HANDSHAKE)
+            self.crypto.generateDHKey(self.client.key_pool, self.kex)
             # Send public key
-            pub_key = base64.b64encode(str(self.crypto.getDHPubKey()).encode())
+            pub_key = base64.b64encode(self.crypto.exportDHPubKey())
             self.sendMessage(COMMAND_PUB_KEY, pub_key)
             # Receive client's public key
             client_pub_key = self.__getHandshakeMessageData(COMMAND_PUB_KEY)
-            self.crypto.computeDHSecret(int(base64.b64decode(client_pub_key)))
-            # Switch to AES encryption
+            self.crypto.computeDHSecret(self.crypto.importDHPubKey(base64.b64decode(client_pub_key)))
+            # Switch to AES encryption, compressing chat messages if we agreed to
+            if self.compression == COMPRESSION_ZLIB:
+                self.compressor = Compressor()
+            else:
+                pass
             self.encrypted = True
             # Mark as done
             self.handshake_done = True
@@ -67,15 +99,26 @@ class PrivateSession(Session.Session):
 
     def __doHandshake(self):
         try:
-            # Send REDY command
-            self.sendMessage(COMMAND_REDY)
+            # Pick the suites and send them with the REDY command
+            (self.kex, cipher, self.smp_codec, self.compression) = \
+                negotiateSuites(self.offer, self.client.kex_suites, self.client.cipher_suites,
+                                self.client.smp_codecs, self.client.compressions)
+            if (self.kex is None) or (cipher is None) or (self.smp_codec is None) or (self.compression is None):
+                raise ProtocolError(err=ERR_BAD_HANDSHAKE)
+            self.crypto.cipherSuite = cipher
+            self.crypto.generateDHKey(self.client.key_pool, self.kex)
+            self.sendMessage(COMMAND_REDY, formatSuites([self.kex], [cipher], [self.smp_codec], [self.compression]))
             # Receive client's public key
             client_pub_key = self.__getHandshakeMessageData(COMMAND_PUB_KEY).encode()
-            self.crypto.computeDHSecret(int(base64.b64decode(client_pub_key)))
+            self.crypto.computeDHSecret(self.crypto.importDHPubKey(base64.b64decode(client_pub_key)))
             # Send our public key
-            pub_key = base64.b64encode(str(self.crypto.getDHPubKey()).encode('ascii'))
+            pub_key = base64.b64encode(self.crypto.exportDHPubKey())
             self.sendMessage(COMMAND_PUB_KEY, pub_key)
-            # Switch to AES encryption
+            # Switch to AES encryption, compressing chat messages if we agreed to
+            if self.compression == COMPRESSION_ZLIB:
+                self.compressor = Compressor()
+            else:
+                pass
             self.encrypted = True
             # Mark as done
             self.handshake_done = True
@@ -101,10 +144,16 @@ class PrivateSession(Session.Session):
             elif command == COMMAND_SMP_1:
                 # If there's already an smp object, go ahead to step 1.
                 # Otherwise, save the data until we have an answer from the user to respond with
-                if self.smp:
+                with self.smp_lock:
+                    answered = self.smp is not None
+                    if not answered:
+                        self.smp_step_1 = data
+                    else:
+                        pass
+                if answered:
                     self.__doSmpStep1(data)
                 else:
-                    self.smp_step_1 = data
+                    pass
             elif command == COMMAND_SMP_2:
                 self.__doSmpStep2(data)
             elif command == COMMAND_SMP_3:
@@ -117,22 +166,66 @@ class PrivateSession(Session.Session):
             self.client.callbacks['smp'](SMP_CALLBACK_ERROR, self.remote_id, '', ce.err)
 
     def __doSmpStep1(self, data):
-        buffer = self.smp.step2(data)
-        self.sendMessage(COMMAND_SMP_2, buffer)
+        self.__runSmpStep('step2', (data,), COMMAND_SMP_2)
 
     def __doSmpStep2(self, data):
-        buffer = self.smp.step3(data)
-        self.sendMessage(COMMAND_SMP_3, buffer)
+        self.__runSmpStep('step3', (data,), COMMAND_SMP_3)
 
     def __doSmpStep3(self, data):
-        buffer = self.smp.step4(data)
-        self.sendMessage(COMMAND_SMP_4, buffer)
+        self.__runSmpStep('step4', (data,), COMMAND_SMP_4)
 
     def __doSmpStep4(self, data):
-        self.smp.step5(data)
-        if self.__checkSmp():
-            self.client.callbacks['smp'](SMP_CALLBACK_COMPLETE, self.remote_id)
-        self.smp = None
+        self.__runSmpStep('step5', (data,), None)
+
+    def __runSmpStep(self, step, args, reply):
+        # Steps go to the client's SMP pool one at a time, the session thread
+        # carries on with other messages and the reply is sent when it's done
+        with self.smp_lock:
+            self.smp_steps.append((step, args, reply))
+            if self.smp_running:
+                return
+            self.smp_running = True
+        self.__nextSmpStep()
+
+    def __nextSmpStep(self):
+        with self.smp_lock:
+            if not self.smp_steps:
+                self.smp_running = False
+                return
+            (step, args, reply) = self.smp_steps.popleft()
+            state = self.smp
+        try:
+            future = self.client.smp_pool.submit(state, step, args)
+        except Exception as e:
+            future = futures.Future()
+            future.set_exception(e)
+        future.add_done_callback(lambda future: self.__smpStepDone(future, reply))
+
+    def __smpStepDone(self, future, reply):
+        try:
+            (state, buffer) = future.result()
+            with self.smp_lock:
+                self.smp = state
+            if reply is not None:
+                self.sendMessage(reply, buffer)
+            elif self.__checkSmp():
+                with self.smp_lock:
+                    self.smp = None
+                self.client.callbacks['smp'](SMP_CALLBACK_COMPLETE, self.remote_id)
+            else:
+                pass
+        except CryptoError as ce:
+            self.__failSmp(ce.err)
+        except Exception:
+            # A step without an SMP running, or the pool broke
+            self.__failSmp(ERR_SMP_CHECK_FAILED)
+        self.__nextSmpStep()
+
+    def __failSmp(self, err):
+        with self.smp_lock:
+            self.smp = None
+            self.smp_steps.clear()
+        self.client.callbacks['smp'](SMP_CALLBACK_ERROR, self.remote_id, '', err)
 
     def connect(self):
         self.__initiateHandshake()
@@ -152,7 +245,7 @@ class PrivateSession(Session.Session):
             # Check if client requested to end
             if message.command == COMMAND_END:
                 self.client.destroySession(self.remote_id)
-                self.client.callbacks['err'](self.remote_id, ERR_CONNECTION_ENDED)
+                self.client.callbacks['err'](self.remote_id, ERR_CONN_ENDED)
             # Verify command
             elif self.handshake_done and (message.command not in LOOP_COMMANDS):
                 self.client.destroySession(self.remote_id)
@@ -167,16 +260,20 @@ class PrivateSession(Session.Session):
                 if message.command in SMP_COMMANDS:
                     self.__handleSmpCommand(message.command, data)
                 else:
-                    self.client.callbacks['recv'](message.command,
-                                                  self.remote_id,
-                                                  data.decode())
+                    self.dispatchMessage(message.command, data)
 
     def initiateSmp(self, question, answer):
         self.sendMessage(COMMAND_SMP_0, question)
-        self.smp = SMP(answer)
-        buffer = self.smp.step1()
-        self.sendMessage(COMMAND_SMP_1, buffer)
+        with self.smp_lock:
+            self.smp = SMP(answer, self.smp_codec)
+        self.__runSmpStep('step1', (), COMMAND_SMP_1)
 
     def respondSmp(self, answer):
-        self.smp = SMP(answer)
-        self.__doSmpStep1(self.smp_step_1)
+        with self.smp_lock:
+            self.smp = SMP(answer, self.smp_codec)
+            step_1 = self.smp_step_1
+        # Otherwise step 1 hasn't arrived yet and is handled when it does
+        if step_1 is not None:
+            self.__doSmpStep1(step_1)
+        else:
+            pass
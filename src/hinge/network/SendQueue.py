@@ -0,0 +1,100 @@
+import collections
+import threading
+
+from src.hinge.utils import *
+
+
+class SendQueue(object):
+
+    # Bounded by both message count and bytes. What happens to a message that
+    # doesn't fit depends on the policy:
+    #   SEND_POLICY_BLOCK       the sender waits for room
+    #   SEND_POLICY_DROP        low priority messages are dropped, others wait
+    #   SEND_POLICY_DISCONNECT  low priority messages are dropped, others evict
+    #                           the consumer with ERR_SLOW_CONSUMER
+    def __init__(self, max_messages=SEND_QUEUE_MAX_MESSAGES, max_bytes=SEND_QUEUE_MAX_BYTES,
+                 policy=SEND_POLICY_BLOCK):
+        if policy not in SEND_POLICIES:
+            raise ValueError("unknown send policy {0}".format(policy))
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.items = collections.deque()
+        self.bytes = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        # Counters for spotting lagging consumers
+        self.high_water_messages = 0
+        self.high_water_bytes = 0
+        self.dropped = 0
+        self.blocked = 0
+
+    def __isFull(self, size):
+        # A single message larger than the byte limit still goes through on its own
+        return (len(self.items) >= self.max_messages) or \
+               (self.items and (self.bytes + size > self.max_bytes))
+
+    def put(self, item, size=0, low_priority=False):
+        # Returns False if the message was dropped
+        with self.lock:
+            if self.closed:
+                return False
+            if self.__isFull(size):
+                if low_priority and (self.policy != SEND_POLICY_BLOCK):
+                    self.dropped += 1
+                    return False
+                elif self.policy == SEND_POLICY_DISCONNECT:
+                    raise NetworkError(ERR_SLOW_CONSUMER, SLOW_CONSUMER)
+                else:
+                    self.blocked += 1
+                    while self.__isFull(size) and not self.closed:
+                        self.not_full.wait()
+                    if self.closed:
+                        return False
+            self.items.append((item, size))
+            self.bytes += size
+            self.high_water_messages = max(self.high_water_messages, len(self.items))
+            self.high_water_bytes = max(self.high_water_bytes, self.bytes)
+            self.not_empty.notify()
+            return True
+
+    def get(self, max_items=SEND_BATCH_SIZE):
+        # Blocks for the first message, then takes whatever else is queued behind it.
+        # Returns an empty list once the queue is closed and drained.
+        with self.lock:
+            while not self.items and not self.closed:
+                self.not_empty.wait()
+            items = []
+            while self.items and (len(items) < max_items):
+                (item, size) = self.items.popleft()
+                self.bytes -= size
+                items.append(item)
+            self.not_full.notify_all()
+            return items
+
+    def close(self, final=None):
+        # Throw away anything still queued; final, if given, is the last thing sent
+        with self.lock:
+            self.closed = True
+            self.items.clear()
+            self.bytes = 0
+            if final is not None:
+                self.items.append((final, 0))
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'messages': len(self.items),
+                'bytes': self.bytes,
+                'high_water_messages': self.high_water_messages,
+                'high_water_bytes': self.high_water_bytes,
+                'dropped': self.dropped,
+                'blocked': self.blocked,
+            }
+
+    def __len__(self):
+        return len(self.items)
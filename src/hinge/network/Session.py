@@ -1,5 +1,5 @@
-import base64
 import queue
+import struct
 import threading
 
 from src.hinge.crypto.CryptoUtils import CryptoUtils
@@ -8,6 +8,13 @@ from src.hinge.network import Message
 from src.hinge.utils import *
 
 
+# With an AEAD cipher typing notifications are numbered apart from everything
+# else, their number goes in front of the ciphertext instead of in num. They
+# may be dropped on the way, a gap in their numbers is fine.
+TYPING_SEQUENCE = 2
+TYPING_NUM = struct.Struct('>Q')
+
+
 class Session(threading.Thread, HingeObject.HingeObject):
 
     def __init__(self, client, remote_id):
@@ -18,20 +25,91 @@ class Session(threading.Thread, HingeObject.HingeObject):
         self.message_queue = queue.Queue()
         self.incoming_message_num = 0
         self.outgoing_message_num = 0
+        self.incoming_typing_num = 0
+        self.outgoing_typing_num = 0
+        # Keys are generated in the handshake, once the suite is agreed on
         self.crypto = CryptoUtils()
-        self.crypto.generateDHKey()
         self.encrypted = False
+        self.initiator = False
+        # Set when the handshake agreed on compressing chat messages
+        self.compressor = None
+        # Sends come from this thread, the UI and SMP completions. Message
+        # numbers have to reach the send queue in the order they were given.
+        self.send_lock = threading.Lock()
 
     def __verifyHmac(self, hmac, data):
         generated_hmac = self.crypto.generateHmac(data)
-        return secureStrcmp(generated_hmac, base64.b64decode(hmac))
+        return secureStrcmp(generated_hmac, hmac)
+
+    def __aeadNonce(self, num, outgoing, sequence=0):
+        # Both directions share the key, the sender's role keeps their nonces apart
+        sender_is_initiator = self.initiator if outgoing else not self.initiator
+        return struct.pack('>IQ', sequence | int(sender_is_initiator), num)
+
+    def __aeadAssociatedData(self, command, num):
+        return '{0}|{1}'.format(command, num).encode()
+
+    def __getAeadTypingData(self, message):
+        data = message.getEncryptedDataAsBinaryString()
+        try:
+            (num,) = TYPING_NUM.unpack_from(data)
+        except struct.error:
+            raise ProtocolError(err=ERR_MALFORMED_MESSAGE)
+        try:
+            data = self.crypto.aeadDecrypt(self.__aeadNonce(num, False, TYPING_SEQUENCE), data[TYPING_NUM.size:],
+                                           self.__aeadAssociatedData(message.command, num))
+        except CryptoError as ce:
+            self.client.callbacks['err'](message.route[0], ce.err)
+            raise ce
+        # Check message number, skipped ones were dropped
+        if self.incoming_typing_num > num:
+            raise ProtocolError(err=ERR_MESSAGE_REPLAY)
+        self.incoming_typing_num = num + 1
+        return data
+
+    def __getAeadDecryptedData(self, message):
+        if (message.command in LOW_PRIORITY_COMMANDS) and not message.hasNum():
+            return self.__getAeadTypingData(message)
+        else:
+            pass
+        try:
+            num = int(message.num)
+            nonce = self.__aeadNonce(num, False)
+        except (ValueError, struct.error):
+            raise ProtocolError(err=ERR_MALFORMED_MESSAGE)
+        try:
+            # Authenticates the command and the message number along with the data
+            data = self.crypto.aeadDecrypt(nonce, message.getEncryptedDataAsBinaryString(),
+                                           self.__aeadAssociatedData(message.command, num))
+        except CryptoError as ce:
+            self.client.callbacks['err'](message.route[0], ce.err)
+            raise ce
+        # Check message number
+        if self.incoming_message_num > num:
+            raise ProtocolError(err=ERR_MESSAGE_REPLAY)
+        elif self.incoming_message_num < num:
+            raise ProtocolError(err=ERR_MESSAGE_DELETION)
+        self.incoming_message_num += 1
+        return data
+
+    def __decompress(self, message, data):
+        if (self.compressor is not None) and (message.command in COMPRESSED_COMMANDS):
+            try:
+                return self.compressor.decompress(data)
+            except CryptoError as ce:
+                self.client.callbacks['err'](message.route[0], ce.err)
+                raise ce
+        else:
+            return data
 
     def __getDecryptedData(self, message):
-        if self.encrypted:
+        if self.encrypted and (self.crypto.cipherSuite in AEAD_CIPHERS):
+            return self.__decompress(message, self.__getAeadDecryptedData(message))
+        elif self.encrypted:
             data = message.getEncryptedDataAsBinaryString()
             enc_num = message.getMessageNumAsBinaryString()
             # Check HMAC
-            if not self.__verifyHmac(message.hmac, data):
+            if not self.__verifyHmac(message.getHmacAsBinaryString(), data):
                 self.client.callbacks['err'](message.route[0], ERR_BAD_HMAC)
                 raise CryptoError(err=BAD_HMAC)
             else:
@@ -39,19 +117,22 @@ class Session(threading.Thread, HingeObject.HingeObject):
                     # Check message number
                     num = int(self.crypto.aesDecrypt(enc_num))
                     if self.incoming_message_num > num:
-                        raise ProtocolError(errno=ERR_MESSAGE_REPLAY)
+                        raise ProtocolError(err=ERR_MESSAGE_REPLAY)
                     elif self.incoming_message_num < num:
-                        raise ProtocolError(errno=ERR_MESSAGE_DELETION)
+                        raise ProtocolError(err=ERR_MESSAGE_DELETION)
                     self.incoming_message_num += 1
                     # Decrypt data
                     data = self.crypto.aesDecrypt(data)
-                    return data
+                    return self.__decompress(message, data)
                 except CryptoError as ce:
                     self.client.callbacks['err'](message.route[0], ERR_BAD_DECRYPT)
                     raise ce
         else:
             return message.data
 
+    def dispatchMessage(self, command, data):
+        self.client.callbacks['recv'](command, self.remote_id, data.decode())
+
     def connect(self):
         # Override in subclass
         pass
@@ -67,24 +148,47 @@ class Session(threading.Thread, HingeObject.HingeObject):
         pass
 
     def sendMessage(self, command, data=None):
-        message = Message.Message(command, (self.client.id, self.remote_id))
-
-        if (data is not None) and self.encrypted:
-            # Encrypt data and message number & generate HMAC
-            enc_data = self.crypto.aesEncrypt(data)
-            num = self.crypto.aesEncrypt(str(self.outgoing_message_num).encode())
-            hmac = self.crypto.generateHmac(enc_data)
-            # Update message
-            message.setEncryptedData(enc_data)
-            message.setBinaryHmac(hmac)
-            message.setBinaryMessageNum(num)
-            self.outgoing_message_num += 1
-        elif data is not None:
-            message.data = data
-        else:
-            pass
+        with self.send_lock:
+            message = Message.Message(command, (self.client.id, self.remote_id))
+
+            # Compressed under the lock too, the stream has to be read in the order it was written
+            if (data is not None) and self.encrypted and (self.compressor is not None) and \
+               (command in COMPRESSED_COMMANDS):
+                data = self.compressor.compress(data)
+            else:
+                pass
+
+            if (data is not None) and self.encrypted and (self.crypto.cipherSuite in AEAD_CIPHERS) and \
+               (command in LOW_PRIORITY_COMMANDS):
+                # Without a num, so it can be dropped if a connection on the way can't keep up
+                num = self.outgoing_typing_num
+                message.setEncryptedData(TYPING_NUM.pack(num) +
+                                         self.crypto.aeadEncrypt(self.__aeadNonce(num, True, TYPING_SEQUENCE), data,
+                                                                 self.__aeadAssociatedData(command, num)))
+                self.outgoing_typing_num += 1
+            elif (data is not None) and self.encrypted and (self.crypto.cipherSuite in AEAD_CIPHERS):
+                # One pass, the message number is the nonce and goes in the clear
+                num = self.outgoing_message_num
+                message.setEncryptedData(self.crypto.aeadEncrypt(self.__aeadNonce(num, True), data,
+                                                                 self.__aeadAssociatedData(command, num)))
+                message.num = str(num)
+                self.outgoing_message_num += 1
+            elif (data is not None) and self.encrypted:
+                # Encrypt data and message number & generate HMAC
+                enc_data = self.crypto.aesEncrypt(data)
+                num = self.crypto.aesEncrypt(str(self.outgoing_message_num).encode())
+                hmac = self.crypto.generateHmac(enc_data)
+                # Update message
+                message.setEncryptedData(enc_data)
+                message.setBinaryHmac(hmac)
+                message.setBinaryMessageNum(num)
+                self.outgoing_message_num += 1
+            elif data is not None:
+                message.data = data
+            else:
+                pass
 
-        self.client.sendMessage(message)
+            self.client.sendMessage(message)
 
     def sendChatMessage(self, text):
         self.sendMessage(COMMAND_MSG, data=text)
@@ -1,14 +1,27 @@
+import asyncio
 import socket
 import struct
 
 from src.hinge.utils import *
 
 
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+# Stay well under IOV_MAX
+SEND_MAX_BUFFERS = 512
+
+
 class Socket(object):
     
-    def __init__(self, addr, sock=None):
+    def __init__(self, addr, sock=None, max_frame_size=MAX_FRAME_SIZE):
         self.addr = addr
         self.sock = sock
+        self.max_frame_size = max_frame_size
+        # Receive buffer, allocated on first use and reused for every frame
+        self.recv_buffer = None
+        self.recv_view = None
+        self.recv_start = 0
+        self.recv_end = 0
+        self.recv_small_frames = 0
         # Create a new socket if not provided
         if sock is None:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -16,6 +29,7 @@ class Socket(object):
         else:
             self.sock = sock
             self.connected = True
+        self._setNoDelay()
 
     def __str__(self):
         return self.addr[0] + ':' + str(self.addr[1])
@@ -27,6 +41,13 @@ class Socket(object):
         except socket.error as se:
             raise GenericError(str(se))
 
+    def _setNoDelay(self):
+        # Frames are coalesced before they are written, so don't let Nagle hold them back
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (socket.error, AttributeError):
+            pass
+
     def disconnect(self):
         try:
             self.sock.shutdown(socket.SHUT_RDWR)
@@ -36,16 +57,52 @@ class Socket(object):
         finally:
             self.connected = False
 
+    @staticmethod
+    def packFrameSize(size):
+        return struct.pack("I", socket.htonl(size))
+
+    @staticmethod
+    def unpackFrameSize(header):
+        return socket.ntohl(struct.unpack("I", header)[0])
+
     def send(self, data):
-        if not isinstance(data, str):
-            raise TypeError()
+        self.sendMany([data])
+
+    def sendMany(self, datas):
+        # Frame every message and hand the whole batch to the kernel at once
+        buffers = []
+        for data in datas:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            elif not isinstance(data, bytes):
+                raise TypeError()
+            buffers.append(self.packFrameSize(len(data)))
+            buffers.append(data)
+        if HAS_SENDMSG:
+            self._sendBuffers(buffers)
         else:
-            data = data.encode('utf-8')
-            size = len(data)
-            # Send the length of the message
-            self._send(struct.pack("I", socket.htonl(size)), 4)
-            # Send the actual data
-            self._send(data, size)
+            data = b''.join(buffers)
+            self._send(data, len(data))
+
+    def _sendBuffers(self, buffers):
+        first = 0
+        while first < len(buffers):
+            try:
+                sent_size = self.sock.sendmsg(buffers[first:first + SEND_MAX_BUFFERS])
+            except Exception:
+                self.connected = False
+                raise NetworkError(UNEXPECTED_CLOSE_CONNECTION)
+
+            if sent_size == 0:
+                self.connected = False
+                raise NetworkError(UNEXPECTED_CLOSE_CONNECTION)
+
+            # Skip what went out and resend the rest of a partially sent buffer
+            while (first < len(buffers)) and (sent_size >= len(buffers[first])):
+                sent_size -= len(buffers[first])
+                first += 1
+            if sent_size:
+                buffers[first] = memoryview(buffers[first])[sent_size:]
 
     def _send(self, data, length):
         sent_size = 0
@@ -63,27 +120,151 @@ class Socket(object):
             sent_size += amount_sent
 
     def recv(self):
+        return self.recvFrame().decode('utf-8')
+
+    def recvFrame(self):
         # Receive length of the incoming message
-        size = socket.ntohl(struct.unpack("I", self._recv(4))[0])
+        self._recv(4)
+        size = self.unpackFrameSize(self.recv_view[self.recv_start:self.recv_start + 4])
+        self._checkFrameSize(size)
         # Receive data
-        data = self._recv(size).decode('utf-8')
+        self._recv(4 + size)
+        start = self.recv_start + 4
+        self.recv_start = start + size
+        data = bytes(self.recv_view[start:self.recv_start])
+        if size + 4 <= RECV_BUFFER_SIZE:
+            self.recv_small_frames += 1
+        else:
+            self.recv_small_frames = 0
+        if self.recv_start == self.recv_end:
+            # Give back the memory of a grown buffer once large frames stop coming
+            if (len(self.recv_buffer) > RECV_BUFFER_SIZE) and \
+               (self.recv_small_frames >= RECV_BUFFER_SHRINK_FRAMES):
+                self._allocRecvBuffer(RECV_BUFFER_SIZE)
+            else:
+                self.recv_start = self.recv_end = 0
         return data
 
+    def _checkFrameSize(self, size):
+        if size > self.max_frame_size:
+            self.connected = False
+            raise NetworkError(ERR_FRAME_TOO_LARGE, FRAME_TOO_LARGE % self.max_frame_size)
+
+    def _allocRecvBuffer(self, size):
+        pending = self.recv_end - self.recv_start
+        buffer = bytearray(size)
+        if pending:
+            buffer[:pending] = self.recv_view[self.recv_start:self.recv_end]
+        self.recv_buffer = buffer
+        self.recv_view = memoryview(buffer)
+        self.recv_start = 0
+        self.recv_end = pending
+
     def _recv(self, length):
+        # Make sure at least length bytes are buffered, reading as much as is available
+        if self.recv_end - self.recv_start >= length:
+            return
+        if self.recv_buffer is None:
+            self._allocRecvBuffer(max(length, RECV_BUFFER_SIZE))
+        elif self.recv_start + length > len(self.recv_buffer):
+            if length > len(self.recv_buffer):
+                self._allocRecvBuffer(min(max(length, 2 * len(self.recv_buffer)),
+                                          self.max_frame_size + 4))
+            else:
+                # Move the partial frame to the front of the buffer
+                pending = self.recv_end - self.recv_start
+                self.recv_view[:pending] = self.recv_view[self.recv_start:self.recv_end]
+                self.recv_start = 0
+                self.recv_end = pending
         try:
-            data = b''
-            recv_size = 0
-            while recv_size < length:
-                new_data = self.sock.recv(length - recv_size)
-                if not new_data:
+            while self.recv_end - self.recv_start < length:
+                recv_size = self.sock.recv_into(self.recv_view[self.recv_end:])
+                if recv_size == 0:
                     self.connected = False
                     raise NetworkError(CLOSE_CONNECTION)
                 else:
-                    data += new_data
-                    recv_size += len(new_data)
-            return data
+                    self.recv_end += recv_size
         except socket.error as se:
             raise NetworkError(str(se))
 
     def getHostname(self):
         return self.addr[0]
+
+
+class AsyncSocket(Socket):
+
+    def __init__(self, addr, reader, writer, max_frame_size=MAX_FRAME_SIZE):
+        Socket.__init__(self, addr, writer.get_extra_info('socket'), max_frame_size)
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.send_pending = []
+        self.send_pending_size = 0
+
+    def _setNoDelay(self):
+        # asyncio already sets TCP_NODELAY on its transports
+        pass
+
+    def disconnect(self):
+        try:
+            self.flush()
+            self.writer.close()
+        except Exception as e:
+            pass
+        finally:
+            self.connected = False
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif not isinstance(data, bytes):
+            raise TypeError()
+        if self.writer.is_closing():
+            self.connected = False
+            raise NetworkError(UNEXPECTED_CLOSE_CONNECTION)
+        # Everything sent during this pass of the event loop goes out in one write
+        if not self.send_pending:
+            self.loop.call_soon(self.flush)
+        self.send_pending.append(self.packFrameSize(len(data)))
+        self.send_pending.append(data)
+        self.send_pending_size += 4 + len(data)
+
+    def flush(self):
+        if self.send_pending:
+            buffers = self.send_pending
+            self.send_pending = []
+            self.send_pending_size = 0
+            if not self.writer.is_closing():
+                # Buffered by the transport, so this never blocks the event loop
+                self.writer.writelines(buffers)
+
+    def bufferedSize(self):
+        # Bytes written but not yet taken by the kernel
+        return self.writer.transport.get_write_buffer_size() + self.send_pending_size
+
+    async def drain(self):
+        self.flush()
+        try:
+            await self.writer.drain()
+        except (ConnectionError, RuntimeError):
+            self.connected = False
+
+    async def recv(self):
+        return (await self.recvFrame()).decode('utf-8')
+
+    async def recvFrame(self):
+        # Receive length of the incoming message
+        size = self.unpackFrameSize(await self._recv(4))
+        self._checkFrameSize(size)
+        # Receive data
+        return await self._recv(size)
+
+    async def _recv(self, length):
+        try:
+            return await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            self.connected = False
+            raise NetworkError(CLOSE_CONNECTION)
+        except socket.error as se:
+            self.connected = False
+            raise NetworkError(str(se))
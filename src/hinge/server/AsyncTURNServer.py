@@ -0,0 +1,200 @@
+import asyncio
+import contextvars
+
+from src.hinge.server.HingeClient import Connection
+from src.hinge.server.HingeClient import HingeClient
+from src.hinge.server.HingeClient import LOW_PRIORITY
+from src.hinge.server.Metrics import ClientMetrics
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.network.Message import Message
+from src.hinge.network.sock import AsyncSocket
+from src.hinge.utils import *
+
+
+# Each RecvTask gets its own list of recipients that went over their limit
+# while it relayed a frame, see AsyncHingeClient.sendFrame
+BACKLOGGED = contextvars.ContextVar('backlogged', default=None)
+
+
+class AsyncHingeClient(HingeClient):
+
+    class RecvTask(HingeClient.Receiver):
+
+        async def run(self):
+            backlogged = []
+            BACKLOGGED.set(backlogged)
+            metrics = self.client.metrics
+            while True:
+                try:
+                    data = await self.client.sock.recvFrame()
+                except Exception as e:
+                    self.handleException(e)
+                    return
+                metrics.frames_in += 1
+                metrics.bytes_in += len(data)
+                # Reading the clock costs more than counting, only time a sample
+                timed = not (metrics.frames_in % METRICS_LATENCY_SAMPLE)
+                if timed:
+                    start = time.perf_counter_ns()
+                else:
+                    pass
+                if not self.handleFrame(data):
+                    return
+                if timed:
+                    metrics.handle_latency.record((time.perf_counter_ns() - start) // 1000)
+                else:
+                    pass
+                # Stop reading from our client until slow recipients catch up
+                while backlogged:
+                    await backlogged.pop().sock.drain()
+
+    def __init__(self, server, sock):
+        Connection.__init__(self, server.client_manager, str(sock))
+        self.server = server
+        self.sock = sock
+        self.manager = self.server.client_manager
+        self.metrics = ClientMetrics()
+        self.recv_task = AsyncHingeClient.RecvTask(self)
+        self.evicted = False
+        self.high_water_bytes = 0
+        self.dropped = 0
+        self.blocked = 0
+
+    async def serve(self):
+        await self.recv_task.run()
+
+    def connect(self):
+        pass
+
+    def send(self, message):
+        self.sendFrame(message.encode(self.frame_format), (message.command in LOW_PRIORITY) and not message.hasNum())
+
+    def sendFrame(self, frame, low_priority=False):
+        # Writes are buffered by the transport, there is no send thread to queue for.
+        # Only the byte limit applies since the transport doesn't count messages.
+        if self.evicted:
+            return
+        buffered = self.sock.bufferedSize()
+        if buffered and (buffered + len(frame) > self.server.send_queue_bytes):
+            if low_priority and (self.server.send_policy != SEND_POLICY_BLOCK):
+                self.dropped += 1
+                return
+            elif self.server.send_policy == SEND_POLICY_DISCONNECT:
+                self.evict(ERR_SLOW_CONSUMER)
+                return
+            else:
+                # The event loop can't block, make the sending task wait instead
+                self.blocked += 1
+                backlogged = BACKLOGGED.get()
+                if (backlogged is not None) and (self not in backlogged):
+                    backlogged.append(self)
+                else:
+                    pass
+        try:
+            self.sock.send(frame)
+            self.metrics.frames_out += 1
+            self.metrics.bytes_out += len(frame)
+        except NetworkError:
+            self.server.notify("{0}: error sending data".format(self.id))
+        self.high_water_bytes = max(self.high_water_bytes, buffered + len(frame))
+
+    def evict(self, error_code):
+        self.server.notify("{0}: evicted, send buffer full".format(self.id))
+        self.evicted = True
+        message = Message(COMMAND_ERR, (SERVER_ROUTE, self.id), error=error_code)
+        try:
+            self.sock.send(message.encode(self.frame_format))
+        except NetworkError:
+            pass
+        self.disconnect()
+
+    def queueStats(self):
+        return {
+            'bytes': self.sock.bufferedSize(),
+            'high_water_bytes': self.high_water_bytes,
+            'dropped': self.dropped,
+            'blocked': self.blocked,
+        }
+
+    def kick(self):
+        message = Message(COMMAND_ERR, (SERVER_ROUTE, self.id), ERR_KICKED)
+        self.send(message)
+        self.server.loop.call_later(0.25, self.disconnect)
+
+
+class AsyncTURNServer(TURNServer):
+
+    def __init__(self, listen_port, show_console=True, fast_relay=True,
+                 max_frame_size=MAX_FRAME_SIZE, backlog=1024,
+                 send_queue_messages=SEND_QUEUE_MAX_MESSAGES, send_queue_bytes=SEND_QUEUE_MAX_BYTES,
+                 send_policy=SEND_POLICY_DISCONNECT, metrics_port=None):
+        TURNServer.__init__(self, listen_port, show_console, fast_relay, max_frame_size,
+                            send_queue_messages, send_queue_bytes, send_policy, metrics_port)
+        self.backlog = backlog
+        self.loop = None
+        # Set by stop() to end serve()
+        self.stopping = None
+
+    def start(self):
+        self.openLog()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            # The loop went with the clients, only the log is left to close
+            self.stopped = True
+            self.notify("Requested to stop server")
+            self.stopMonitoring()
+            self.closeLog()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.startServer(self.backlog)
+        self.startMonitoring()
+        server = await asyncio.start_server(self.__clientConnected,
+                                            sock=self.sock,
+                                            backlog=self.backlog)
+        await self.stopping.wait()
+        # Not wait_closed(), that waits for every client to hang up
+        server.close()
+
+    async def __clientConnected(self, reader, writer):
+        # Wrap the streams in our socket object
+        client_sock = AsyncSocket(writer.get_extra_info('peername'), reader, writer,
+                                  self.max_frame_size)
+        # Store client's IP and port
+        self.notify("Got connection: {0}".format(client_sock))
+        new_client = AsyncHingeClient(self, client_sock)
+        try:
+            self.client_manager.add(new_client)
+        except Exception as e:
+            self.notify("Dropped connection {0}: {1}".format(client_sock, e))
+            client_sock.disconnect()
+            return
+        self.metrics.register(new_client)
+        await new_client.serve()
+
+    def stop(self):
+        # Clients may only be written to from the event loop thread
+        if self.loop is not None:
+            if self.stopped:
+                return
+            else:
+                self.stopped = True
+            future = asyncio.run_coroutine_threadsafe(self.__stop(), self.loop)
+            future.result()
+        else:
+            TURNServer.stop(self)
+
+    async def __stop(self):
+        self.notify("Requested to stop server")
+        # Pulse shutdown
+        message = Message(COMMAND_END, error=ERR_SERVER_SHUTDOWN)
+        for client in list(self.client_manager.clients):
+            message.route = (SERVER_ROUTE, client.id)
+            client.send(message)
+        # Pause to ensure message has been received
+        await asyncio.sleep(0.25)
+        self.stopMonitoring()
+        self.closeLog()
+        self.stopping.set()
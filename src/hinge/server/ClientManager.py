@@ -1,70 +1,204 @@
+import collections
+import threading
+
 from src.hinge.network.Message import Message
+from src.hinge.network.Message import routeId
 from src.hinge.utils import *
 
 
+class LockStripes(object):
+
+    class Held(object):
+
+        def __init__(self, locks):
+            self.locks = locks
+
+        def __enter__(self):
+            for lock in self.locks:
+                lock.acquire()
+
+        def __exit__(self, *exc_info):
+            for lock in reversed(self.locks):
+                lock.release()
+
+    def __init__(self, count=CLIENT_MANAGER_LOCK_STRIPES):
+        self.locks = [threading.Lock() for i in range(count)]
+
+    def hold(self, *keys):
+        if len(keys) == 1:
+            return self.locks[hash(keys[0]) % len(self.locks)]
+        else:
+            # Take the stripes in index order so two holders can never deadlock
+            indexes = sorted(set(hash(key) % len(self.locks) for key in keys))
+            return LockStripes.Held([self.locks[index] for index in indexes])
+
+
+class RouteTable(object):
+
+    # Connections by route ID, a slot map: the low ROUTE_SLOT_BITS of an ID
+    # index the slot, the slot's generation is above them and the prefix (the
+    # shard) above that. A freed slot is handed out again with its generation
+    # moved on, so a stale ID misses instead of reaching the slot's next owner.
+    # Lookups don't take the lock, a slot's ID only matches while it is filled.
+    def __init__(self, prefix=0):
+        self.prefix = prefix << (ROUTE_SLOT_BITS + ROUTE_GENERATION_BITS)
+        self.lock = threading.Lock()
+        # Slot 0 is never handed out, so no client gets the server's ID
+        self.slots = [None]
+        self.ids = [None]
+        self.generations = [0]
+        # Oldest freed first, generations come round as slowly as they can
+        self.free = collections.deque()
+
+    def __len__(self):
+        return len(self.slots) - len(self.free) - 1
+
+    def add(self, client):
+        with self.lock:
+            if self.free:
+                index = self.free.popleft()
+            else:
+                index = len(self.slots)
+                if index >> ROUTE_SLOT_BITS:
+                    raise Exception("route table is full")
+                else:
+                    pass
+                self.slots.append(None)
+                self.ids.append(None)
+                self.generations.append(0)
+            route_id = self.prefix | (self.generations[index] << ROUTE_SLOT_BITS) | index
+            self.slots[index] = client
+            self.ids[index] = route_id
+            return route_id
+
+    def remove(self, route_id):
+        index = route_id & ((1 << ROUTE_SLOT_BITS) - 1)
+        with self.lock:
+            if (index >= len(self.ids)) or (self.ids[index] != route_id):
+                raise KeyError("route {0} is not in use".format(route_id))
+            self.ids[index] = None
+            self.slots[index] = None
+            self.generations[index] = (self.generations[index] + 1) & ((1 << ROUTE_GENERATION_BITS) - 1)
+            self.free.append(index)
+
+    def get(self, route_id):
+        index = route_id & ((1 << ROUTE_SLOT_BITS) - 1)
+        if (index < len(self.ids)) and (self.ids[index] == route_id):
+            return self.slots[index]
+        else:
+            return None
+
+
 class ClientManager(object):
 
-    def __init__(self):
+    # Lookups never take a lock: writers are serialised per key by the stripes
+    # and a rename always inserts the new key before deleting the old one, so a
+    # concurrent reader sees either name but never neither
+    def __init__(self, stripes=CLIENT_MANAGER_LOCK_STRIPES, route_prefix=0):
+        self._stripes = LockStripes(stripes)
+        # Connections by the route ID the server gave them, the ID maps below
+        # also hold the IDs clients from before route IDs picked for themselves
+        self._routes = RouteTable(route_prefix)
         self._ip_to_connections = {}
         self._id_to_client = {}
         self._nick_to_client = {}
+        # Who looked up which nick, so they can be told when it goes away
+        self._watchers_lock = threading.Lock()
+        self._nick_to_watchers = {}
+        self._watcher_to_nicks = {}
 
+    # Snapshots, safe to iterate while clients come and go
     @property
     def clients(self):
-        return self._id_to_client.values()
+        return list(self._id_to_client.values())
 
     @property
     def ids(self):
-        return self._id_to_client.keys()
+        return list(self._id_to_client.keys())
 
     @property
     def nicks(self):
-        return self._nick_to_client.keys()
+        return list(self._nick_to_client.keys())
 
     def __clientRegistered(self, client):
-        if self._nick_to_client.get(client.nick):
-            raise Exception("client with nick {0} already exists".format(client.id)) # TODO: Fix this so that clients that abruptly disconnect can reconnect
-        else:
-            self._nick_to_client[client.nick] = client
+        with self._stripes.hold(client.nick):
+            if self._nick_to_client.get(client.nick):
+                raise Exception("client with nick {0} already exists".format(client.nick)) # TODO: Fix this so that clients that abruptly disconnect can reconnect
+            else:
+                self._nick_to_client[client.nick] = client
 
     def __clientUnregistered(self, nick):
-        if self._nick_to_client.get(nick):
-            del self._nick_to_client[nick]
-        else:
-            raise KeyError("client with nick {0} does not exist".format(nick))
+        with self._stripes.hold(nick):
+            if self._nick_to_client.get(nick):
+                del self._nick_to_client[nick]
+            else:
+                raise KeyError("client with nick {0} does not exist".format(nick))
+        self.notifyNickWatchers(nick, self.popNickWatchers(nick))
 
     def add(self, client):
+        # Give the connection its route ID
+        client.route_id = self._routes.add(client)
+        client.updateId(client.route_id)
         # Add to IP map
-        if self._ip_to_connections.get(client.ip):
-            self._ip_to_connections[client.ip].append(client)
-        else:
-            self._ip_to_connections[client.ip] = [client]
+        with self._stripes.hold(client.ip):
+            connections = self._ip_to_connections.get(client.ip)
+            if connections is None:
+                connections = self._ip_to_connections[client.ip] = set()
+            connections.add(client)
         # Add to ID map
-        if not self._id_to_client.get(client.id):
-            self._id_to_client[client.id] = client
+        with self._stripes.hold(client.id):
+            if not self._id_to_client.get(client.id):
+                self._id_to_client[client.id] = client
+                return
+        # Should not happen
+        self.__removeConnection(client)
+        self.__removeRoute(client)
+        raise Exception("client with id {0} already exists".format(client.id))
+
+    def __removeRoute(self, client):
+        if client.route_id is not None:
+            self._routes.remove(client.route_id)
+            client.route_id = None
         else:
-            # Should not happen
-            raise Exception("client with id {0} already exists".format(client.id))
+            pass
+
+    def __removeConnection(self, client):
+        with self._stripes.hold(client.ip):
+            connections = self._ip_to_connections.get(client.ip)
+            if (connections is None) or (client not in connections):
+                raise KeyError("ip {0} is not connected".format(client.ip))
+            connections.discard(client)
+            if not connections:
+                del self._ip_to_connections[client.ip]
+            else:
+                pass
 
     def remove(self, client):
         # Remove from nick map
-        if (client.nick is not None) and self._nick_to_client.get(client.nick):
-            del self._nick_to_client[client.nick]
-        elif self._nick_to_client.get(client.nick):
-            self.unregister(client)
-            del self._nick_to_client[client.nick]
-        else:
-            pass
+        nick = client.nick
+        removed_nick = False
+        if nick is not None:
+            with self._stripes.hold(nick):
+                if self._nick_to_client.get(nick) is client:
+                    del self._nick_to_client[nick]
+                    removed_nick = True
+                else:
+                    pass
         # Remove from ID map
-        if self._id_to_client.get(client.id):
-            del self._id_to_client[client.id]
+        with self._stripes.hold(client.id):
+            if self._id_to_client.get(client.id) is client:
+                del self._id_to_client[client.id]
+            else:
+                raise KeyError("client with id {0} does not exist".format(client.id))
+        # Remove from IP map and give up the route ID
+        self.__removeConnection(client)
+        self.__removeRoute(client)
+        # Tell whoever looked the nick up, and stop tracking the client's own lookups
+        if removed_nick:
+            self.notifyNickWatchers(nick, self.popNickWatchers(nick))
         else:
-            raise KeyError("client with id {0} does not exist".format(client.id))
-        # Remove from IP map
-        if self._ip_to_connections.get(client.ip):
-            self._ip_to_connections.get(client.ip).remove(client)
-        else:
-            raise KeyError("ip {0} is not connected".format(client.ip))
+            pass
+        self.unwatchNicks(client.id)
 
     def register(self, client):
         if not self._id_to_client.get(client.id):
@@ -103,17 +237,27 @@ class ClientManager(object):
             return False
 
     def getClientById(self, client_id):
-        if self.isIdRegistered(client_id):
-            return self._id_to_client.get(client_id)
+        # Route IDs from binary frames are a slot index, anything else a dict lookup. A
+        # route ID that misses is stale, whoever holds its decimal form now isn't its owner.
+        if type(client_id) is int:
+            client = self._routes.get(client_id)
+        else:
+            client = self._id_to_client.get(client_id)
+        if client is not None:
+            return client
         else:
             raise KeyError("client with id {0} does not exist".format(client_id))
 
     def getClientByNick(self, nick):
-        if self.isNickRegistered(nick):
-            return self._nick_to_client.get(nick)
+        client = self._nick_to_client.get(nick)
+        if client is not None:
+            return client
         else:
             raise KeyError("client with nick {0} does not exist".format(nick))
 
+    def getClientsByIp(self, ip):
+        return list(self._ip_to_connections.get(ip, ()))
+
     def getClientId(self, nick):
         client = self.getClientByNick(nick)
         return client.id
@@ -122,16 +266,82 @@ class ClientManager(object):
         client = self.getClientById(client_id)
         return client.nick
 
+    def getClientIds(self, nicks):
+        ids = {}
+        for nick in nicks:
+            client = self._nick_to_client.get(nick)
+            ids[nick] = client.id if client is not None else ''
+        return ids
+
+    def getClientNicks(self, client_ids):
+        nicks = {}
+        for client_id in client_ids:
+            client = self._id_to_client.get(client_id)
+            nicks[client_id] = client.nick if (client is not None) and (client.nick is not None) else ''
+        return nicks
+
+    def watchNicks(self, watcher_id, nicks):
+        with self._watchers_lock:
+            for nick in nicks:
+                self._nick_to_watchers.setdefault(nick, set()).add(watcher_id)
+            self._watcher_to_nicks.setdefault(watcher_id, set()).update(nicks)
+
+    def unwatchNicks(self, watcher_id):
+        with self._watchers_lock:
+            for nick in self._watcher_to_nicks.pop(watcher_id, ()):
+                watchers = self._nick_to_watchers.get(nick)
+                if watchers is not None:
+                    watchers.discard(watcher_id)
+                    if not watchers:
+                        del self._nick_to_watchers[nick]
+                else:
+                    pass
+
+    def popNickWatchers(self, nick):
+        with self._watchers_lock:
+            watchers = self._nick_to_watchers.pop(nick, set())
+            for watcher_id in watchers:
+                nicks = self._watcher_to_nicks.get(watcher_id)
+                if nicks is not None:
+                    nicks.discard(nick)
+                else:
+                    pass
+        return watchers
+
+    def notifyNickWatchers(self, nick, watcher_ids):
+        # Tell everyone who looked the nick up to drop it from their cache
+        for watcher_id in watcher_ids:
+            try:
+                watcher = self.getClientById(watcher_id)
+            except KeyError:
+                continue
+            watcher.send(Message(COMMAND_UNREGISTERED, (SERVER_ROUTE, watcher_id), nick))
+
     def updateClientId(self, client_id, new_client_id):
-        client = self.getClientById(client_id)
-        client.updateId(new_client_id)
-        # Change in ID map
-        del self._id_to_client[client_id]
-        self._id_to_client[client.id] = client
+        new_client_id = str(new_client_id)
+        if new_client_id == client_id:
+            return
+        # Binary frames would carry it as a route ID, and the server hands those out
+        if routeId(new_client_id) is not None:
+            raise Exception("client id {0} is reserved for route ids".format(new_client_id))
+        with self._stripes.hold(client_id, new_client_id):
+            client = self.getClientById(client_id)
+            if self._id_to_client.get(new_client_id):
+                raise Exception("client with id {0} already exists".format(new_client_id))
+            # Change in ID map, new entry first
+            self._id_to_client[new_client_id] = client
+            client.updateId(new_client_id)
+            del self._id_to_client[client_id]
+            # Clients that pick their own ID are only found by it
+            self.__removeRoute(client)
 
     def updateClientNick(self, nick, new_nick):
-        client = self.getClientByNick(nick)
-        client.nick = new_nick
-        # Change in nick map
-        del self._nick_to_client[nick]
-        self._nick_to_client[client.nick] = client
+        with self._stripes.hold(nick, new_nick):
+            client = self.getClientByNick(nick)
+            if self._nick_to_client.get(new_nick):
+                raise Exception("client with nick {0} already exists".format(new_nick))
+            # Change in nick map, new entry first
+            self._nick_to_client[new_nick] = client
+            client.nick = new_nick
+            del self._nick_to_client[nick]
+        self.notifyNickWatchers(nick, self.popNickWatchers(nick))
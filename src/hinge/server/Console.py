@@ -1,11 +1,137 @@
-import os
-import signal
 import threading
 
+from src.hinge.utils import *
+
+
+def formatBytes(count):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if count < 1024:
+            return "{0:.1f} {1}".format(count, unit)
+        count /= 1024.0
+    return "{0:.1f} TB".format(count)
+
+def formatLatency(histogram):
+    return "p50 {0}  p99 {1}  p99.9 {2}  (us, {3} samples)".format(histogram.percentile(50),
+                                                                  histogram.percentile(99),
+                                                                  histogram.percentile(99.9),
+                                                                  histogram.count())
+
 
 class Console(threading.Thread):
 
-    def __init__(self, client_manager):
+    def __init__(self, server):
         threading.Thread.__init__(self, daemon=True)
-        self.client_manager = client_manager
-        self.commands = {}
+        self.server = server
+        self.client_manager = server.client_manager
+        self.commands = {
+            'help': {
+                'callback': self.help,
+                'help': "help\t\tshow this help",
+            },
+            'list': {
+                'callback': self.list,
+                'help': "list\t\tlist registered clients",
+            },
+            'stats': {
+                'callback': self.stats,
+                'help': "stats\t\tthroughput, send queues and relay latency",
+            },
+            'top': {
+                'callback': self.top,
+                'help': "top [count]\tclients moving the most bytes per second",
+            },
+            'profile': {
+                'callback': self.profile,
+                'help': "profile [secs]\ttime each stage frames pass through",
+            },
+            'stop': {
+                'callback': self.stop,
+                'help': "stop\t\tstop the server",
+            },
+        }
+
+    def run(self):
+        while True:
+            try:
+                line = input(">> ")
+            except EOFError:
+                # Nobody at the terminal
+                return
+            args = line.split()
+            if not args:
+                continue
+            command = self.commands.get(args[0])
+            if command is None:
+                print("Unrecognized command, type help for a list of commands")
+            else:
+                command['callback'](args[1:])
+
+    def help(self, args):
+        for name in sorted(self.commands):
+            print(self.commands[name]['help'])
+
+    def list(self, args):
+        for client in self.client_manager.clients:
+            print("{0}\t{1}\t{2}".format(client.id, client.nick, client.ip))
+
+    def stats(self, args):
+        metrics = self.server.metrics
+        before = metrics.totals().counters()
+        time.sleep(CONSOLE_SAMPLE_INTERVAL)
+        totals = metrics.totals()
+        after = totals.counters()
+        rates = dict((key, (after[key] - before[key]) / CONSOLE_SAMPLE_INTERVAL) for key in after)
+        queues = [client.queueStats() for client in metrics.liveClients()]
+        print("clients: {0}  connections: {1}  uptime: {2}s".format(len(queues),
+                                                                metrics.connections,
+                                                                int(time.time() - metrics.started)))
+        print("in:  {0:.0f} frames/s  {1}/s  (total {2} frames, {3})".format(rates['frames_in'],
+                                                                           formatBytes(rates['bytes_in']),
+                                                                           after['frames_in'],
+                                                                           formatBytes(after['bytes_in'])))
+        print("out: {0:.0f} frames/s  {1}/s  (total {2} frames, {3})".format(rates['frames_out'],
+                                                                           formatBytes(rates['bytes_out']),
+                                                                           after['frames_out'],
+                                                                           formatBytes(after['bytes_out'])))
+        print("queued: {0}  (deepest {1}, dropped {2})".format(formatBytes(sum(stats['bytes'] for stats in queues)),
+                                                            formatBytes(max([stats['bytes'] for stats in queues] or [0])),
+                                                            sum(stats['dropped'] for stats in queues)))
+        print("handle: {0}".format(formatLatency(totals.handle_latency)))
+        print("send:   {0}".format(formatLatency(totals.send_latency)))
+
+    def top(self, args):
+        try:
+            count = int(args[0]) if args else CONSOLE_TOP_COUNT
+        except ValueError:
+            print("Usage: {0}".format(self.commands['top']['help']))
+            return
+        rates = self.server.metrics.sampleRates(CONSOLE_SAMPLE_INTERVAL)
+        rates.sort(key=lambda entry: entry[1]['bytes_in'] + entry[1]['bytes_out'], reverse=True)
+        print("id\tnick\tin/s\tout/s\tframes in/s\tframes out/s\tqueued")
+        for client, rate in rates[:count]:
+            print("{0}\t{1}\t{2}\t{3}\t{4:.0f}\t{5:.0f}\t{6}".format(client.id, client.nick,
+                                                                  formatBytes(rate['bytes_in']),
+                                                                  formatBytes(rate['bytes_out']),
+                                                                  rate['frames_in'],
+                                                                  rate['frames_out'],
+                                                                  formatBytes(client.queueStats()['bytes'])))
+
+    def profile(self, args):
+        # Imported here since it imports the servers, which import us
+        from src.hinge.instrumentation import StageProfiler
+        try:
+            duration = float(args[0]) if args else PROFILE_DURATION
+        except ValueError:
+            print("Usage: {0}".format(self.commands['profile']['help']))
+            return
+        profiler = StageProfiler()
+        profiler.start()
+        try:
+            time.sleep(duration)
+        finally:
+            profiler.stop()
+        print(profiler.report())
+
+    def stop(self, args):
+        # Ends the server's accept loop too
+        self.server.stop()
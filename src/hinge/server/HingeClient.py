@@ -1,18 +1,28 @@
-import queue
+import json
 import threading
 import time
 
 from src.hinge.network.Message import Message
+from src.hinge.network.SendQueue import SendQueue
+from src.hinge.server.Metrics import ClientMetrics
 from src.hinge.utils import *
 
 
+RELAY_COMMANDS = frozenset(SESSION_COMMANDS + LOOP_COMMANDS)
+LOW_PRIORITY = frozenset(LOW_PRIORITY_COMMANDS)
+
+
 class Connection(object):
 
     def __init__(self, manager, ip):
         self.manager = manager
         self.ip = ip
         self.id = str(hash(self))
+        # Given by the ClientManager, the ID is its decimal form unless the client picked its own
+        self.route_id = None
         self.nick = None
+        # What we send, agreed on in VERSION. Frames are read in either format.
+        self.frame_format = FRAME_JSON
 
     def updateId(self, new_id):
         self.id = str(new_id)
@@ -25,153 +35,275 @@ class HingeClient(Connection):
         def __init__(self, client):
             threading.Thread.__init__(self, daemon=True)
             self.client = client
-            self.queue = queue.Queue()
+            server = client.server
+            self.queue = SendQueue(server.send_queue_messages, server.send_queue_bytes, server.send_policy)
 
         def run(self):
+            metrics = self.client.metrics
             while True:
-                message = self.queue.get()
+                # Everything that queued up goes out in the same write
+                frames = self.queue.get()
                 try:
-                    self.client.sock.send(message.json())
+                    if frames:
+                        start = time.perf_counter_ns()
+                        self.client.sock.sendMany(frames)
+                        metrics.send_latency.record((time.perf_counter_ns() - start) // 1000)
+                        metrics.frames_out += len(frames)
+                        metrics.bytes_out += sum(map(len, frames))
+                    else:
+                        pass
                 except Exception as e:
-                    self.client.server.notify("{0}: error sending data to {1}".format(*message.route))
+                    self.client.server.notify("{0}: error sending data".format(self.client.id))
+                    self.queue.close()
+                    self.client.disconnect()
+                    return
+                # A closed queue has nothing after its final message
+                if self.queue.closed and not len(self.queue):
                     self.client.disconnect()
                     return
-                finally:
-                    self.queue.task_done()
 
-    class RecvThread(threading.Thread):
+    class Receiver(object):
 
         def __init__(self, client):
-            threading.Thread.__init__(self, daemon=True)
             self.client = client
+            self.version_verified = False
+            # Clients told their ID in the VERSION answer don't pick their own
+            self.id_assigned = False
+            self.registered = False
 
         def __handleError(self, error_code, msg=None):
             message = Message(COMMAND_ERR, error=error_code)
-            self.client.sock.send(message.json())
+            self.client.sock.send(message.encode(self.client.frame_format))
             self.client.disconnect()
             if message:
                 self.client.server.notify(message)
             else:
                 pass
 
-        def __verifyClientConnection(self):
-            # The client should send the protocol version
-            try:
-                message = Message.createFromJson(self.client.sock.recv())
-            except KeyError:
-                msg = "{0}: sent a command with missing JSON fields".format(self.client.id)
-                self.exit(ERR_MALFORMED_MESSAGE, msg)
-                return
+        def __verifyVersion(self, message):
             # Check that the client sent the version command
             if message.command != COMMAND_VERSION:
                 msg = "{0}: did not send version command".format(self.client.id)
                 self.exit(ERR_INVALID_COMMAND, msg)
-                return
+                return False
             # Check that the protocol version match
             if message.data != PROTOCOL_VERSION:
                 msg = "{0}: is using a mismatched protocol version".format(self.client.id)
                 self.exit(ERR_PROTOCOL_VERSION_MISMATCH, msg)
-                return
-            # The client should register a nick
-            try:
-                message = Message.createFromJson(self.client.sock.recv())
-            except KeyError:
-                msg = "{0}: sent a command with missing fields".format(self.client.id)
-                self.exit(ERR_INVALID_COMMAND, msg)
-                return
+                return False
+            self.version_verified = True
+            # Newer clients list the frame formats they read in num, and take the ID they are given
+            if message.num:
+                offered = message.num.split(',')
+                frame_format = next((offer for offer in FRAME_FORMATS if offer in offered), FRAME_JSON)
+                self.client.send(Message(COMMAND_VERSION, (SERVER_ROUTE, message.route[0]), frame_format,
+                                         num=self.client.id))
+                self.client.frame_format = frame_format
+                self.id_assigned = True
+            else:
+                pass
+            return True
+
+        def __verifyRegistration(self, message):
             # Check that the client sent the register command
             if message.command != COMMAND_REGISTER:
                 msg = "{0}: did not register a nick".format(self.client.id)
                 self.exit(ERR_INVALID_COMMAND, msg)
-                return
+                return False
             # Validate the nick
             if self.client.manager.isNickValid(message.data) != VALID_NICK:
                 msg = "{0}: tried to register an invalid nick".format(self.client.id)
                 self.exit(ERR_INVALID_NICK, msg)
-                return
+                return False
             elif self.client.manager.isNickRegistered(message.data):
                 msg = "{0}: tried to register an existing nick".format(self.client.id)
                 self.exit(ERR_NICK_IN_USE, msg)
-                return
+                return False
             else:
-                self.client.registerNick(message.data, message.route[0])
+                try:
+                    self.client.registerNick(message.data,
+                                             self.client.id if self.id_assigned else message.route[0])
+                except Exception:
+                    # Another client took the nick (or ID) since we checked
+                    msg = "{0}: lost the race for a nick or ID".format(self.client.id)
+                    self.exit(ERR_NICK_IN_USE, msg)
+                    return False
+                self.registered = True
+                return True
 
-        def run(self):
-            self.__verifyClientConnection()
-            while True:
+        def __relayMessage(self, message):
+            # Handle request to end connection
+            if message.command == COMMAND_END:
+                if message.route[1] == SERVER_ROUTE:
+                    self.client.server.notify("{0}: requested to end conection".format(self.client.id))
+                    self.client.disconnect()
+                    return False
+                else:
+                    remote = self.client.manager.getClientById(message.route[1])
+                    remote.send(message)
+            # Handle requests to retrieve a client's id
+            elif message.command == COMMAND_REQ_ID:
+                nick = message.data
                 try:
-                    # Check for malformed messages
-                    try:
-                        message = Message.createFromJson(self.client.sock.recv())
-                    except KeyError:
-                        msg = "{0}: sent a command with missing fields".format(self.client.id)
-                        self.exit(ERR_MALFORMED_MESSAGE, msg)
-                        return
-                    # Handle request to end connection
-                    if message.command == COMMAND_END:
-                        if message.route[1] == SERVER_ROUTE:
-                            self.client.server.notify("{0}: requested to end conection".format(self.client.id))
-                            self.client.manager.remove(self.client)
-                            self.client.disconnect()
-                        else:
-                            remote = self.client.manager.getClientById(message.route[1])
-                            remote.send(message)
-                    # Handle requests to retrieve a client's id
-                    elif message.command == COMMAND_REQ_ID:
-                        try:
-                            message.data = self.client.manager.getClientId(message.data)
-                        except KeyError:
-                            message.data = ''
-                        finally:
-                            message.command = COMMAND_SEND_ID
-                            message.route = (SERVER_ROUTE, message.route[0])
-                            self.client.send(message)
-                    # Handle requests to retrieve a client's nick
-                    elif message.command == COMMAND_REQ_NICK:
-                        try:
-                            message.data = self.client.manager.getClientNick(message.data)
-                        except KeyError:
-                            message.data = ''
-                        finally:
-                            message.command = COMMAND_SEND_NICK
-                            message.route = (SERVER_ROUTE, message.route[0])
-                            self.client.send(message)
-                    # Handle session commands
-                    elif message.command in SESSION_COMMANDS + LOOP_COMMANDS:
-                        remote = self.client.manager.getClientById(message.route[1])
-                        remote.send(message)
-                    # Handle relay requests
-                    elif message.command == COMMAND_RELAY:
-                        try:
-                            remote = self.client.manager.getClientById(message.route[1])
-                            remote.send(message)
-                        except KeyError:
-                            msg = "{0}: requested to send message to invalid id".format(self.client.id)
-                            self.exit(ERR_INVALID_ID, msg)
-                    # Handle invalid requests
-                    else:
-                        msg = "{0}: sent invalid command".format(self.client.id)
-                        self.exit(ERR_INVALID_COMMAND, msg)
-                        return
-                        
-                # Handle errors
-                except Exception as e:
-                    if hasattr(e, 'errno') and (e.errno != ERR_CLOSED_CONNECTION):
-                        msg = "{0}: error receiving".format(self.client.id)
-                        self.exit(e.errno, msg)
+                    message.data = self.client.manager.getClientId(nick)
+                    self.client.manager.watchNicks(self.client.id, [nick])
+                except KeyError:
+                    message.data = ''
+                finally:
+                    message.command = COMMAND_SEND_ID
+                    message.route = (SERVER_ROUTE, message.route[0])
+                    self.client.send(message)
+            # Handle requests to retrieve a client's nick
+            elif message.command == COMMAND_REQ_NICK:
+                try:
+                    message.data = self.client.manager.getClientNick(message.data)
+                    if message.data:
+                        self.client.manager.watchNicks(self.client.id, [message.data])
                     else:
                         pass
-                    self.client.disconnect()
-                    return
+                except KeyError:
+                    message.data = ''
+                finally:
+                    message.command = COMMAND_SEND_NICK
+                    message.route = (SERVER_ROUTE, message.route[0])
+                    self.client.send(message)
+            # Handle batched lookups, answered with a JSON mapping in one response
+            elif message.command in (COMMAND_REQ_IDS, COMMAND_REQ_NICKS):
+                return self.__sendMappings(message)
+            # Handle session commands
+            elif message.command in SESSION_COMMANDS + LOOP_COMMANDS:
+                remote = self.client.manager.getClientById(message.route[1])
+                remote.send(message)
+            # Handle relay requests
+            elif message.command == COMMAND_RELAY:
+                try:
+                    remote = self.client.manager.getClientById(message.route[1])
+                    remote.send(message)
+                except KeyError:
+                    msg = "{0}: requested to send message to invalid id".format(self.client.id)
+                    self.exit(ERR_INVALID_ID, msg)
+            # Handle invalid requests
+            else:
+                msg = "{0}: sent invalid command".format(self.client.id)
+                self.exit(ERR_INVALID_COMMAND, msg)
+                return False
+            return True
+
+        def __sendMappings(self, message):
+            try:
+                keys = json.loads(message.data)
+                if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+                    raise ValueError()
+            except ValueError:
+                msg = "{0}: sent a malformed lookup".format(self.client.id)
+                self.exit(ERR_MALFORMED_MESSAGE, msg)
+                return False
+            if message.command == COMMAND_REQ_IDS:
+                mappings = self.client.manager.getClientIds(keys)
+                found = [nick for nick, client_id in mappings.items() if client_id != '']
+                message.command = COMMAND_SEND_ID
+            else:
+                mappings = self.client.manager.getClientNicks(keys)
+                found = [nick for nick in mappings.values() if nick != '']
+                message.command = COMMAND_SEND_NICK
+            self.client.manager.watchNicks(self.client.id, found)
+            message.data = json.dumps(mappings)
+            message.route = (SERVER_ROUTE, message.route[0])
+            self.client.send(message)
+            return True
+
+        def handleMessage(self, message):
+            # The client should send the protocol version, then register a nick
+            if not self.version_verified:
+                return self.__verifyVersion(message)
+            elif not self.registered:
+                return self.__verifyRegistration(message)
+            else:
+                return self.__relayMessage(message)
+
+        def __relayFrame(self, data):
+            # Forward session traffic to the peer as-is, the payload is opaque to us
+            header = Message.peekHeader(data)
+            if header is None:
+                return False
+            (command, route) = header
+            if (command not in RELAY_COMMANDS) or (route[1] in SERVER_ROUTES):
+                return False
+            # A valid header doesn't make a valid frame, the peer has to be able to decode it
+            if not Message.isWellFormed(data):
+                return False
+            remote = self.client.manager.getClientById(route[1])
+            remote.relayFrame(data, (command in LOW_PRIORITY) and not Message.frameHasNum(data))
+            return True
+
+        def handleFrame(self, data):
+            try:
+                # Skip decoding frames that are only passing through
+                if self.registered and self.client.server.fast_relay:
+                    if self.__relayFrame(data):
+                        return True
+                # Check for malformed messages
+                try:
+                    message = Message.decode(data)
+                except KeyError:
+                    msg = "{0}: sent a command with missing fields".format(self.client.id)
+                    self.exit(ERR_MALFORMED_MESSAGE, msg)
+                    return False
+                return self.handleMessage(message)
+            # Handle errors
+            except Exception as e:
+                self.handleException(e)
+                return False
+
+        def handleException(self, e):
+            if isinstance(e, NetworkError) and (e.err == ERR_FRAME_TOO_LARGE):
+                msg = "{0}: sent an oversized frame".format(self.client.id)
+                self.exit(e.err, msg)
+            elif hasattr(e, 'errno') and (e.errno != ERR_CLOSED_CONNECTION):
+                msg = "{0}: error receiving".format(self.client.id)
+                self.exit(e.errno, msg)
+            else:
+                pass
+            self.client.disconnect()
 
         def exit(self, code, msg=None):
             self.__handleError(code, msg)
 
+    class RecvThread(threading.Thread, Receiver):
+
+        def __init__(self, client):
+            threading.Thread.__init__(self, daemon=True)
+            HingeClient.Receiver.__init__(self, client)
+
+        def run(self):
+            metrics = self.client.metrics
+            while True:
+                try:
+                    data = self.client.sock.recvFrame()
+                except Exception as e:
+                    self.handleException(e)
+                    return
+                metrics.frames_in += 1
+                metrics.bytes_in += len(data)
+                # Reading the clock costs more than counting, only time a sample
+                timed = not (metrics.frames_in % METRICS_LATENCY_SAMPLE)
+                if timed:
+                    start = time.perf_counter_ns()
+                else:
+                    pass
+                if not self.handleFrame(data):
+                    return
+                if timed:
+                    metrics.handle_latency.record((time.perf_counter_ns() - start) // 1000)
+                else:
+                    pass
+
     def __init__(self, server, sock):
         Connection.__init__(self, server.client_manager, str(sock))
         self.server = server
         self.sock = sock
         self.manager = self.server.client_manager
+        self.metrics = ClientMetrics()
         self.send_thread = HingeClient.SendThread(self)
         self.recv_thread = HingeClient.RecvThread(self)
 
@@ -190,13 +322,51 @@ class HingeClient(Connection):
                                                     self.id))
 
     def send(self, message):
-        self.send_thread.queue.put(message)
+        # Encode now, callers reuse message objects
+        self.sendFrame(message.encode(self.frame_format), (message.command in LOW_PRIORITY) and not message.hasNum())
+
+    def relayFrame(self, frame, low_priority=False):
+        # Passed on as it came, unless it is from a client using the other format
+        if Message.frameFormat(frame) != self.frame_format:
+            frame = Message.decode(frame).encode(self.frame_format)
+        else:
+            pass
+        self.sendFrame(frame, low_priority)
+
+    def sendFrame(self, frame, low_priority=False):
+        try:
+            self.send_thread.queue.put(frame, len(frame), low_priority)
+        except NetworkError as ne:
+            self.evict(ne.err)
+
+    def evict(self, error_code):
+        # Drop whatever is queued, tell the client why and hang up. A client that stopped
+        # reading holds the send thread in a write, hanging up is what frees it.
+        self.server.notify("{0}: evicted, send queue full".format(self.id))
+        message = Message(COMMAND_ERR, (SERVER_ROUTE, self.id), error=error_code)
+        self.send_thread.queue.close(message.encode(self.frame_format))
+        # Not started yet if the client was evicted between being added and connect()
+        if self.send_thread.is_alive():
+            self.send_thread.join(EVICT_GRACE_PERIOD)
+        else:
+            pass
+        self.disconnect()
+
+    def queueStats(self):
+        return self.send_thread.queue.stats()
 
     def registerNick(self, nick, remote_id):
         self.nick = nick
         self.__nickRegistered(nick, remote_id)
 
     def disconnect(self):
+        # Every way a connection ends comes through here, some more than once. The first
+        # gives up the ID, nick and route ID, after that the manager no longer has the client.
+        try:
+            self.manager.remove(self)
+        except KeyError:
+            pass
+        self.server.metrics.retire(self)
         self.sock.disconnect()
 
     def kick(self):
@@ -0,0 +1,132 @@
+import collections
+import os
+import threading
+
+from src.hinge.utils import *
+
+
+class LogWriter(threading.Thread):
+
+    # Callers only append to a buffer, the disk is touched from this thread.
+    # Records are written out once LOG_FLUSH_BYTES have piled up or every
+    # LOG_FLUSH_INTERVAL seconds. The file is rotated to path.1, path.2, ...
+    # once it grows past max_bytes. If more than max_pending records are
+    # waiting only one in LOG_OVERLOAD_SAMPLE is kept and the number dropped
+    # is logged once the writer catches up.
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUP_COUNT,
+                 flush_bytes=LOG_FLUSH_BYTES, flush_interval=LOG_FLUSH_INTERVAL,
+                 max_pending=LOG_MAX_PENDING):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.dropped = 0
+        self.overloaded = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        # Fail here rather than on the first write
+        self.__open()
+
+    def write(self, record):
+        with self.lock:
+            if self.closed:
+                return
+            if len(self.pending) >= self.max_pending:
+                self.overloaded += 1
+                if self.overloaded % LOG_OVERLOAD_SAMPLE:
+                    self.dropped += 1
+                    return
+                else:
+                    pass
+            line = '{0}\n'.format(record)
+            self.pending.append(line)
+            self.pending_bytes += len(line)
+            if self.pending_bytes >= self.flush_bytes:
+                self.wakeup.notify()
+            else:
+                pass
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.closed and (self.pending_bytes < self.flush_bytes):
+                    self.wakeup.wait(self.flush_interval)
+                lines = self.pending
+                self.pending = collections.deque()
+                self.pending_bytes = 0
+                if self.dropped:
+                    lines.append("Log overloaded, dropped {0} records\n".format(self.dropped))
+                    self.dropped = 0
+                else:
+                    pass
+                closed = self.closed
+            if lines:
+                self.__writeLines(lines)
+            else:
+                pass
+            if closed:
+                self.__close()
+                return
+
+    def __open(self):
+        self.file = open(self.path, 'a', encoding='utf-8', errors='backslashreplace')
+        self.size = self.file.tell()
+
+    def __close(self):
+        if self.file is not None:
+            self.file.close()
+        else:
+            pass
+
+    def __writeLines(self, lines):
+        try:
+            # Reopened here if it couldn't be after the last rotation
+            if self.file is None:
+                self.__open()
+            else:
+                pass
+            data = ''.join(lines)
+            self.file.write(data)
+            self.file.flush()
+            # max_bytes is in bytes on disk
+            self.size += len(data.encode('utf-8', 'backslashreplace'))
+            if self.size >= self.max_bytes:
+                self.__rotate()
+            else:
+                pass
+        except (IOError, OSError, ValueError):
+            # Nowhere left to report it, drop the batch rather than kill the writer
+            pass
+
+    def __rotate(self):
+        self.file.close()
+        self.file = None
+        try:
+            for i in range(self.backups - 1, 0, -1):
+                older = '{0}.{1}'.format(self.path, i)
+                if os.path.exists(older):
+                    os.replace(older, '{0}.{1}'.format(self.path, i + 1))
+                else:
+                    pass
+            if self.backups > 0:
+                os.replace(self.path, '{0}.1'.format(self.path))
+            else:
+                os.remove(self.path)
+        finally:
+            self.__open()
+
+    def close(self):
+        # Write out whatever is left and stop
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        if self.is_alive():
+            self.join()
+        else:
+            self.__close()
@@ -0,0 +1,233 @@
+import collections
+import http.server
+import threading
+import time
+
+from src.hinge.utils import *
+
+
+class Histogram(object):
+
+    # Log-linear buckets in the style of HdrHistogram: values below
+    # 2**sub_bucket_bits are counted exactly, above that every power of two is
+    # split into 2**(sub_bucket_bits - 1) equal buckets, so a recorded value is
+    # off by at most 2**-(sub_bucket_bits - 1). Only buckets that were hit are
+    # stored. Written by one thread, read by copying the counts.
+    def __init__(self, sub_bucket_bits=HISTOGRAM_SUB_BUCKET_BITS, max_value=HISTOGRAM_MAX_VALUE):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_buckets = 1 << sub_bucket_bits
+        self.half_buckets = self.sub_buckets >> 1
+        self.max_value = max_value
+        self.counts = collections.defaultdict(int)
+        self.total = 0
+
+    def bucketIndex(self, value):
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return self.sub_buckets + (shift - 1) * self.half_buckets + (value >> shift) - self.half_buckets
+
+    def bucketBounds(self, index):
+        # Lowest and highest value counted in the bucket
+        if index < self.sub_buckets:
+            return (index, index)
+        (shift, offset) = divmod(index - self.sub_buckets, self.half_buckets)
+        shift += 1
+        low = (self.half_buckets + offset) << shift
+        return (low, low + (1 << shift) - 1)
+
+    def record(self, value):
+        # This is on the relay path, most latencies fit the exact buckets
+        if 0 <= value < self.sub_buckets:
+            self.counts[value] += 1
+        else:
+            value = min(max(value, 0), self.max_value)
+            self.counts[self.bucketIndex(value)] += 1
+        self.total += value
+
+    def merge(self, other):
+        # dict.copy() doesn't let the writer in halfway through
+        for index, count in other.counts.copy().items():
+            self.counts[index] += count
+        self.total += other.total
+
+    def count(self):
+        return sum(self.counts.copy().values())
+
+    def percentile(self, percent):
+        counts = self.counts.copy()
+        total = sum(counts.values())
+        if not total:
+            return 0
+        rank = max(1, int(total * percent / 100.0 + 0.5))
+        seen = 0
+        for index in sorted(counts):
+            seen += counts[index]
+            if seen >= rank:
+                return self.bucketBounds(index)[1]
+        return self.bucketBounds(max(counts))[1]
+
+    def cumulativeCounts(self, bounds):
+        # Number of values at or below each bound, for exporting as histogram buckets
+        counts = sorted(self.counts.copy().items())
+        result = []
+        seen = 0
+        i = 0
+        for bound in bounds:
+            while (i < len(counts)) and (self.bucketBounds(counts[i][0])[1] <= bound):
+                seen += counts[i][1]
+                i += 1
+            result.append(seen)
+        return result
+
+
+class ClientMetrics(object):
+
+    # Every field has a single writer: the receiving side is only updated by
+    # the client's receive thread and the sending side by its send thread, so
+    # counting takes no locks. Latencies are in microseconds.
+    def __init__(self):
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.handle_latency = Histogram()
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.send_latency = Histogram()
+
+    def merge(self, other):
+        self.frames_in += other.frames_in
+        self.bytes_in += other.bytes_in
+        self.handle_latency.merge(other.handle_latency)
+        self.frames_out += other.frames_out
+        self.bytes_out += other.bytes_out
+        self.send_latency.merge(other.send_latency)
+
+    def counters(self):
+        return {
+            'frames_in': self.frames_in,
+            'bytes_in': self.bytes_in,
+            'frames_out': self.frames_out,
+            'bytes_out': self.bytes_out,
+        }
+
+
+class ServerMetrics(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # Clients are summed when read, disconnected ones are folded in here
+        self.clients = set()
+        self.retired = ClientMetrics()
+        self.connections = 0
+
+    def register(self, client):
+        with self.lock:
+            self.clients.add(client)
+            self.connections += 1
+
+    def retire(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+                self.retired.merge(client.metrics)
+            else:
+                pass
+
+    def liveClients(self):
+        with self.lock:
+            return list(self.clients)
+
+    def totals(self):
+        total = ClientMetrics()
+        with self.lock:
+            total.merge(self.retired)
+            for client in self.clients:
+                total.merge(client.metrics)
+        return total
+
+    def sampleRates(self, interval=1.0):
+        # Per client counter deltas over the interval, in units per second
+        before = dict((client, client.metrics.counters()) for client in self.liveClients())
+        time.sleep(interval)
+        rates = []
+        for client in self.liveClients():
+            now = client.metrics.counters()
+            then = before.get(client, dict((key, 0) for key in now))
+            rates.append((client, dict((key, (now[key] - then[key]) / interval) for key in now)))
+        return rates
+
+
+class MetricsExporter(threading.Thread):
+
+    # Serves the metrics in the Prometheus text format on localhost
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = self.server.exporter.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    def __init__(self, server, port, address='127.0.0.1'):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.httpd = http.server.ThreadingHTTPServer((address, port), MetricsExporter.Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.exporter = self
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def render(self):
+        metrics = self.server.metrics
+        totals = metrics.totals()
+        clients = metrics.liveClients()
+        queued = [client.queueStats() for client in clients]
+        lines = []
+        def add(name, kind, value, help_text):
+            lines.append('# HELP hinge_{0} {1}'.format(name, help_text))
+            lines.append('# TYPE hinge_{0} {1}'.format(name, kind))
+            lines.append('hinge_{0} {1}'.format(name, value))
+        add('frames_received_total', 'counter', totals.frames_in, 'Frames received from clients')
+        add('bytes_received_total', 'counter', totals.bytes_in, 'Bytes received from clients')
+        add('frames_sent_total', 'counter', totals.frames_out, 'Frames written to clients')
+        add('bytes_sent_total', 'counter', totals.bytes_out, 'Bytes written to clients')
+        add('connections_total', 'counter', metrics.connections, 'Connections accepted')
+        add('clients', 'gauge', len(clients), 'Connected clients')
+        add('send_queue_messages', 'gauge', sum(stats.get('messages', 0) for stats in queued),
+            'Messages waiting in send queues')
+        add('send_queue_bytes', 'gauge', sum(stats['bytes'] for stats in queued),
+            'Bytes waiting in send queues')
+        add('send_queue_dropped', 'gauge', sum(stats['dropped'] for stats in queued),
+            'Low priority messages dropped for connected clients')
+        self.addHistogram(lines, 'handle_seconds', totals.handle_latency,
+                          'Time from receiving a frame to handing it to the recipient, sampled')
+        self.addHistogram(lines, 'send_seconds', totals.send_latency,
+                          'Time spent writing a batch of frames to a client')
+        lines.append('')
+        return '\n'.join(lines)
+
+    def addHistogram(self, lines, name, histogram, help_text):
+        # The fine buckets are collapsed to powers of two to keep the output small
+        bounds = [(1 << i) - 1 for i in range(HISTOGRAM_EXPORT_BITS + 1)]
+        lines.append('# HELP hinge_{0} {1}'.format(name, help_text))
+        lines.append('# TYPE hinge_{0} histogram'.format(name))
+        for bound, count in zip(bounds, histogram.cumulativeCounts(bounds)):
+            lines.append('hinge_{0}_bucket{{le="{1:g}"}} {2}'.format(name, (bound + 1) / 1e6, count))
+        count = histogram.count()
+        lines.append('hinge_{0}_bucket{{le="+Inf"}} {1}'.format(name, count))
+        lines.append('hinge_{0}_sum {1:g}'.format(name, histogram.total / 1e6))
+        lines.append('hinge_{0}_count {1}'.format(name, count))
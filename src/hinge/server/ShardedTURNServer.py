@@ -0,0 +1,410 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+
+from multiprocessing.managers import BaseManager
+
+from src.hinge.server.ClientManager import ClientManager
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.network.Message import Message
+from src.hinge.network.SendQueue import SendQueue
+from src.hinge.network.sock import Socket
+from src.hinge.utils import *
+
+
+SHARD_ROUTE_CACHE_SIZE = 65536
+
+
+class ShardDirectory(object):
+
+    # Lives in the manager process, every call runs on one of its server threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nick_to_id = {}
+        self.id_to_nick = {}
+        self.id_to_shard = {}
+        self.nick_to_watchers = {}
+        self.watcher_to_nicks = {}
+
+    def register(self, nick, client_id, shard):
+        with self.lock:
+            if nick in self.nick_to_id:
+                return False
+            else:
+                self.nick_to_id[nick] = client_id
+                self.id_to_nick[client_id] = nick
+                self.id_to_shard[client_id] = shard
+                return True
+
+    def unregister(self, nick, client_id):
+        with self.lock:
+            if self.nick_to_id.get(nick) == client_id:
+                del self.nick_to_id[nick]
+            if self.id_to_nick.get(client_id) == nick:
+                del self.id_to_nick[client_id]
+                del self.id_to_shard[client_id]
+
+    def isNickRegistered(self, nick):
+        return nick in self.nick_to_id
+
+    def getClientId(self, nick):
+        return self.nick_to_id[nick]
+
+    def getClientNick(self, client_id):
+        return self.id_to_nick[client_id]
+
+    def getShard(self, client_id):
+        return self.id_to_shard[client_id]
+
+    def getClientIds(self, nicks):
+        return dict((nick, self.nick_to_id.get(nick, '')) for nick in nicks)
+
+    def getClientNicks(self, client_ids):
+        return dict((client_id, self.id_to_nick.get(client_id, '')) for client_id in client_ids)
+
+    # Watchers are kept here so a nick leaving one shard reaches watchers on all of them
+    def watchNicks(self, watcher_id, nicks):
+        with self.lock:
+            for nick in nicks:
+                self.nick_to_watchers.setdefault(nick, set()).add(watcher_id)
+            self.watcher_to_nicks.setdefault(watcher_id, set()).update(nicks)
+
+    def unwatchNicks(self, watcher_id):
+        with self.lock:
+            for nick in self.watcher_to_nicks.pop(watcher_id, ()):
+                watchers = self.nick_to_watchers.get(nick)
+                if watchers is not None:
+                    watchers.discard(watcher_id)
+                    if not watchers:
+                        del self.nick_to_watchers[nick]
+
+    def popNickWatchers(self, nick):
+        with self.lock:
+            watchers = self.nick_to_watchers.pop(nick, set())
+            for watcher_id in watchers:
+                nicks = self.watcher_to_nicks.get(watcher_id)
+                if nicks is not None:
+                    nicks.discard(nick)
+            return watchers
+
+
+class DirectoryManager(BaseManager):
+    pass
+
+DirectoryManager.register('ShardDirectory', ShardDirectory)
+
+
+class RemoteShard(object):
+
+    class SendThread(threading.Thread):
+
+        def __init__(self, shard):
+            threading.Thread.__init__(self, daemon=True)
+            self.shard = shard
+            server = shard.server
+            # Backed up frames for the clients on the other shard wait, bar typing notifications.
+            # The link is shared, a client that can't keep up is evicted by its own shard.
+            self.queue = SendQueue(server.send_queue_messages, server.send_queue_bytes, SEND_POLICY_DROP)
+
+        def run(self):
+            while True:
+                # Everything that queued up goes out in the same write
+                frames = self.queue.get()
+                if not frames:
+                    return
+                try:
+                    self.shard.sock.sendMany(frames)
+                except Exception as e:
+                    self.shard.server.notify("shard {0}: error sending to shard {1}".format(self.shard.server.shard,
+                                                                                        self.shard.index))
+                    self.shard.disconnect()
+                    return
+
+    def __init__(self, server, index, path):
+        self.server = server
+        self.index = index
+        self.path = path
+        self.sock = None
+        self.send_thread = RemoteShard.SendThread(self)
+
+    def connect(self):
+        link = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        link.connect(self.path)
+        self.sock = Socket((self.path, self.index), link)
+        self.send_thread.start()
+
+    def disconnect(self):
+        # What is still queued is lost, the next frame for the shard opens a new link
+        self.server.dropShard(self)
+        self.send_thread.queue.close()
+        if self.sock is not None:
+            self.sock.disconnect()
+
+    # Stands in for a HingeClient living on another shard
+    def send(self, message):
+        self.sendFrame(message.json().encode('utf-8'), (message.command in LOW_PRIORITY_COMMANDS) and not message.hasNum())
+
+    def sendFrame(self, frame, low_priority=False):
+        self.send_thread.queue.put(frame, len(frame), low_priority)
+
+    def relayFrame(self, frame, low_priority=False):
+        # The shard the client is on converts it if it has to
+        self.sendFrame(frame, low_priority)
+
+
+class ShardedClientManager(ClientManager):
+
+    def __init__(self, server, directory):
+        # Route IDs carry the shard so they are unique across shards
+        ClientManager.__init__(self, route_prefix=server.shard)
+        self.server = server
+        self.directory = directory
+        self._id_to_shard = {}
+
+    def register(self, client):
+        if not self.directory.register(client.nick, client.id, self.server.shard):
+            raise Exception("client with nick {0} already exists".format(client.nick))
+        ClientManager.register(self, client)
+
+    def remove(self, client):
+        # Drop the nick from the directory before its watchers are told it is gone,
+        # unless the client was already removed
+        if (client.nick is not None) and (self._id_to_client.get(client.id) is client):
+            self.directory.unregister(client.nick, client.id)
+        ClientManager.remove(self, client)
+
+    def isNickRegistered(self, nick):
+        return self.directory.isNickRegistered(nick)
+
+    def getClientId(self, nick):
+        return self.directory.getClientId(nick)
+
+    def getClientNick(self, client_id):
+        return self.directory.getClientNick(client_id)
+
+    def getClientIds(self, nicks):
+        return self.directory.getClientIds(nicks)
+
+    def getClientNicks(self, client_ids):
+        return self.directory.getClientNicks(client_ids)
+
+    def watchNicks(self, watcher_id, nicks):
+        self.directory.watchNicks(watcher_id, nicks)
+
+    def unwatchNicks(self, watcher_id):
+        self.directory.unwatchNicks(watcher_id)
+
+    def popNickWatchers(self, nick):
+        return self.directory.popNickWatchers(nick)
+
+    def getLocalClientById(self, client_id):
+        return ClientManager.getClientById(self, client_id)
+
+    def getShardById(self, client_id):
+        shard = self._id_to_shard.get(client_id)
+        if shard is None:
+            shard = self.directory.getShard(client_id)
+            # Entries of disconnected clients are never invalidated, so cap the cache
+            if len(self._id_to_shard) >= SHARD_ROUTE_CACHE_SIZE:
+                self._id_to_shard.clear()
+            self._id_to_shard[client_id] = shard
+        return shard
+
+    def getClientById(self, client_id):
+        if type(client_id) is int:
+            client = self._routes.get(client_id)
+            # Not ours, or stale. Either way never whoever holds its decimal form here.
+            client_id = str(client_id)
+        else:
+            client = self._id_to_client.get(client_id)
+        if client is not None:
+            return client
+        else:
+            shard = self.getShardById(client_id)
+            if shard == self.server.shard:
+                raise KeyError("client with id {0} does not exist".format(client_id))
+            else:
+                return self.server.getShard(shard)
+
+
+class ShardWorker(TURNServer):
+
+    class LinkThread(threading.Thread):
+
+        def __init__(self, server, sock):
+            threading.Thread.__init__(self, daemon=True)
+            self.server = server
+            self.sock = sock
+
+        def run(self):
+            while True:
+                try:
+                    frame = self.sock.recvFrame()
+                except NetworkError:
+                    return
+                self.server.deliver(frame)
+
+    def __init__(self, listen_port, shard, link_paths, directory, show_console=False,
+                 fast_relay=True, max_frame_size=MAX_FRAME_SIZE,
+                 send_queue_messages=SEND_QUEUE_MAX_MESSAGES, send_queue_bytes=SEND_QUEUE_MAX_BYTES,
+                 send_policy=SEND_POLICY_DISCONNECT, metrics_port=None):
+        TURNServer.__init__(self, listen_port, show_console, fast_relay, max_frame_size,
+                            send_queue_messages, send_queue_bytes, send_policy, metrics_port)
+        self.shard = shard
+        self.link_paths = link_paths
+        # Shards rotate their logs independently
+        self.log_path = 'hingechat.shard{0}.log'.format(shard)
+        self.client_manager = ShardedClientManager(self, directory)
+        self.shards = {}
+        self.shards_lock = threading.Lock()
+
+    def startServer(self, backlog=10):
+        self.notify("Starting shard {0}...".format(self.shard))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Every shard binds the same port and the kernel balances accepts between them
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.sock.bind(('0.0.0.0', self.listen_port))
+            self.sock.listen(backlog)
+        except socket.error as se:
+            self.notify("Failed to start shard {0}: {1}".format(self.shard, se))
+            sys.exit(1)
+        self.startLinks()
+
+    def startLinks(self):
+        self.link_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.link_sock.bind(self.link_paths[self.shard])
+        self.link_sock.listen(len(self.link_paths))
+        threading.Thread(target=self.acceptLinks, daemon=True).start()
+
+    def acceptLinks(self):
+        while True:
+            (link, _) = self.link_sock.accept()
+            link_sock = Socket((self.link_paths[self.shard], self.shard), link)
+            ShardWorker.LinkThread(self, link_sock).start()
+
+    def getShard(self, index):
+        shard = self.shards.get(index)
+        if shard is None:
+            with self.shards_lock:
+                shard = self.shards.get(index)
+                if shard is None:
+                    shard = RemoteShard(self, index, self.link_paths[index])
+                    shard.connect()
+                    self.shards[index] = shard
+        return shard
+
+    def dropShard(self, shard):
+        with self.shards_lock:
+            if self.shards.get(shard.index) is shard:
+                del self.shards[shard.index]
+            else:
+                pass
+
+    def deliver(self, frame):
+        # Frames from other shards are addressed to one of our clients
+        header = Message.peekHeader(frame)
+        if header is None:
+            message = Message.decode(frame)
+            header = (message.command, message.route)
+        (command, route) = header
+        low_priority = (command in LOW_PRIORITY_COMMANDS) and not Message.frameHasNum(frame)
+        try:
+            client = self.client_manager.getLocalClientById(route[1])
+        except KeyError:
+            # The client may have reconnected to another shard since the sender cached its route
+            try:
+                shard = self.client_manager.directory.getShard(str(route[1]))
+            except KeyError:
+                self.notify("shard {0}: dropped frame for unknown id {1}".format(self.shard, route[1]))
+                return
+            if shard != self.shard:
+                self.getShard(shard).sendFrame(frame, low_priority)
+            return
+        client.relayFrame(frame, low_priority)
+
+
+def runShard(listen_port, shard, link_paths, directory, fast_relay, max_frame_size, send_limits,
+             metrics_port):
+    (send_queue_messages, send_queue_bytes, send_policy) = send_limits
+    worker = ShardWorker(listen_port, shard, link_paths, directory,
+                         fast_relay=fast_relay, max_frame_size=max_frame_size,
+                         send_queue_messages=send_queue_messages,
+                         send_queue_bytes=send_queue_bytes,
+                         send_policy=send_policy,
+                         metrics_port=metrics_port)
+    worker.start()
+
+
+class ShardedTURNServer(TURNServer):
+
+    def __init__(self, listen_port, show_console=True, fast_relay=True,
+                 max_frame_size=MAX_FRAME_SIZE, workers=None,
+                 send_queue_messages=SEND_QUEUE_MAX_MESSAGES, send_queue_bytes=SEND_QUEUE_MAX_BYTES,
+                 send_policy=SEND_POLICY_DISCONNECT, metrics_port=None):
+        TURNServer.__init__(self, listen_port, show_console, fast_relay, max_frame_size,
+                            send_queue_messages, send_queue_bytes, send_policy, metrics_port)
+        self.workers = workers or os.cpu_count() or 1
+        self.processes = []
+        self.directory_manager = None
+        self.link_dir = None
+
+    def start(self):
+        self.openLog()
+        self.notify("Starting {0} shards...".format(self.workers))
+        # Make sure the shards are reaped when we are terminated
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.directory_manager = DirectoryManager()
+        self.directory_manager.start()
+        directory = self.directory_manager.ShardDirectory()
+        self.link_dir = tempfile.mkdtemp(prefix='hinge-shards-')
+        link_paths = [os.path.join(self.link_dir, 'shard-{0}.sock'.format(i))
+                      for i in range(self.workers)]
+        for shard in range(self.workers):
+            process = multiprocessing.Process(target=runShard,
+                                              args=(self.listen_port, shard, link_paths,
+                                                    directory, self.fast_relay,
+                                                    self.max_frame_size,
+                                                    (self.send_queue_messages,
+                                                     self.send_queue_bytes,
+                                                     self.send_policy),
+                                                    # Each shard counts its own clients
+                                                    self.__shardMetricsPort(shard)),
+                                              daemon=True)
+            process.start()
+            self.processes.append(process)
+        try:
+            for process in self.processes:
+                process.join()
+        finally:
+            self.stop()
+
+    def __shardMetricsPort(self, shard):
+        if self.metrics_port is None:
+            return None
+        else:
+            return self.metrics_port + shard
+
+    def stop(self):
+        self.notify("Requested to stop server")
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        if self.directory_manager is not None:
+            self.directory_manager.shutdown()
+        if self.link_dir is not None:
+            shutil.rmtree(self.link_dir, ignore_errors=True)
+        # Close log
+        if self.log_file is not None:
+            self.log_file.close()
+        else:
+            pass
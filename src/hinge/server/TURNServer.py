@@ -4,6 +4,9 @@ import sys
 from src.hinge.server.Console import Console
 from src.hinge.server.ClientManager import ClientManager
 from src.hinge.server.HingeClient import HingeClient
+from src.hinge.server.LogWriter import LogWriter
+from src.hinge.server.Metrics import MetricsExporter
+from src.hinge.server.Metrics import ServerMetrics
 from src.hinge.network.Message import Message
 from src.hinge.network.sock import Socket
 from src.hinge.utils import *
@@ -11,22 +14,39 @@ from src.hinge.utils import *
 
 class TURNServer(object):
 
-    def __init__(self, listen_port, show_console=True):
+    def __init__(self, listen_port, show_console=True, fast_relay=True, max_frame_size=MAX_FRAME_SIZE,
+                 send_queue_messages=SEND_QUEUE_MAX_MESSAGES, send_queue_bytes=SEND_QUEUE_MAX_BYTES,
+                 send_policy=SEND_POLICY_DISCONNECT, metrics_port=None):
         self.listen_port = listen_port
         self.show_console = show_console
+        self.fast_relay = fast_relay
+        self.max_frame_size = max_frame_size
+        # Limits on what is buffered for each client, see SendQueue
+        self.send_queue_messages = send_queue_messages
+        self.send_queue_bytes = send_queue_bytes
+        self.send_policy = send_policy
         self.client_manager = ClientManager()
+        self.log_path = 'hingechat.log'
+        self.log_file = None
+        self.metrics = ServerMetrics()
+        # Scraped from localhost only, off unless a port is given
+        self.metrics_port = metrics_port
+        self.metrics_exporter = None
+        self.sock = None
+        self.stopped = False
 
     def openLog(self):
         try:
-            self.log_file = open('hingechat.log', 'a')
+            # Written from a background thread so the disk stays off the relay path
+            self.log_file = LogWriter(self.log_path)
+            self.log_file.start()
         except:
             self.log_file = None
             self.notify("Error opening logfile")
 
     def log(self, message):
         if self.log_file is not None:
-            self.log_file.write('{0}\n'.format(message))
-            self.log_file.flush()
+            self.log_file.write(message)
         else:
             pass
 
@@ -41,29 +61,79 @@ class TURNServer(object):
     def start(self):
         self.openLog()
         self.startServer()
+        self.startMonitoring()
+        try:
+            self.acceptClients()
+        except KeyboardInterrupt:
+            self.stop()
+
+    def acceptClients(self):
         while True:
             # Wait for client to connect
-            (client_sock, client_addr) = self.sock.accept()
+            try:
+                (client_sock, client_addr) = self.sock.accept()
+            except socket.error:
+                # stop() closed the listening socket
+                if self.stopped:
+                    return
+                else:
+                    raise
             # Wrap the socket in our socket object
-            client_sock = Socket(client_addr, client_sock)
+            client_sock = Socket(client_addr, client_sock, self.max_frame_size)
             # Store client's IP and port
             self.notify("Got connection: {0}".format(client_sock))
             new_client = HingeClient(self, client_sock)
-            self.client_manager.add(new_client)
+            try:
+                self.client_manager.add(new_client)
+            except Exception as e:
+                # Drop this one, don't stop accepting the rest
+                self.notify("Dropped connection {0}: {1}".format(client_sock, e))
+                client_sock.disconnect()
+                continue
+            self.metrics.register(new_client)
             new_client.connect()
 
-    def startServer(self):
+    def startServer(self, backlog=10):
         self.notify("Starting server...")
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.sock.bind(('0.0.0.0', self.listen_port))
-            self.sock.listen(10)
+            self.sock.listen(backlog)
         except NetworkError as ne:
             self.notify("Failed to start server")
             sys.exit(1)
 
+    def startMonitoring(self):
+        if self.metrics_port is not None:
+            try:
+                self.metrics_exporter = MetricsExporter(self, self.metrics_port)
+                self.metrics_exporter.start()
+            except socket.error as se:
+                self.notify("Failed to serve metrics on port {0}: {1}".format(self.metrics_port, se))
+        else:
+            pass
+        if self.show_console:
+            Console(self).start()
+        else:
+            pass
+
+    def stopMonitoring(self):
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+            self.metrics_exporter = None
+        else:
+            pass
+
+    def getQueueStats(self):
+        # Send queue depth and high-water marks of every client, to see who is lagging
+        return dict((client.id, client.queueStats()) for client in self.client_manager.clients)
+
     def stop(self):
+        if self.stopped:
+            return
+        else:
+            self.stopped = True
         self.notify("Requested to stop server")
         # Pulse shutdown
         message = Message(COMMAND_END, error=ERR_SERVER_SHUTDOWN)
@@ -72,7 +142,24 @@ class TURNServer(object):
             client.send(message)
         # Pause to ensure message has been received
         time.sleep(0.25)
-        # Close log
+        self.stopMonitoring()
+        self.closeLog()
+        # Last, start() returns once the accept loop ends
+        self.stopListening()
+
+    def stopListening(self):
+        # Shut down first, closing alone doesn't wake a thread blocked in accept()
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+        else:
+            pass
+
+    def closeLog(self):
+        # Writes out what is still pending
         if self.log_file is not None:
             self.log_file.close()
         else:
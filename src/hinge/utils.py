@@ -14,6 +14,61 @@ DEFAULT_RSA_BITS = 4096
 DEFAULT_HASH_TYPE = 'sha512'
 TYPING_TIMEOUT = 1500
 SERVER_ROUTE = '0'
+# The server's route ID in binary frames, never handed out to a client
+SERVER_ROUTE_ID = 0
+SERVER_ROUTES = (SERVER_ROUTE, SERVER_ROUTE_ID)
+# Route IDs are a slot index with a generation above it and the shard above that
+ROUTE_SLOT_BITS = 20
+ROUTE_GENERATION_BITS = 8
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+RECV_BUFFER_SIZE = 16 * 1024
+RECV_BUFFER_SHRINK_FRAMES = 64
+SEND_BATCH_SIZE = 256
+SYNC_REQUEST_TIMEOUT = 30
+# Servers from before frame formats never answer VERSION
+VERSION_ANSWER_TIMEOUT = 2
+CLIENT_MANAGER_LOCK_STRIPES = 64
+SEND_QUEUE_MAX_MESSAGES = 4096
+SEND_QUEUE_MAX_BYTES = 8 * 1024 * 1024
+# How long an evicted client's send thread gets to write the error saying why
+EVICT_GRACE_PERIOD = 0.25
+LOG_FLUSH_BYTES = 64 * 1024
+LOG_FLUSH_INTERVAL = 1.0
+LOG_MAX_BYTES = 16 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_MAX_PENDING = 10000
+LOG_OVERLOAD_SAMPLE = 100
+HISTOGRAM_SUB_BUCKET_BITS = 7
+HISTOGRAM_MAX_VALUE = 3600 * 1000 * 1000
+HISTOGRAM_EXPORT_BITS = 25
+METRICS_LATENCY_SAMPLE = 16
+CONSOLE_SAMPLE_INTERVAL = 1.0
+CONSOLE_TOP_COUNT = 10
+INSTRUMENTATION_SAMPLE = 8
+PROFILE_DURATION = 10
+DH_POOL_SIZE = 4
+DH_POOL_WORKERS = 1
+FIXED_BASE_WINDOW = 7
+# One per core
+SMP_POOL_WORKERS = None
+# Chat messages shorter than this aren't worth compressing
+COMPRESSION_THRESHOLD = 64
+COMPRESSION_LEVEL = 6
+# Per session: a 8 KB window and deflate state of about 40 KB
+COMPRESSION_WINDOW_BITS = 13
+COMPRESSION_MEM_LEVEL = 5
+
+# Send queue overflow policies
+
+SEND_POLICY_BLOCK = 'block'
+SEND_POLICY_DROP = 'drop'
+SEND_POLICY_DISCONNECT = 'disconnect'
+
+SEND_POLICIES = [
+    SEND_POLICY_BLOCK,
+    SEND_POLICY_DROP,
+    SEND_POLICY_DISCONNECT,
+]
 
 # Server commands
 
@@ -23,8 +78,11 @@ COMMAND_ADD = "ADD"
 COMMAND_VERSION = "VERSION"
 COMMAND_REQ_ID = "REQID"
 COMMAND_REQ_NICK = "REQNICK"
+COMMAND_REQ_IDS = "REQIDS"
+COMMAND_REQ_NICKS = "REQNICKS"
 COMMAND_SEND_ID = "SENDID"
 COMMAND_SEND_NICK = "SENDNICK"
+COMMAND_UNREGISTERED = "UNREG"
 
 SYNC_COMMANDS = [
     COMMAND_SEND_ID,
@@ -45,6 +103,76 @@ SESSION_COMMANDS = [
     COMMAND_PUB_KEY,
 ]
 
+# Key exchange, message cipher, SMP codec and compression suites, offered in HELO as
+# "kex,kex;cipher,cipher;codec,codec;compression,compression" and picked in REDY
+# as "kex;cipher;codec;compression"
+
+KEX_X25519 = 'x25519'
+KEX_MODP4096 = 'modp4096'
+
+# In order of preference
+KEX_SUITES = [
+    KEX_X25519,
+    KEX_MODP4096,
+]
+
+CIPHER_CHACHA20_POLY1305 = 'chacha20-poly1305'
+CIPHER_AES_GCM = 'aes256-gcm'
+CIPHER_AES_CBC_HMAC = 'aes256-cbc-hmac'
+
+# In order of preference
+CIPHER_SUITES = [
+    CIPHER_CHACHA20_POLY1305,
+    CIPHER_AES_GCM,
+    CIPHER_AES_CBC_HMAC,
+]
+
+AEAD_CIPHERS = [
+    CIPHER_CHACHA20_POLY1305,
+    CIPHER_AES_GCM,
+]
+
+AEAD_TAG_SIZE = 16
+
+# How SMP integers are packed and hashed. v1 is length prefixed big endian
+# with decimal strings hashed, v2 fixed width with the bytes themselves hashed.
+SMP_CODEC_V1 = 'smp1'
+SMP_CODEC_V2 = 'smp2'
+
+# In order of preference
+SMP_CODECS = [
+    SMP_CODEC_V2,
+    SMP_CODEC_V1,
+]
+
+# Compression of chat messages before they are encrypted. zlib1 is
+# deflate with the first preset dictionary.
+COMPRESSION_NONE = 'none'
+COMPRESSION_ZLIB = 'zlib1'
+
+# In order of preference
+COMPRESSIONS = [
+    COMPRESSION_ZLIB,
+    COMPRESSION_NONE,
+]
+
+# Opt in: the length of a compressed message gives away more about its text
+DEFAULT_COMPRESSIONS = [
+    COMPRESSION_NONE,
+]
+
+# What the data of a compressed command starts with
+COMPRESSION_RAW = b'\x00'
+COMPRESSION_DEFLATED = b'\x01'
+
+# What a client that leaves a kind out of its offer supports
+SUITE_DEFAULTS = [
+    KEX_MODP4096,
+    CIPHER_AES_CBC_HMAC,
+    SMP_CODEC_V1,
+    COMPRESSION_NONE,
+]
+
 # Loop commands
 
 COMMAND_MSG = "MSG"
@@ -65,6 +193,13 @@ SMP_COMMANDS = [
     COMMAND_SMP_4,
 ]
 
+# Loop commands that may be dropped when a connection can't keep up, unless they take
+# a message number: the peer would see a gap in the numbers as a deleted message
+
+LOW_PRIORITY_COMMANDS = [
+    COMMAND_TYPING,
+]
+
 LOOP_COMMANDS = [
     COMMAND_MSG,
     COMMAND_TYPING,
@@ -77,6 +212,53 @@ LOOP_COMMANDS = [
     COMMAND_SMP_4,
 ]
 
+# Loop commands compressed when the session agreed on a compression, SMP
+# values don't compress and shouldn't share a stream with the chat
+
+COMPRESSED_COMMANDS = [
+    COMMAND_MSG,
+]
+
+# Frame formats, the client lists those it reads in VERSION and the
+# server answers with its pick. Clients that list none get JSON.
+
+FRAME_JSON = 'json'
+FRAME_BINARY = 'binary'
+
+# In order of preference
+FRAME_FORMATS = [
+    FRAME_BINARY,
+    FRAME_JSON,
+]
+
+# Binary frames carry the command as its index in here, plus one. Only ever append.
+FRAME_COMMANDS = [
+    COMMAND_REGISTER,
+    COMMAND_RELAY,
+    COMMAND_ADD,
+    COMMAND_VERSION,
+    COMMAND_REQ_ID,
+    COMMAND_REQ_NICK,
+    COMMAND_REQ_IDS,
+    COMMAND_REQ_NICKS,
+    COMMAND_SEND_ID,
+    COMMAND_SEND_NICK,
+    COMMAND_UNREGISTERED,
+    COMMAND_HELO,
+    COMMAND_REDY,
+    COMMAND_REJECT,
+    COMMAND_PUB_KEY,
+    COMMAND_MSG,
+    COMMAND_TYPING,
+    COMMAND_END,
+    COMMAND_ERR,
+    COMMAND_SMP_0,
+    COMMAND_SMP_1,
+    COMMAND_SMP_2,
+    COMMAND_SMP_3,
+    COMMAND_SMP_4,
+]
+
 # Message sources
 
 MSG_SENDER = 0
@@ -111,6 +293,22 @@ SMP_CALLBACK_ERROR = 2
 
 URL_REGEX = r"(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?]))"
 
+# Instrumentation stages, in the order a frame passes through them
+
+STAGE_RECV = 'socket.recv'
+STAGE_DECODE = 'message.decode'
+STAGE_ROUTE = 'server.route'
+STAGE_ENQUEUE = 'server.enqueue'
+STAGE_SEND = 'socket.send'
+STAGE_DECRYPT = 'session.decrypt'
+STAGE_AES_DECRYPT = 'crypto.aes_decrypt'
+STAGE_DISPATCH = 'client.dispatch'
+
+# Stages whose time includes waiting on the network
+BLOCKING_STAGES = [
+    STAGE_RECV,
+]
+
 # Exceptions
 
 class GenericError(Exception):
@@ -169,6 +367,7 @@ TITLE_SMP_MATCH_FAILED = "Eavesdropping Detected"
 TITLE_MESSAGE_REPLAY = "Tampering Detected"
 TITLE_MESSAGE_DELETION = "Tampering Detected"
 TITLE_PROTOCOL_VERSION_MISMATCH = "Incompatible Versions"
+TITLE_SLOW_CONSUMER = "Connection Too Slow"
 
 UNEXPECTED_CLOSE_CONNECTION = "Server unexpectedly closed connection"
 CLOSE_CONNECTION = "The server closed the connection"
@@ -206,6 +405,9 @@ SMP_MATCH_FAILED_SHORT = "Chat authentication failed. Note that answers are case
 MESSAGE_REPLAY = "Warning: Old message recieved multiple times. Someone may be tampering with your conversation."
 MESSAGE_DELETION = "Warning: Message deletion detected. Someone may be tampering with your conversation."
 PROTOCOL_VERSION_MISMATCH = "The server is reporting that you are using an outdated version of the program. Are you running the most recent version?"
+FRAME_TOO_LARGE = "Remote sent a frame larger than %d bytes"
+SYNC_REQUEST_TIMED_OUT = "The server did not answer a lookup in time"
+SLOW_CONSUMER = "The server disconnected you because your connection could not keep up"
 
 # Error codes
 
@@ -231,6 +433,8 @@ ERR_MESSAGE_REPLAY = 18
 ERR_MESSAGE_DELETION = 19
 ERR_PROTOCOL_VERSION_MISMATCH = 20
 ERR_MALFORMED_MESSAGE = 21
+ERR_FRAME_TOO_LARGE = 22
+ERR_SLOW_CONSUMER = 23
 
 # Functions
 
@@ -4,13 +4,13 @@ import traceback
 
 from threading import Thread
 
-from src.hinge.network.connectionManager import ConnectionManager
-from src.hinge.utils import constants
+from src.hinge.network.Client import Client
+from src.hinge.utils import *
 from .waitingMock import WaitingMock
 
 
 class MockClient(Thread):
-    def __init__(self, nick, remoteNick):
+    def __init__(self, nick, remoteNick, port=DEFAULT_PORT):
         Thread.__init__(self)
 
         self.nick = nick
@@ -29,8 +29,23 @@ class MockClient(Thread):
         self.smpRequestCallback = WaitingMock()
         self.errorCallback = WaitingMock()
 
-        self.connectionManager = ConnectionManager(self.nick, ('localhost', constants.DEFAULT_PORT),
-            self.recvMessageCallback, self.newClientCallback, self.handshakeDoneCallback, self.smpRequestCallback, self.errorCallback)
+        self.client = Client(self.nick, ('localhost', port), {
+            'recv': self.recvMessageCallback,
+            'new': self.newClientCallback,
+            'handshake': self.handshakeDoneCallback,
+            'smp': self.smpRequestCallback,
+            'err': self.errorCallback,
+        })
+
+    def waitForRemote(self):
+        # There's no callback for other clients registering so ask the server until it knows the remote
+        deadline = time.time() + WaitingMock.TIMEOUT
+        while time.time() < deadline:
+            remoteId = self.client.getClientId(self.remoteNick)
+            if remoteId:
+                return remoteId
+            time.sleep(0.05)
+        raise AssertionError("%s never registered" % self.remoteNick)
 
     def success(self):
         sys.stdout.write('.')
@@ -50,37 +65,35 @@ class MockClient(Thread):
 
 
 class Client1(MockClient):
-    def __init__(self, nick, remoteNick):
-        MockClient.__init__(self, nick, remoteNick)
+    def __init__(self, nick, remoteNick, port=DEFAULT_PORT):
+        MockClient.__init__(self, nick, remoteNick, port)
 
 
     def run(self):
         try:
-            self.connectionManager.connectToServer()
+            self.client.connectToServer()
+            remoteId = self.waitForRemote()
 
-            # There's no connected to server callback so wait for all mock clients to connect to the server before trying to connect to one
-            time.sleep(1)
+            # Open a session and expect the handshake to complete
+            self.client.openSession(self.remoteNick)
+            self.handshakeDoneCallback.assert_called_with_wait(remoteId)
 
-            # Open the chat again and expect success
-            self.connectionManager.openChat(self.remoteNick)
-            self.handshakeDoneCallback.assert_called_with_wait(self.remoteNick)
-
-            client = self.connectionManager.getClient(self.remoteNick)
+            session = self.client.getSession(remoteId)
 
             # Send two regular chat messages
-            client.sendChatMessage(self.message1)
-            client.sendChatMessage(self.message2)
+            session.sendChatMessage(self.message1)
+            session.sendChatMessage(self.message2)
 
-            # Expect client 1 to send two typing messages
-            self.recvMessageCallback.assert_called_with_wait(constants.COMMAND_TYPING, self.remoteNick, str(constants.TYPING_STOP_WITHOUT_TEXT))
-            self.recvMessageCallback.assert_called_with_wait(constants.COMMAND_TYPING, self.remoteNick, str(constants.TYPING_START))
+            # Expect client 2 to send two typing messages
+            self.recvMessageCallback.assert_called_with_wait(COMMAND_TYPING, remoteId, str(TYPING_START))
+            self.recvMessageCallback.assert_called_with_wait(COMMAND_TYPING, remoteId, str(TYPING_STOP_WITHOUT_TEXT))
 
             # Start an SMP request
-            client.initiateSMP(self.smpQuestion, self.smpAnswer)
-            self.smpRequestCallback.assert_called_with_wait(constants.SMP_CALLBACK_COMPLETE, self.remoteNick)
+            session.initiateSmp(self.smpQuestion, self.smpAnswer)
+            self.smpRequestCallback.assert_called_with_wait(SMP_CALLBACK_COMPLETE, remoteId)
 
-            # End the connection
-            client.disconnect()
+            # End the session
+            session.disconnect()
 
             self.success()
         except AssertionError as err:
@@ -92,41 +105,41 @@ class Client1(MockClient):
 
 
 class Client2(MockClient):
-    def __init__(self, nick, remoteNick):
-        MockClient.__init__(self, nick, remoteNick)
+    def __init__(self, nick, remoteNick, port=DEFAULT_PORT):
+        MockClient.__init__(self, nick, remoteNick, port)
 
 
     def run(self):
         try:
-            self.connectionManager.connectToServer()
+            self.client.connectToServer()
+            remoteId = self.waitForRemote()
 
-            # Expect client 1 to open a chat with us and then accept it
-            self.newClientCallback.assert_called_with_wait(self.remoteNick)
-            self.connectionManager.newClientAccepted(self.remoteNick)
-            self.handshakeDoneCallback.assert_called_with_wait(self.remoteNick)
+            # Expect client 1 to open a session with us and then accept it
+            self.newClientCallback.assert_called_with_wait(remoteId)
+            self.client.newClientAccepted(remoteId)
+            self.handshakeDoneCallback.assert_called_with_wait(remoteId)
 
             # Expect client 1 to send us two messages
-            # Message 1 should arrive first so check for message 2 since the callbacks are stored in a stack
-            self.recvMessageCallback.assert_called_with_wait(constants.COMMAND_MSG, self.remoteNick, self.message2)
-            self.recvMessageCallback.assert_called_with_wait(constants.COMMAND_MSG, self.remoteNick, self.message1)
+            self.recvMessageCallback.assert_called_with_wait(COMMAND_MSG, remoteId, self.message1)
+            self.recvMessageCallback.assert_called_with_wait(COMMAND_MSG, remoteId, self.message2)
 
-            client = self.connectionManager.getClient(self.remoteNick)
+            session = self.client.getSession(remoteId)
 
             # Send the typing command and then the stop typing command
-            client.sendTypingMessage(constants.TYPING_START)
-            client.sendTypingMessage(constants.TYPING_STOP_WITHOUT_TEXT)
+            session.sendTypingMessage(TYPING_START)
+            session.sendTypingMessage(TYPING_STOP_WITHOUT_TEXT)
 
             # Expect an SMP request
-            self.smpRequestCallback.assert_called_with_wait(constants.SMP_CALLBACK_REQUEST, self.remoteNick, self.smpQuestion)
-            client.respondSMP(self.smpAnswer)
+            self.smpRequestCallback.assert_called_with_wait(SMP_CALLBACK_REQUEST, remoteId, self.smpQuestion)
+            self.client.respondSmp(remoteId, self.smpAnswer)
 
-            # Expec client 1 to end the connection
-            self.recvMessageCallback.assert_called_with_wait(constants.COMMAND_END, self.remoteNick, None)
+            # Expect client 1 to end the session
+            self.errorCallback.assert_called_with_wait(remoteId, ERR_CONN_ENDED)
 
             self.success()
         except AssertionError as err:
             self.failure()
             self.exceptions.append((err, traceback.format_exc()))
-        except:
+        except Exception as err:
             self.exception()
             self.exceptions.append((err, traceback.format_exc()))
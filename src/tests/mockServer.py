@@ -1,16 +1,20 @@
+import os
+import tempfile
+
 from threading import Thread
 
-from src.hinge.server.turnServer import TURNServer
-from src.hinge.utils import constants
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.utils import *
 
 
 class MockServer(Thread):
-    def __init__(self):
+    def __init__(self, port=DEFAULT_PORT):
         Thread.__init__(self)
         self.daemon = True
-        self.server = None
+        self.server = TURNServer(port, show_console=False)
+        # Keep the log out of the working tree
+        self.server.log_path = os.path.join(tempfile.mkdtemp(prefix='hinge-test-'), 'hingechat.log')
 
 
     def run(self):
-        self.server = TURNServer(constants.DEFAULT_PORT, showConsole=False)
         self.server.start()
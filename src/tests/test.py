@@ -1,7 +1,10 @@
-#! /usr/bin/env python2.7
+#! /usr/bin/env python3
 
+import socket
 import sys
+import time
 
+from src.hinge.utils import *
 from .mockServer import MockServer
 from .mockClient import MockClient, Client1, Client2
 
@@ -12,8 +15,12 @@ def test():
     serverThread.start()
 
     # Wait for the server to start
-    while not hasattr(serverThread.server, 'serversock'):
-        pass
+    while True:
+        try:
+            socket.create_connection(('localhost', DEFAULT_PORT)).close()
+            break
+        except socket.error:
+            time.sleep(0.05)
 
     clients = [
         Client1('alice', 'bob'),
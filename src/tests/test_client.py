@@ -0,0 +1,107 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from src.hinge.network.Client import Client
+from src.hinge.network.Message import Message
+from src.hinge.network.sock import Socket
+from src.hinge.utils import *
+
+
+def connectedClient():
+    (left, right) = socket.socketpair()
+    client = Client('alice', ('server', 0), {'err': lambda *args: None, 'new': lambda *args: None})
+    client.sock = Socket(('server', 0), left)
+    client.send_thread.start()
+    client.recv_thread.start()
+    return (client, Socket(('client', 0), right))
+
+def answer(server, request, data):
+    reply = Message(COMMAND_SEND_ID if request.command == COMMAND_REQ_ID else COMMAND_SEND_NICK,
+                    (SERVER_ROUTE, request.route[0]), data, num=request.num)
+    server.send(reply.json())
+
+def test_responses_matched_by_request_id():
+    (client, server) = connectedClient()
+    lookups = [client.requestClientId('bob'), client.requestClientNick('42'), client.requestClientId('carol')]
+    requests = [Message.createFromJson(server.recv()) for lookup in lookups]
+    # Answer out of order
+    answer(server, requests[2], '7')
+    answer(server, requests[0], '5')
+    answer(server, requests[1], 'dave')
+    assert [lookup.result(5) for lookup in lookups] == ['5', 'dave', '7']
+    assert client.requests == {}
+
+def test_malformed_frames_skipped():
+    (client, server) = connectedClient()
+    lookup = client.requestClientId('bob')
+    request = Message.createFromJson(server.recv())
+    server.send(b'{"command": "SENDID", "route": ["0", "1"], "data": ')
+    server.send(Message(COMMAND_ERR, (SERVER_ROUTE, '1'), error='x').json())
+    answer(server, request, '5')
+    assert lookup.result(5) == '5'
+
+def test_pending_requests_fail_on_disconnect():
+    (client, server) = connectedClient()
+    lookup = client.requestClientId('bob')
+    server.recv()
+    server.disconnect()
+    with pytest.raises(NetworkError):
+        client._waitForResp(lookup, 5)
+
+def test_unanswered_request_times_out():
+    (client, server) = connectedClient()
+    with pytest.raises(NetworkError):
+        client._waitForResp(client.requestClientId('bob'), 0.05)
+    assert client.requests == {}
+
+def test_batch_lookup_fills_cache_until_unregistered():
+    (client, server) = connectedClient()
+    lookup = client.requestClientIds(['bob', 'carol'])
+    request = Message.createFromJson(server.recv())
+    assert request.command == COMMAND_REQ_IDS
+    assert json.loads(request.data) == ['bob', 'carol']
+    answer(server, request, json.dumps({'bob': '5', 'carol': ''}))
+    assert json.loads(lookup.result(5)) == {'bob': '5', 'carol': ''}
+    assert client.getClientIds(['bob']) == {'bob': '5'}
+    server.send(Message(COMMAND_UNREGISTERED, (SERVER_ROUTE, client.id), 'bob').json())
+    deadline = time.time() + 5
+    while ('bob' in client.nick_cache) and (time.time() < deadline):
+        time.sleep(0.01)
+    assert 'bob' not in client.nick_cache
+
+def test_switches_to_the_frame_format_the_server_picks():
+    (client, server) = connectedClient()
+    assert client.frame_format == FRAME_JSON
+    server.send(Message(COMMAND_VERSION, (SERVER_ROUTE, client.id), FRAME_BINARY, num='1048577').json())
+    deadline = time.time() + 5
+    while (client.frame_format != FRAME_BINARY) and (time.time() < deadline):
+        time.sleep(0.01)
+    # Along with the ID the server gave it
+    assert client.id == '1048577'
+    client.requestClientId('bob')
+    frame = server.recvFrame()
+    assert Message.frameFormat(frame) == FRAME_BINARY
+    assert Message.peekHeader(frame)[1] == (1048577, SERVER_ROUTE_ID)
+    assert Message.decode(frame).data == 'bob'
+
+def test_registers_under_the_id_the_server_gives():
+    listener = socket.create_server(('127.0.0.1', 0))
+    client = Client('alice', listener.getsockname(), {'err': lambda *args: None},
+                    kex_suites=[KEX_X25519])
+    connecting = threading.Thread(target=client.connectToServer)
+    connecting.start()
+    server = Socket(('client', 0), listener.accept()[0])
+    version = Message.decode(server.recvFrame())
+    assert version.command == COMMAND_VERSION
+    # Nothing else goes out until the answer is in
+    time.sleep(0.2)
+    assert connecting.is_alive()
+    server.send(Message(COMMAND_VERSION, (SERVER_ROUTE, version.route[0]), FRAME_JSON, num='1048577').json())
+    connecting.join(5)
+    registration = Message.decode(server.recvFrame())
+    assert (registration.command, registration.route[0]) == (COMMAND_REGISTER, '1048577')
+    listener.close()
@@ -0,0 +1,136 @@
+import threading
+
+import pytest
+
+from src.hinge.server.ClientManager import ClientManager
+from src.hinge.server.ClientManager import RouteTable
+from src.hinge.server.HingeClient import Connection
+from src.hinge.utils import *
+
+
+class FakeClient(Connection):
+
+    def __init__(self, manager, nick):
+        Connection.__init__(self, manager, '127.0.0.1')
+        self.nick = nick
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+def managerWith(*nicks):
+    manager = ClientManager()
+    clients = [FakeClient(manager, nick) for nick in nicks]
+    for client in clients:
+        manager.add(client)
+        manager.register(client)
+    return (manager, clients)
+
+def test_batch_lookups():
+    (manager, (alice, bob)) = managerWith('alice', 'bob')
+    assert manager.getClientIds(['alice', 'bob', 'carol']) == {'alice': alice.id, 'bob': bob.id, 'carol': ''}
+    assert manager.getClientNicks([bob.id, 'nobody']) == {bob.id: 'bob', 'nobody': ''}
+
+def test_clients_found_by_route_id():
+    (manager, (alice, bob)) = managerWith('alice', 'bob')
+    assert alice.id == str(alice.route_id)
+    assert manager.getClientById(bob.route_id) is manager.getClientById(bob.id) is bob
+    # Clients that pick their own ID give up theirs
+    manager.updateClientId(alice.id, '8794656763062')
+    assert alice.route_id is None
+    assert manager.getClientById('8794656763062') is alice
+    manager.remove(alice)
+    manager.remove(bob)
+    assert len(manager._routes) == 0
+
+def test_stale_route_ids_miss():
+    manager = ClientManager(route_prefix=16)
+    (alice, bob) = (FakeClient(manager, 'alice'), FakeClient(manager, 'bob'))
+    for client in (alice, bob):
+        manager.add(client)
+    stale = alice.route_id
+    manager.remove(alice)
+    # Too wide to be a route ID in a frame, so bob may pick it
+    manager.updateClientId(bob.id, str(stale))
+    with pytest.raises(KeyError):
+        manager.getClientById(stale)
+    assert manager.getClientById(str(stale)) is bob
+
+def test_picked_ids_kept_out_of_route_ids():
+    (manager, (alice, bob)) = managerWith('alice', 'bob')
+    next_id = '3'
+    with pytest.raises(Exception):
+        manager.updateClientId(alice.id, next_id)
+    manager.add(FakeClient(manager, 'carol'))
+    assert manager.getClientById(next_id).nick == 'carol'
+
+def test_reused_slots_miss_stale_ids():
+    table = RouteTable(prefix=3)
+    (first, second) = (object(), object())
+    stale = table.add(first)
+    assert stale >> (ROUTE_SLOT_BITS + ROUTE_GENERATION_BITS) == 3
+    table.remove(stale)
+    fresh = table.add(second)
+    assert (fresh != stale) and ((fresh ^ stale) & ((1 << ROUTE_SLOT_BITS) - 1) == 0)
+    assert (table.get(stale), table.get(fresh)) == (None, second)
+    with pytest.raises(KeyError):
+        table.remove(stale)
+
+def test_watchers_told_when_nick_goes_away():
+    (manager, (alice, bob, carol)) = managerWith('alice', 'bob', 'carol')
+    manager.watchNicks(alice.id, ['bob'])
+    manager.watchNicks(carol.id, ['bob'])
+    manager.remove(carol)
+    manager.remove(bob)
+    assert [(message.command, message.data) for message in alice.sent] == [(COMMAND_UNREGISTERED, 'bob')]
+    assert manager._nick_to_watchers == {}
+    assert manager._watcher_to_nicks == {alice.id: set()}
+
+def test_only_one_client_gets_a_contended_nick():
+    manager = ClientManager()
+    contenders = [FakeClient(manager, 'bob') for i in range(16)]
+    winners = []
+
+    def claim(client):
+        manager.add(client)
+        try:
+            manager.register(client)
+            winners.append(client)
+        except Exception:
+            pass
+
+    threads = [threading.Thread(target=claim, args=(client,)) for client in contenders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(winners) == 1
+    assert manager.getClientByNick('bob') is winners[0]
+
+def test_renamed_client_is_always_reachable():
+    (manager, (alice,)) = managerWith('alice')
+    names = ['alice{0}'.format(i) for i in range(2000)]
+    misses = []
+    done = threading.Event()
+
+    def lookup():
+        while not done.is_set():
+            ids = manager.ids
+            nicks = manager.nicks
+            # Mid-rename both names may be there, but never neither
+            if (not ids) or (not nicks):
+                misses.append((ids, nicks))
+
+    reader = threading.Thread(target=lookup)
+    reader.start()
+    nick = 'alice'
+    for new_nick in names:
+        manager.updateClientNick(nick, new_nick)
+        manager.updateClientId(alice.id, 'id' + new_nick)
+        nick = new_nick
+    done.set()
+    reader.join()
+    assert misses == []
+    assert manager.getClientById('id' + nick) is alice
+    assert manager.getClientsByIp('127.0.0.1') == [alice]
@@ -0,0 +1,70 @@
+import socket
+import time
+
+import pytest
+
+from src.hinge.network.Message import Message
+from src.hinge.network.sock import Socket
+from src.hinge.server.HingeClient import HingeClient
+from src.hinge.server.TURNServer import TURNServer
+from src.hinge.utils import *
+
+
+def connectedClient(server):
+    # A server-side client talking to a socket the test holds the other end of
+    (left, right) = socket.socketpair()
+    client = HingeClient(server, Socket(('client', 0), left))
+    server.client_manager.add(client)
+    server.metrics.register(client)
+    client.connect()
+    return (client, Socket(('server', 0), right))
+
+def register(client, peer, nick):
+    peer.send(Message(COMMAND_VERSION, (client.id, SERVER_ROUTE), PROTOCOL_VERSION, num=FRAME_JSON).json())
+    peer.recvFrame()
+    peer.send(Message(COMMAND_REGISTER, (client.id, SERVER_ROUTE), nick).json())
+    # Nothing comes back, wait for the server to get to it
+    deadline = time.monotonic() + 5
+    while (not client.manager.isNickRegistered(nick)) and (time.monotonic() < deadline):
+        time.sleep(0.01)
+
+def test_hanging_up_gives_up_the_route_id():
+    server = TURNServer(0, show_console=False)
+    (client, peer) = connectedClient(server)
+    register(client, peer, 'alice')
+    peer.disconnect()
+    client.recv_thread.join(5)
+    assert server.client_manager.clients == []
+    assert server.client_manager.nicks == []
+    assert len(server.client_manager._routes) == 0
+    assert server.metrics.liveClients() == []
+
+def test_client_that_stops_reading_is_evicted():
+    server = TURNServer(0, show_console=False, send_queue_messages=20, send_queue_bytes=64 * 1024)
+    (client, peer) = connectedClient(server)
+    register(client, peer, 'slow')
+    frame = Message(COMMAND_MSG, (SERVER_ROUTE, client.id), 'x' * 4096).json().encode()
+    # The peer never reads, so the send thread ends up stuck writing to it before the queue fills
+    for i in range(5000):
+        if client.send_thread.queue.closed:
+            break
+        client.sendFrame(frame)
+        time.sleep(0.001)
+    client.send_thread.join(5)
+    assert not client.send_thread.is_alive()
+    assert server.client_manager.nicks == []
+    assert server.client_manager.clients == []
+
+def test_malformed_frames_not_relayed():
+    server = TURNServer(0, show_console=False)
+    ((alice, alice_peer), (bob, bob_peer)) = (connectedClient(server), connectedClient(server))
+    register(alice, alice_peer, 'alice')
+    register(bob, bob_peer, 'bob')
+    # A header the fast relay takes, followed by a cut off body
+    frame = Message(COMMAND_MSG, (alice.id, bob.id), 'hello').json().encode()
+    alice_peer.send(frame[:-10])
+    alice.recv_thread.join(5)
+    assert server.client_manager.nicks == ['bob']
+    bob_peer.sock.settimeout(0.2)
+    with pytest.raises(NetworkError):
+        bob_peer.recvFrame()
@@ -0,0 +1,50 @@
+import inspect
+
+from src.hinge import instrumentation
+from src.hinge.instrumentation import StageProfiler
+from src.hinge.network.Message import Message
+from src.hinge.network.sock import AsyncSocket
+from src.hinge.network.sock import Socket
+from src.hinge.server.ClientManager import ClientManager
+from src.hinge.utils import *
+
+
+def decodeAndRoute(count):
+    frame = Message(COMMAND_MSG, ('alice', 'bob'), 'hi').json()
+    manager = ClientManager()
+    for i in range(count):
+        Message.createFromJson(frame)
+        try:
+            manager.getClientById('bob')
+        except KeyError:
+            pass
+
+def test_hooks_installed_only_while_registered():
+    originals = (Socket.__dict__['recvFrame'], AsyncSocket.__dict__['recvFrame'])
+    seen = []
+    hook = lambda stage, elapsed: seen.append(stage)
+    instrumentation.addHook(hook, sample=1)
+    try:
+        assert Socket.__dict__['recvFrame'] is not originals[0]
+        assert inspect.iscoroutinefunction(AsyncSocket.recvFrame)
+        decodeAndRoute(1)
+    finally:
+        instrumentation.removeHook(hook)
+    assert (Socket.__dict__['recvFrame'], AsyncSocket.__dict__['recvFrame']) == originals
+    assert isinstance(Message.__dict__['createFromJson'], staticmethod)
+    assert seen == [STAGE_DECODE, STAGE_ROUTE]
+    decodeAndRoute(1)
+    assert len(seen) == 2
+
+def test_profiler_samples_and_reports():
+    profiler = StageProfiler(sample=4)
+    profiler.start()
+    try:
+        decodeAndRoute(100)
+    finally:
+        profiler.stop()
+    assert profiler.stages[STAGE_DECODE].count() == 25
+    lines = profiler.report().splitlines()
+    rows = dict((line.split()[0], line.split()) for line in lines[1:-1])
+    assert sorted(rows) == [STAGE_DECODE, STAGE_ROUTE]
+    assert rows[STAGE_DECODE][1] == '100'
@@ -0,0 +1,49 @@
+import base64
+
+import pytest
+
+from src.hinge.crypto.CryptoUtils import CryptoUtils
+from src.hinge.crypto.CryptoUtils import formatSuites
+from src.hinge.crypto.CryptoUtils import negotiateSuites
+from src.hinge.utils import *
+
+
+def test_negotiation_prefers_our_order():
+    offer = formatSuites([KEX_MODP4096, KEX_X25519], [CIPHER_AES_CBC_HMAC, CIPHER_AES_GCM])
+    assert negotiateSuites(offer, KEX_SUITES, CIPHER_SUITES) == (KEX_X25519, CIPHER_AES_GCM)
+    assert negotiateSuites('x25519;aes256-gcm', [KEX_MODP4096], CIPHER_SUITES) == (None, CIPHER_AES_GCM)
+    # Older clients don't offer anything
+    assert negotiateSuites('', KEX_SUITES, CIPHER_SUITES) == (KEX_MODP4096, CIPHER_AES_CBC_HMAC)
+    assert negotiateSuites('', [KEX_X25519], [CIPHER_AES_GCM]) == (None, None)
+    # Clients that don't know SMP codecs only speak v1
+    assert negotiateSuites('x25519;aes256-gcm', KEX_SUITES, CIPHER_SUITES, SMP_CODECS) == \
+        (KEX_X25519, CIPHER_AES_GCM, SMP_CODEC_V1)
+    offer = formatSuites(KEX_SUITES, CIPHER_SUITES, SMP_CODECS)
+    assert negotiateSuites(offer, KEX_SUITES, CIPHER_SUITES, SMP_CODECS)[2] == SMP_CODEC_V2
+
+def test_compression_only_when_both_opt_in():
+    ours = (KEX_SUITES, CIPHER_SUITES, SMP_CODECS)
+    both = formatSuites(*(ours + (COMPRESSIONS,)))
+    assert negotiateSuites(both, *(ours + (COMPRESSIONS,)))[3] == COMPRESSION_ZLIB
+    assert negotiateSuites(both, *(ours + (DEFAULT_COMPRESSIONS,)))[3] == COMPRESSION_NONE
+    assert negotiateSuites(formatSuites(*ours), *(ours + (COMPRESSIONS,)))[3] == COMPRESSION_NONE
+
+def test_x25519_agreement():
+    (alice, bob) = (CryptoUtils(), CryptoUtils())
+    for crypto in (alice, bob):
+        crypto.generateDHKey(suite=KEX_X25519)
+    # As PrivateSession sends it
+    encoded = base64.b64encode(alice.exportDHPubKey())
+    assert len(encoded) == 44
+    bob.computeDHSecret(bob.importDHPubKey(base64.b64decode(encoded)))
+    alice.computeDHSecret(alice.importDHPubKey(bob.exportDHPubKey()))
+    assert alice.aesKey == bob.aesKey
+    assert alice.aesDecrypt(bob.aesEncrypt(b'hello')) == b'hello'
+
+def test_bad_x25519_key():
+    crypto = CryptoUtils()
+    crypto.generateDHKey(suite=KEX_X25519)
+    with pytest.raises(CryptoError):
+        crypto.importDHPubKey(b'short')
+    with pytest.raises(CryptoError):
+        crypto.computeDHSecret(b'\0' * 32)
@@ -0,0 +1,56 @@
+import time
+
+from src.hinge.crypto.CryptoUtils import CryptoUtils
+from src.hinge.crypto.KeyPool import KeyPool
+from src.hinge.utils import *
+
+
+# Small enough that generating a key costs nothing
+P = 2 ** 127 - 1
+G = 3
+
+
+def waitForKeys(pool, count, timeout=30):
+    deadline = time.time() + timeout
+    while (pool.stats()['ready'] < count) and (time.time() < deadline):
+        time.sleep(0.01)
+    assert pool.stats()['ready'] == count
+
+def test_keys_come_from_the_pool_once():
+    pool = KeyPool(size=2, p=P, g=G)
+    pool.start()
+    try:
+        waitForKeys(pool, 2)
+        (first, second) = (pool.get(), pool.get())
+        assert first.priv_key != second.priv_key
+        assert first.pub_key == pow(G, first.priv_key, P)
+        assert first.computeKey(second.pub_key) == second.computeKey(first.pub_key)
+        # Taken keys are replaced in the background
+        waitForKeys(pool, 2)
+        stats = pool.stats()
+        assert (stats['hits'], stats['misses'], stats['refills']) == (2, 0, 4)
+        assert stats['refill_lag_max'] > 0
+    finally:
+        pool.close()
+
+def test_empty_pool_generates_inline():
+    pool = KeyPool(size=0, p=P, g=G)
+    pool.start()
+    crypto = CryptoUtils()
+    crypto.generateDHKey(pool)
+    assert crypto.getDHPubKey() == pow(G, crypto.dh.priv_key, P)
+    stats = pool.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (0, 1, 0.0)
+    assert pool.executor is None
+
+def test_started_on_first_use():
+    pool = KeyPool(size=2, p=P, g=G)
+    try:
+        assert pool.executor is None
+        # Nothing ready yet, the first key is generated inline
+        key = pool.get()
+        assert key.pub_key == pow(G, key.priv_key, P)
+        assert pool.stats()['misses'] == 1
+        waitForKeys(pool, 2)
+    finally:
+        pool.close()
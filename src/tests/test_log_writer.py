@@ -0,0 +1,74 @@
+import os
+import time
+
+from src.hinge.server.LogWriter import LogWriter
+from src.hinge.utils import *
+
+
+def readLines(path):
+    with open(path) as log:
+        return log.read().splitlines()
+
+def test_records_written_in_order_on_close(tmp_path):
+    path = str(tmp_path / 'hinge.log')
+    writer = LogWriter(path, flush_interval=60)
+    writer.start()
+    for i in range(1000):
+        writer.write('record {0}'.format(i))
+    writer.close()
+    assert readLines(path) == ['record {0}'.format(i) for i in range(1000)]
+
+def test_rotates_by_size(tmp_path):
+    path = str(tmp_path / 'hinge.log')
+    writer = LogWriter(path, max_bytes=100, backups=2, flush_bytes=1)
+    writer.start()
+    for i in range(50):
+        writer.write('record {0:04d}'.format(i))
+        # One batch per record so every rotation point is hit
+        while writer.pending:
+            time.sleep(0.001)
+    writer.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['hinge.log', 'hinge.log.1', 'hinge.log.2']
+    assert os.path.getsize(path + '.1') <= 100 + len('record 0000\n')
+    # The newest records survive
+    assert readLines(path)[-1] == 'record 0049'
+
+def test_overload_samples_instead_of_blocking(tmp_path):
+    path = str(tmp_path / 'hinge.log')
+    # Not started, so nothing drains
+    writer = LogWriter(path, max_pending=10)
+    for i in range(10 + 10 * LOG_OVERLOAD_SAMPLE):
+        writer.write('record {0}'.format(i))
+    assert len(writer.pending) == 20
+    writer.start()
+    writer.close()
+    lines = readLines(path)
+    assert len(lines) == 21
+    assert lines[-1] == "Log overloaded, dropped {0} records".format(10 * (LOG_OVERLOAD_SAMPLE - 1))
+
+def test_size_counted_in_bytes(tmp_path):
+    path = str(tmp_path / 'hinge.log')
+    writer = LogWriter(path, max_bytes=1000, backups=1)
+    writer._LogWriter__writeLines(['é' * 300 + '\n'])
+    assert writer.size == os.path.getsize(path) == 601
+    writer._LogWriter__writeLines(['é' * 250 + '\n'])
+    # Past max_bytes in bytes though not in characters
+    assert os.path.exists(path + '.1')
+    writer.close()
+
+def test_survives_failing_to_reopen_after_rotation(tmp_path, monkeypatch):
+    path = str(tmp_path / 'hinge.log')
+    writer = LogWriter(path, max_bytes=20, backups=1)
+
+    def unavailable(*args, **kwargs):
+        raise OSError("disk gone")
+
+    monkeypatch.setattr('builtins.open', unavailable)
+    writer._LogWriter__writeLines(['record 0000, long enough to rotate\n'])
+    # Dropped, the writer carries on
+    writer._LogWriter__writeLines(['record 0001\n'])
+    monkeypatch.undo()
+    writer._LogWriter__writeLines(['record 0002\n'])
+    writer.close()
+    assert readLines(path) == ['record 0002']
+    assert readLines(path + '.1') == ['record 0000, long enough to rotate']
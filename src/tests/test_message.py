@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from src.hinge.network.Message import Message
+from src.hinge.utils import *
+
+
+def encrypted():
+    message = Message(COMMAND_MSG, ('alice', 'bob'))
+    message.setEncryptedData(os.urandom(48))
+    message.setBinaryHmac(os.urandom(32))
+    message.setBinaryMessageNum(os.urandom(16))
+    return message
+
+def fields(message):
+    return (message.command, message.route, message.getEncryptedDataAsBinaryString(),
+            message.getHmacAsBinaryString(), message.error, message.getMessageNumAsBinaryString())
+
+def test_binary_round_trip():
+    message = encrypted()
+    frame = message.binary()
+    assert Message.frameFormat(frame) == FRAME_BINARY
+    assert len(frame) < len(message.json())
+    assert fields(Message.decode(frame)) == fields(message)
+    # Plain fields come back as text
+    plain = Message.decode(Message(COMMAND_REQ_ID, ('alice', SERVER_ROUTE), 'bob', num='7').binary())
+    assert (plain.command, plain.data, plain.num, plain.raw_data) == (COMMAND_REQ_ID, 'bob', '7', None)
+
+def test_formats_convert_both_ways():
+    message = encrypted()
+    # As the server relays between clients reading different formats
+    from_json = Message.decode(Message.decode(message.json()).binary())
+    from_binary = Message.decode(Message.decode(message.binary()).json().encode())
+    assert fields(from_json) == fields(from_binary) == fields(message)
+
+def test_peek_header():
+    message = Message(COMMAND_TYPING, ('alice', 'bob'), '0')
+    header = (COMMAND_TYPING, ('alice', 'bob'))
+    assert Message.peekHeader(message.binary()) == Message.peekHeader(message.json().encode()) == header
+    assert Message.peekHeader(message.binary()[:4]) is None
+
+def test_numeric_routes_sent_as_ids():
+    message = Message(COMMAND_TYPING, ('1048577', SERVER_ROUTE), '0')
+    frame = message.binary()
+    assert len(frame) < len(Message(COMMAND_TYPING, ('alice', 'bob'), '0').binary())
+    assert Message.peekHeader(frame) == (COMMAND_TYPING, (1048577, SERVER_ROUTE_ID))
+    assert Message.decode(frame).route == ('1048577', SERVER_ROUTE)
+    # Anything that wouldn't come back the same is sent as a string
+    for route in ('01', '4294967296', '\u0661'):
+        assert Message.decode(Message(COMMAND_TYPING, (route, '1'), '0').binary()).route == (route, '1')
+
+def test_malformed_binary_frames():
+    frame = encrypted().binary()
+    for bad in (frame[:-1], frame + b'\0', frame[:1] + b'\xff' + frame[2:]):
+        with pytest.raises(ValueError):
+            Message.decode(bad)
+    # Text fields that aren't UTF-8, caught up front rather than when first read
+    text = Message(COMMAND_ERR, ('alice', 'bob'), 'x', error='7').binary()
+    for bad in (text.replace(b'x', b'\xff'), text.replace(b'7', b'\xc3')):
+        with pytest.raises(ValueError):
+            Message.decode(bad)
+
+def test_well_formed_frames():
+    message = encrypted()
+    message.route = ('a"\\b\n\u00e9', '1')
+    message.error = '\t\u2603'
+    for frame_format in FRAME_FORMATS:
+        frame = message.encode(frame_format)
+        assert Message.isWellFormed(frame)
+        # What fast relays check is what the peer will decode
+        for bad in (frame[:-1], frame + b'\0', frame[:1] + b'\xff' + frame[2:], frame[:40] + b'\\x' + frame[40:]):
+            assert not Message.isWellFormed(bad)
+            with pytest.raises(ValueError):
+                Message.decode(bad)
+
+def test_unchanged_messages_reuse_their_frame():
+    frame = encrypted().binary()
+    message = Message.decode(frame)
+    assert not hasattr(message, '__dict__')
+    assert message.encode(FRAME_BINARY) is frame
+    # Changing the route leaves the fields that were still in the old frame
+    data = Message.decode(frame).getEncryptedDataAsBinaryString()
+    message.route = ('bob', 'alice')
+    assert message.getEncryptedDataAsBinaryString() == data
+    relayed = Message.decode(message.encode(FRAME_BINARY))
+    assert (relayed.route, relayed.getEncryptedDataAsBinaryString()) == (('bob', 'alice'), data)
+    json_frame = message.encode(FRAME_JSON)
+    assert message.encode(FRAME_JSON) is json_frame
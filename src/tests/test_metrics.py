@@ -0,0 +1,77 @@
+import random
+import urllib.request
+
+from src.hinge.server.Metrics import ClientMetrics
+from src.hinge.server.Metrics import Histogram
+from src.hinge.server.Metrics import MetricsExporter
+from src.hinge.server.Metrics import ServerMetrics
+from src.hinge.utils import *
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.metrics = ClientMetrics()
+
+    def queueStats(self):
+        return {'messages': 2, 'bytes': 100, 'dropped': 1}
+
+
+class FakeServer(object):
+
+    def __init__(self):
+        self.metrics = ServerMetrics()
+
+
+def test_histogram_buckets_cover_every_value_once():
+    histogram = Histogram(sub_bucket_bits=4)
+    previous = -1
+    for index in range(histogram.bucketIndex(1 << 20) + 1):
+        (low, high) = histogram.bucketBounds(index)
+        assert low == previous + 1
+        assert histogram.bucketIndex(low) == index == histogram.bucketIndex(high)
+        previous = high
+
+def test_histogram_percentiles_within_precision():
+    histogram = Histogram()
+    values = [random.randint(1, 10 ** 6) for i in range(10000)]
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    for percent in (50, 99, 99.9):
+        exact = values[int(len(values) * percent / 100.0 + 0.5) - 1]
+        assert exact <= histogram.percentile(percent) <= exact * (1 + 2.0 ** -(HISTOGRAM_SUB_BUCKET_BITS - 1))
+
+def test_retired_clients_still_counted():
+    metrics = ServerMetrics()
+    (first, second) = (FakeClient(), FakeClient())
+    for client in (first, second):
+        metrics.register(client)
+        client.metrics.frames_in += 3
+        client.metrics.handle_latency.record(10)
+    metrics.retire(first)
+    metrics.retire(first)
+    totals = metrics.totals()
+    assert totals.frames_in == 6
+    assert totals.handle_latency.count() == 2
+    assert metrics.liveClients() == [second]
+
+def test_exporter_serves_prometheus_text():
+    server = FakeServer()
+    client = FakeClient()
+    server.metrics.register(client)
+    client.metrics.bytes_out += 42
+    for value in (1, 3, 1000):
+        client.metrics.send_latency.record(value)
+    exporter = MetricsExporter(server, 0)
+    exporter.start()
+    try:
+        url = 'http://127.0.0.1:{0}/metrics'.format(exporter.httpd.server_address[1])
+        lines = urllib.request.urlopen(url, timeout=5).read().decode('utf-8').splitlines()
+    finally:
+        exporter.stop()
+    assert 'hinge_bytes_sent_total 42' in lines
+    assert 'hinge_send_queue_messages 2' in lines
+    assert 'hinge_send_seconds_bucket{le="4e-06"} 2' in lines
+    assert 'hinge_send_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'hinge_send_seconds_count 3' in lines
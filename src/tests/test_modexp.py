@@ -0,0 +1,37 @@
+import random
+
+from src.hinge.crypto import modexp
+from src.hinge.crypto.smp import SMP
+
+
+def test_fixed_base_matches_pow():
+    mod = SMP('secret').mod
+    table = modexp.FixedBase(2, mod, 256, window=5)
+    rand = random.Random(1)
+    exponents = [0, 1, 2, 31, 32, (1 << 256) - 1] + [rand.getrandbits(256) for i in range(20)]
+    for exponent in exponents:
+        assert table.pow(exponent) == pow(2, exponent, mod)
+    # Wider than the table
+    assert table.pow(1 << 300) == pow(2, 1 << 300, mod)
+
+def test_tables_are_shared():
+    (first, second) = (SMP('a'), SMP('b'))
+    assert first.powGen(12345) == pow(2, 12345, first.mod)
+    second.powGen(1)
+    assert first.genTable is second.genTable
+
+def test_multi_exp_matches_pow():
+    mod = SMP('secret').mod
+    rand = random.Random(2)
+    for sizes in [(1536, 256), (1536, 1536), (0, 7), (1, 1535, 300)]:
+        pairs = [(rand.randrange(mod * 2), rand.getrandbits(size) if size else 0) for size in sizes]
+        expected = 1
+        for base, exponent in pairs:
+            expected = expected * pow(base, exponent, mod) % mod
+        assert modexp.multiExp(pairs, mod) == expected
+    assert modexp.multiExp([], mod) == 1
+
+def test_smp_exchange():
+    (alice, bob) = (SMP('at dawn'), SMP('at dawn'))
+    alice.step5(bob.step4(alice.step3(bob.step2(alice.step1()))))
+    assert alice.match and bob.match
@@ -0,0 +1,55 @@
+import threading
+import time
+
+import pytest
+
+from src.hinge.network.SendQueue import SendQueue
+from src.hinge.utils import *
+
+
+def test_batches_and_high_water_marks():
+    queue = SendQueue(max_messages=10, max_bytes=100)
+    for i in range(5):
+        assert queue.put(i, 10)
+    assert queue.get(max_items=3) == [0, 1, 2]
+    assert queue.get() == [3, 4]
+    stats = queue.stats()
+    assert (stats['messages'], stats['bytes']) == (0, 0)
+    assert (stats['high_water_messages'], stats['high_water_bytes']) == (5, 50)
+
+def test_drop_policy_drops_low_priority_only():
+    queue = SendQueue(max_messages=2, policy=SEND_POLICY_DROP)
+    queue.put('a')
+    queue.put('b')
+    assert not queue.put('typing', low_priority=True)
+    assert queue.stats()['dropped'] == 1
+    # Anything else waits for room
+    sender = threading.Thread(target=queue.put, args=('c',))
+    sender.start()
+    time.sleep(0.05)
+    assert sender.is_alive()
+    assert queue.get(max_items=1) == ['a']
+    sender.join(5)
+    assert queue.get() == ['b', 'c']
+    assert queue.stats()['blocked'] == 1
+
+def test_disconnect_policy_evicts():
+    queue = SendQueue(max_bytes=10, policy=SEND_POLICY_DISCONNECT)
+    queue.put('a', 8)
+    with pytest.raises(NetworkError) as ne:
+        queue.put('b', 8)
+    assert ne.value.err == ERR_SLOW_CONSUMER
+    queue.close('bye')
+    assert queue.get() == ['bye']
+    assert queue.get() == []
+
+def test_close_wakes_blocked_senders():
+    queue = SendQueue(max_messages=1)
+    queue.put('a')
+    results = []
+    sender = threading.Thread(target=lambda: results.append(queue.put('b')))
+    sender.start()
+    time.sleep(0.05)
+    queue.close()
+    sender.join(5)
+    assert results == [False]
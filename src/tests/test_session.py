@@ -0,0 +1,117 @@
+import pytest
+
+from src.hinge.network.Compressor import Compressor
+from src.hinge.network.Message import Message
+from src.hinge.network.Session import Session
+from src.hinge.utils import *
+
+
+class FakeClient(object):
+
+    def __init__(self, client_id):
+        self.id = client_id
+        self.key_pool = None
+        self.sent = []
+        self.errors = []
+        self.callbacks = {'err': lambda remote_id, error: self.errors.append(error)}
+
+    def sendMessage(self, message):
+        self.sent.append(message)
+
+
+def sessionPair(cipher):
+    (alice, bob) = (Session(FakeClient('alice'), 'bob'), Session(FakeClient('bob'), 'alice'))
+    for session in (alice, bob):
+        session.crypto.generateDHKey(suite=KEX_X25519)
+        session.crypto.cipherSuite = cipher
+        session.encrypted = True
+    alice.crypto.computeDHSecret(bob.crypto.exportDHPubKey())
+    bob.crypto.computeDHSecret(alice.crypto.exportDHPubKey())
+    alice.initiator = True
+    return (alice, bob)
+
+@pytest.mark.parametrize('cipher', CIPHER_SUITES)
+def test_messages_round_trip(cipher):
+    (alice, bob) = sessionPair(cipher)
+    for i in range(3):
+        alice.sendMessage(COMMAND_MSG, 'hello {0}'.format(i))
+        bob.sendMessage(COMMAND_MSG, 'hi {0}'.format(i))
+    assert [bob._Session__getDecryptedData(message) for message in alice.client.sent] == \
+           [b'hello 0', b'hello 1', b'hello 2']
+    assert [alice._Session__getDecryptedData(message) for message in bob.client.sent] == \
+           [b'hi 0', b'hi 1', b'hi 2']
+
+@pytest.mark.parametrize('cipher', [CIPHER_CHACHA20_POLY1305, CIPHER_AES_GCM])
+def test_aead_rejects_tampering(cipher):
+    (alice, bob) = sessionPair(cipher)
+    alice.sendMessage(COMMAND_MSG, 'attack at dawn')
+    message = alice.client.sent[-1]
+    # The command is authenticated too
+    message.command = COMMAND_TYPING
+    with pytest.raises(CryptoError):
+        bob._Session__getDecryptedData(message)
+    assert bob.client.errors == [ERR_BAD_HMAC]
+    # Replaying an earlier message
+    message.command = COMMAND_MSG
+    assert bob._Session__getDecryptedData(message) == b'attack at dawn'
+    with pytest.raises(ProtocolError):
+        bob._Session__getDecryptedData(message)
+    # Both sides start counting at 0, a message can't be reflected back to its sender
+    with pytest.raises(CryptoError):
+        alice._Session__getDecryptedData(message)
+
+@pytest.mark.parametrize('cipher', CIPHER_SUITES)
+def test_long_messages_compressed(cipher):
+    (alice, bob) = sessionPair(cipher)
+    (plain, _) = sessionPair(cipher)
+    for session in (alice, bob):
+        session.compressor = Compressor()
+    paste = 'def relay(self, frame):\n    return self.sock.send(frame)\n' * 20
+    texts = ['hi', paste, paste.upper(), paste, 'bye']
+    for text in texts:
+        alice.sendMessage(COMMAND_MSG, text)
+        plain.sendMessage(COMMAND_MSG, text)
+    alice.sendMessage(COMMAND_TYPING, str(TYPING_START))
+    assert [bob._Session__getDecryptedData(message) for message in alice.client.sent] == \
+           [text.encode() for text in texts] + [str(TYPING_START).encode()]
+    sizes = [len(message.getEncryptedDataAsBinaryString()) for message in alice.client.sent]
+    plain_sizes = [len(message.getEncryptedDataAsBinaryString()) for message in plain.client.sent]
+    assert sizes[1] < plain_sizes[1] // 4
+    # The repeat is mostly a reference back into the stream
+    assert sizes[3] < sizes[1]
+
+def test_corrupt_compressed_data():
+    (sender, receiver) = (Compressor(threshold=0), Compressor())
+    deflated = sender.compress('hello ' * 50)
+    with pytest.raises(CryptoError):
+        receiver.decompress(b'\x02' + deflated[1:])
+    with pytest.raises(CryptoError):
+        receiver.decompress(COMPRESSION_DEFLATED + b'\xff' * 8)
+
+@pytest.mark.parametrize('cipher', [CIPHER_CHACHA20_POLY1305, CIPHER_AES_GCM])
+def test_dropped_typing_notifications_leave_no_gap(cipher):
+    (alice, bob) = sessionPair(cipher)
+    alice.sendMessage(COMMAND_TYPING, str(TYPING_START))
+    alice.sendMessage(COMMAND_TYPING, str(TYPING_STOP_WITHOUT_TEXT))
+    alice.sendMessage(COMMAND_MSG, 'one')
+    alice.sendMessage(COMMAND_TYPING, str(TYPING_START))
+    alice.sendMessage(COMMAND_MSG, 'two')
+    # The first notification is dropped on the way, only they are droppable
+    sent = alice.client.sent
+    assert [message.hasNum() for message in sent] == [False, False, True, False, True]
+    for frame_format in FRAME_FORMATS:
+        assert [Message.frameHasNum(message.encode(frame_format)) for message in sent] == \
+               [False, False, True, False, True]
+    assert [bob._Session__getDecryptedData(message) for message in sent[1:]] == \
+           [str(TYPING_STOP_WITHOUT_TEXT).encode(), b'one', str(TYPING_START).encode(), b'two']
+    # Replayed ones still aren't accepted
+    with pytest.raises(ProtocolError):
+        bob._Session__getDecryptedData(sent[1])
+
+def test_typing_notifications_numbered_with_cbc_are_not_droppable():
+    (alice, bob) = sessionPair(CIPHER_AES_CBC_HMAC)
+    alice.sendMessage(COMMAND_TYPING, str(TYPING_START))
+    # Older clients number them along with everything else
+    message = alice.client.sent[0]
+    assert message.hasNum()
+    assert all(Message.frameHasNum(message.encode(frame_format)) for frame_format in FRAME_FORMATS)
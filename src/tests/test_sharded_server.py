@@ -0,0 +1,35 @@
+import os
+import socket
+import tempfile
+
+from src.hinge.network.sock import Socket
+from src.hinge.server.ShardedTURNServer import ShardWorker
+from src.hinge.utils import *
+
+
+def test_dead_links_are_dropped_and_reopened():
+    link_dir = tempfile.mkdtemp(prefix='hinge-test-')
+    link_paths = [os.path.join(link_dir, 'shard-{0}.sock'.format(i)) for i in range(2)]
+    worker = ShardWorker(0, 0, link_paths, None, send_queue_messages=4, send_queue_bytes=1024)
+    # Stands in for shard 1
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(link_paths[1])
+    listener.listen(2)
+    shard = worker.getShard(1)
+    link = Socket((link_paths[1], 1), listener.accept()[0])
+    shard.sendFrame(b'hello')
+    assert link.recvFrame() == b'hello'
+    link.disconnect()
+    # Writes fail once the other end is gone, the link goes and nothing is queued for it
+    for i in range(100):
+        shard.sendFrame(b'x' * 512)
+    shard.send_thread.join(5)
+    assert not shard.send_thread.is_alive()
+    assert worker.shards == {}
+    assert len(shard.send_thread.queue) == 0
+    reopened = worker.getShard(1)
+    assert reopened is not shard
+    link = Socket((link_paths[1], 1), listener.accept()[0])
+    reopened.sendFrame(b'again')
+    assert link.recvFrame() == b'again'
+    listener.close()
@@ -0,0 +1,49 @@
+import struct
+
+import pytest
+
+from src.hinge.crypto import smp
+from src.hinge.crypto.CryptoUtils import CryptoUtils
+from src.hinge.crypto.smp import SMP
+from src.hinge.utils import *
+
+
+def oldPackList(*items):
+    # The encoding before int.to_bytes, one byte at a time
+    buffer = b''
+    for item in items:
+        bytes = b''
+        while item != 0:
+            bytes = struct.pack('B', item & 0xff) + bytes
+            item >>= 8
+        buffer += struct.pack('!I', len(bytes)) + bytes
+    return buffer
+
+def exchange(codec, secrets=('at dawn', 'at dawn')):
+    (alice, bob) = (SMP(secrets[0], codec), SMP(secrets[1], codec))
+    buffer = bob.step2(alice.step1())
+    alice.step5(bob.step4(alice.step3(buffer)))
+    return (alice, bob)
+
+def test_v1_is_wire_compatible():
+    items = [0, 1, 255, 256, smp.MOD - 1, 1 << 1535]
+    assert smp.packList(*items) == oldPackList(*items)
+    assert smp.unpackList(oldPackList(*items)) == items
+    assert SMP('at dawn').hash('1' + str(items[4])) == int(CryptoUtils().stringHash('1' + str(items[4])), 16)
+
+@pytest.mark.parametrize('codec', SMP_CODECS)
+def test_exchange(codec):
+    (alice, bob) = exchange(codec)
+    assert alice.match and bob.match
+    (alice, bob) = exchange(codec, ('at dawn', 'at dusk'))
+    assert not (alice.match or bob.match)
+
+def test_v2_is_fixed_width():
+    values = [0, 1, smp.MOD - 1]
+    buffer = smp.packFixed(*values)
+    assert len(buffer) == 3 * smp.INT_SIZE == 768
+    assert smp.unpackFixed(buffer) == values
+    with pytest.raises(CryptoError):
+        smp.unpackFixed(buffer[:-1])
+    # The two codecs hash the same values differently
+    assert SMP('at dawn', SMP_CODEC_V1).hashValues('1', 5, 7) != SMP('at dawn', SMP_CODEC_V2).hashValues('1', 5, 7)
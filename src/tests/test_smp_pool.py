@@ -0,0 +1,34 @@
+import pytest
+
+from src.hinge.crypto.SmpPool import SmpPool
+from src.hinge.crypto.smp import SMP
+from src.hinge.utils import *
+
+
+def exchange(pool):
+    (alice, bob) = (SMP('at dawn'), SMP('at dawn'))
+    (alice, buffer) = pool.submit(alice, 'step1').result()
+    (bob, buffer) = pool.submit(bob, 'step2', (buffer,)).result()
+    (alice, buffer) = pool.submit(alice, 'step3', (buffer,)).result()
+    (bob, buffer) = pool.submit(bob, 'step4', (buffer,)).result()
+    (alice, buffer) = pool.submit(alice, 'step5', (buffer,)).result()
+    return (alice, bob)
+
+def test_steps_run_in_worker_processes():
+    pool = SmpPool(workers=1)
+    try:
+        (alice, bob) = exchange(pool)
+        assert alice.match and bob.match
+        # The table stayed behind in the worker
+        assert alice.genTable is None
+    finally:
+        pool.close()
+
+def test_inline_pool_reports_check_failures():
+    pool = SmpPool(workers=0)
+    (state, buffer) = pool.submit(SMP('at dawn'), 'step1').result()
+    future = pool.submit(SMP('at dusk'), 'step2', (buffer[:-1] + bytes([buffer[-1] ^ 1]),))
+    assert future.done()
+    with pytest.raises(CryptoError) as error:
+        future.result()
+    assert error.value.err == ERR_SMP_CHECK_FAILED
@@ -0,0 +1,53 @@
+import socket
+import threading
+
+import pytest
+
+from src.hinge.network.sock import Socket
+from src.hinge.utils import *
+
+
+def socketPair(max_frame_size=MAX_FRAME_SIZE):
+    (left, right) = socket.socketpair()
+    return (Socket(('left', 0), left), Socket(('right', 0), right, max_frame_size))
+
+def test_queued_frames_are_split():
+    (writer, reader) = socketPair()
+    writer.send('first')
+    writer.send(b'second')
+    writer.send('')
+    assert reader.recv() == 'first'
+    assert reader.recvFrame() == b'second'
+    assert reader.recvFrame() == b''
+
+def test_frame_split_across_reads():
+    (writer, reader) = socketPair()
+    frame = writer.packFrameSize(5) + b'hello'
+    for i in range(len(frame)):
+        writer.sock.send(frame[i:i + 1])
+    assert reader.recvFrame() == b'hello'
+
+def test_large_frame_grows_buffer():
+    (writer, reader) = socketPair()
+    data = b'x' * (RECV_BUFFER_SIZE * 3 + 7)
+    pending = writer.packFrameSize(len(data)) + data + writer.packFrameSize(2) + b'ok'
+    # Send from another thread so neither side blocks on a full socket buffer
+    thread = threading.Thread(target=writer.sock.sendall, args=(pending,))
+    thread.start()
+    assert reader.recvFrame() == data
+    assert reader.recvFrame() == b'ok'
+    thread.join()
+
+def test_oversized_frame_is_rejected():
+    (writer, reader) = socketPair(max_frame_size=16)
+    writer.send('x' * 17)
+    with pytest.raises(NetworkError) as ne:
+        reader.recvFrame()
+    assert ne.value.err == ERR_FRAME_TOO_LARGE
+    assert not reader.connected
+
+def test_closed_connection():
+    (writer, reader) = socketPair()
+    writer.disconnect()
+    with pytest.raises(NetworkError):
+        reader.recvFrame()
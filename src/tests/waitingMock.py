@@ -1,27 +1,28 @@
-from mock import Mock
-from threading import Event
+from threading import Condition
+from unittest.mock import Mock, call
 
 class WaitingMock(Mock):
-    TIMEOUT = 3
+    # DH and SMP are done in pure Python, give them time
+    TIMEOUT = 60
 
     def __init__(self, *args, **kwargs):
         super(WaitingMock, self).__init__(*args, **kwargs)
-        self.calledEvent = Event()
+        self.calledCondition = Condition()
 
 
     def _mock_call(self, *args, **kwargs):
         retval = super(WaitingMock, self)._mock_call(*args, **kwargs)
 
-        if self.call_count >= 1:
-            self.calledEvent.set()
+        with self.calledCondition:
+            self.calledCondition.notify_all()
 
         return retval
 
     def assert_called_with_wait(self, *args, **kargs):
-        self.calledEvent.clear()
+        # Callbacks come from other threads, so wait for a matching call in any order
+        expected = call(*args, **kargs)
 
-        if self.call_count >= 1:
-            return True
+        with self.calledCondition:
+            self.calledCondition.wait_for(lambda: expected in self.call_args_list, timeout=self.TIMEOUT)
 
-        self.calledEvent.wait(timeout=self.TIMEOUT)
-        self.assert_called_with(*args, **kargs)
+        self.assert_any_call(*args, **kargs)